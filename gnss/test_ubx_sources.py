@@ -0,0 +1,326 @@
+""" Round trip tests of the UBX frame sources, run with pytest """
+
+import os
+import gzip
+import time
+import shutil
+import socket
+import sqlite3
+import asyncio
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+import gnss_lib_py as glp
+from pyubx2 import UBXReader
+
+from ubx_batch import convert_ubx_files, read_manifest
+from ubx_generator import UbxGenerator
+from ubx_index import UbxEpochIndex, INDEX_SUFFIX
+from ubx_parser import UbxParser
+from ubx_schema import UbxSchemaCache, tabulate_message
+from ubx_scanner import UbxScanner, UbxBlockMessage, decode_native, ubx_identity
+from ubx_stream import UbxStreamScanner, ubx_file_frames, serve_ubx_file
+from ubx_writers import SENSORS_DB_TABLES, SqliteWriterPool
+
+
+def read_outputs(parser):
+    """Contents of each output file of a parser by identity."""
+    outputs = dict()
+    for identity, path in parser.ubx_csv_files.items():
+        with open(path, 'rb') as f:
+            outputs[identity] = f.read()
+    return outputs
+
+
+def file_frames(input_path):
+    """Frames of a whole file as (offset, class, id, bytes)."""
+    return [(offset, msg_class, msg_id, bytes(frame))
+            for offset, msg_class, msg_id, frame in UbxScanner(input_path)]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def ubx_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("ubx") / "capture.ubx")
+    UbxGenerator(rate=10., n_svs=12, n_sigs=16, n_meas=8, seed=1).write(path, 5.)
+    return path
+
+
+@pytest.fixture(scope="module")
+def corrupted_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("ubx") / "corrupted.ubx")
+    UbxGenerator(rate=10., n_svs=12, n_sigs=16, n_meas=8, corruption=0.05,
+                 seed=2).write(path, 5.)
+    return path
+
+
+def test_mmap_matches_pyubx2(ubx_file, tmp_path):
+    mmap = UbxParser(ubx_file, engine="mmap", output_dir=str(tmp_path / "mmap"))
+    reader = UbxParser(ubx_file, engine="pyubx2", output_dir=str(tmp_path / "pyubx2"))
+
+    assert mmap.n_epochs == reader.n_epochs == 50
+    assert read_outputs(mmap) == read_outputs(reader)
+
+
+@pytest.mark.parametrize("input_name", ["ubx_file", "corrupted_file"])
+def test_stream_scanner_matches_file_scanner(input_name, request):
+    input_path = request.getfixturevalue(input_name)
+    with open(input_path, 'rb') as f:
+        data = f.read()
+
+    rng = np.random.default_rng(3)
+    cuts = np.sort(rng.integers(0, len(data), 400))
+    scanner = UbxStreamScanner(exact=True)
+    frames = []
+    for start, stop in zip(np.concatenate(([0], cuts)), np.concatenate((cuts, [len(data)]))):
+        frames += scanner.feed(data[start:stop])
+    frames += scanner.finish()
+
+    assert [(offset, msg_class, msg_id, bytes(frame))
+            for offset, msg_class, msg_id, frame in frames] == file_frames(input_path)
+
+
+def test_compressed_frames_match_file_scanner(corrupted_file, tmp_path):
+    compressed_path = str(tmp_path / "corrupted.ubx.gz")
+    with open(corrupted_file, 'rb') as src, gzip.open(compressed_path, 'wb') as dst:
+        dst.write(src.read())
+
+    frames = [(offset, msg_class, msg_id, bytes(frame))
+              for offset, msg_class, msg_id, frame in ubx_file_frames(compressed_path,
+                                                                      chunk_size=4096)]
+    assert frames == file_frames(corrupted_file)
+
+
+def test_stream_matches_file(ubx_file, tmp_path):
+    port = free_port()
+
+    async def serve():
+        try:
+            await serve_ubx_file(ubx_file, port=port, speed=0, packet_size=777)
+        except asyncio.CancelledError:
+            pass
+
+    loop = asyncio.new_event_loop()
+    server = loop.create_task(serve())
+    thread = threading.Thread(target=loop.run_until_complete, args=(server,), daemon=True)
+    thread.start()
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        streamed = UbxParser(None, stream_address=("127.0.0.1", port), idle_timeout=10.,
+                             output_dir=str(tmp_path / "stream"))
+    finally:
+        loop.call_soon_threadsafe(server.cancel)
+        thread.join(5)
+        loop.close()
+
+    parsed = UbxParser(ubx_file, output_dir=str(tmp_path / "file"))
+    assert streamed.n_epochs == parsed.n_epochs
+    assert read_outputs(streamed) == read_outputs(parsed)
+    assert all(os.path.dirname(path) == str(tmp_path / "stream")
+               for path in streamed.ubx_csv_files.values())
+    # serving doesn't write an index sidecar next to the capture
+    assert not os.path.exists(ubx_file + INDEX_SUFFIX)
+
+
+@pytest.mark.parametrize("input_name", ["ubx_file", "corrupted_file"])
+def test_parallel_matches_serial(input_name, request, tmp_path):
+    input_path = request.getfixturevalue(input_name)
+    serial = UbxParser(input_path, output_dir=str(tmp_path / "serial"))
+    parallel = UbxParser(input_path, workers=4, output_dir=str(tmp_path / "parallel"))
+
+    assert parallel.n_epochs == serial.n_epochs
+    assert read_outputs(parallel) == read_outputs(serial)
+
+
+def test_follow_resumes_from_checkpoint(ubx_file, tmp_path):
+    with open(ubx_file, 'rb') as f:
+        data = f.read()
+    growing_path = str(tmp_path / "growing.ubx")
+    output_dir = str(tmp_path / "follow")
+
+    # the file grows by pieces ending in the middle of a frame, each run
+    # parses what has been appended since the last one and returns
+    frames = file_frames(ubx_file)
+    chosen = np.sort(np.random.default_rng(4).choice(len(frames), 12, replace=False))
+    cuts = [frames[i][0] + len(frames[i][3]) // 2 for i in chosen.tolist()]
+    written = 0
+    for cut in cuts + [len(data)]:
+        with open(growing_path, 'ab') as f:
+            f.write(data[written:cut])
+        written = cut
+        followed = UbxParser(growing_path, follow=True, idle_timeout=0, output_dir=output_dir)
+
+    parsed = UbxParser(ubx_file, output_dir=str(tmp_path / "file"))
+    assert read_outputs(followed) == read_outputs(parsed)
+
+
+def rows_in_time_range(output, start_millis, end_millis):
+    """Header and rows of a csv output whose gps_millis is in the range."""
+    lines = output.splitlines(keepends=True)
+    return [lines[0]] + [line for line in lines[1:]
+                         if start_millis <= float(line.split(b",")[0]) <= end_millis]
+
+
+def test_time_range_matches_filtered_parse(ubx_file, tmp_path):
+    input_path = str(tmp_path / "capture.ubx")
+    shutil.copy(ubx_file, input_path)
+    gps_millis = UbxEpochIndex.build(input_path).gps_millis
+    # between epoch times, so the bounds don't depend on float rounding
+    start_millis = (gps_millis[9] + gps_millis[10]) / 2
+    end_millis = (gps_millis[30] + gps_millis[31]) / 2
+
+    ranged = UbxParser(input_path, time_range=(start_millis, end_millis),
+                       output_dir=str(tmp_path / "range"))
+    parsed = UbxParser(input_path, output_dir=str(tmp_path / "file"))
+
+    assert ranged.n_epochs == 21
+    # RXM rows have no gps_millis column to filter by
+    expected = {identity: rows_in_time_range(output, start_millis, end_millis)
+                for identity, output in read_outputs(parsed).items()
+                if not identity.startswith("RXM")}
+    assert {identity: output.splitlines(keepends=True)
+            for identity, output in read_outputs(ranged).items()
+            if not identity.startswith("RXM")} == expected
+
+
+def test_index_sidecar_reused_until_stale(ubx_file, tmp_path, monkeypatch):
+    input_path = str(tmp_path / "capture.ubx")
+    shutil.copy(ubx_file, input_path)
+    builds = []
+    build = UbxEpochIndex.build.__func__
+    monkeypatch.setattr(UbxEpochIndex, "build",
+                        classmethod(lambda cls, path: builds.append(path) or build(cls, path)))
+
+    index = UbxEpochIndex.load_or_build(input_path)
+    assert os.path.exists(input_path + INDEX_SUFFIX)
+    reused = UbxEpochIndex.load_or_build(input_path)
+    assert len(builds) == 1
+    assert np.array_equal(reused.ends, index.ends)
+    assert np.array_equal(reused.gps_millis, index.gps_millis, equal_nan=True)
+
+    # a changed file makes the sidecar stale
+    stat = os.stat(input_path)
+    os.utime(input_path, (stat.st_atime, stat.st_mtime + 10))
+    UbxEpochIndex.load_or_build(input_path)
+    assert len(builds) == 2
+    UbxEpochIndex.load_or_build(input_path)
+    assert len(builds) == 2
+
+
+def test_block_decoders_match_pyubx2(ubx_file):
+    conversions = UbxParser._ubx_name_conversions()
+    schemas = UbxSchemaCache(conversions)
+    decoded = dict()
+    for offset, msg_class, msg_id, frame in UbxScanner(ubx_file):
+        identity = ubx_identity(msg_class, msg_id)
+        if identity not in ("NAV-SAT", "NAV-SIG", "RXM-RAWX"):
+            continue
+        native = decode_native(msg_class, msg_id, frame)
+        reference = UBXReader.parse(bytes(frame))
+
+        assert isinstance(native, UbxBlockMessage)
+        labels, rows = tabulate_message(reference, conversions)
+        assert tabulate_message(native, conversions) == (labels, rows)
+        assert schemas.tabulate(native) == (labels, rows)
+        decoded[identity] = decoded.get(identity, 0) + 1
+
+    assert decoded == {"NAV-SAT" : 50, "NAV-SIG" : 50, "RXM-RAWX" : 50}
+
+
+def read_output_dir(output_dir):
+    """Contents of each csv file in a directory by file name."""
+    outputs = dict()
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith(".csv"):
+            with open(os.path.join(output_dir, name), 'rb') as f:
+                outputs[name] = f.read()
+    return outputs
+
+
+def test_batch_skips_up_to_date_files(ubx_file, corrupted_file, tmp_path):
+    input_dir = tmp_path / "captures"
+    os.makedirs(input_dir / "day")
+    shutil.copy(ubx_file, input_dir / "clean.ubx")
+    with open(corrupted_file, 'rb') as src, gzip.open(input_dir / "day" / "corrupted.ubx.gz", 'wb') as dst:
+        dst.write(src.read())
+    output_root = str(tmp_path / "results")
+    clean_dir = os.path.join(output_root, "clean")
+
+    def convert(**options):
+        summary = convert_ubx_files([str(input_dir)], output_root, workers=2, **options)
+        return summary["converted"], summary["skipped"]
+
+    assert convert() == (2, 0)
+    assert convert() == (0, 2)
+    # a .gz capture is written like the uncompressed file
+    parsed = UbxParser(corrupted_file, output_dir=str(tmp_path / "file"))
+    assert read_output_dir(os.path.join(output_root, "day", "corrupted")) \
+           == read_output_dir(parsed.output_dir)
+
+    # size and mtime manifests don't match hashes, then hashes ignore mtimes
+    assert convert(use_hash=True) == (2, 0)
+    assert convert(use_hash=True) == (0, 2)
+    stat = os.stat(input_dir / "clean.ubx")
+    os.utime(input_dir / "clean.ubx", (stat.st_atime, stat.st_mtime + 10))
+    assert convert(use_hash=True) == (0, 2)
+    assert convert() == (2, 0)
+    assert convert(force=True) == (2, 0)
+
+    # narrowing include removes the outputs it no longer writes
+    assert set(read_output_dir(clean_dir)) > {"NAV_PVT.csv"}
+    assert convert(include=["NAV-PVT"]) == (2, 0)
+    assert set(read_output_dir(clean_dir)) == {"NAV_PVT.csv"}
+    assert read_manifest(clean_dir)["files"] == [os.path.join(clean_dir, "NAV_PVT.csv")]
+
+
+def read_sqlite_tables(parser):
+    """Columns and rows of every table of a parser's sqlite output."""
+    connection = sqlite3.connect(parser.ubx_csv_files["NAV-PVT"])
+    tables = dict()
+    for table, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+        cursor = connection.execute(f"SELECT * FROM {table} ORDER BY id")
+        tables[table] = ([column[0] for column in cursor.description], cursor.fetchall())
+    connection.close()
+    return tables
+
+
+@pytest.mark.parametrize("input_name", ["ubx_file", "corrupted_file"])
+def test_sqlite_output(input_name, request, tmp_path):
+    input_path = request.getfixturevalue(input_name)
+    serial = UbxParser(input_path, output_format="sqlite", session="s1",
+                       output_dir=str(tmp_path / "serial"))
+    parallel = UbxParser(input_path, output_format="sqlite", session="s1", workers=4,
+                         output_dir=str(tmp_path / "parallel"))
+
+    tables = read_sqlite_tables(serial)
+    # the generated captures have NAV-PVT and NAV-TIMEGPS of the sensors database tables
+    assert set(tables) == {"nav_pvt", "nav_timegps"}
+    for table, columns in SENSORS_DB_TABLES.values():
+        if table in tables:
+            assert tables[table][0] == ["id", "system_time", "session"] + [column[0] for column in columns]
+            # at most one row per epoch, corrupted epochs can miss the message
+            assert 0 < len(tables[table][1]) <= serial.n_epochs
+    assert read_sqlite_tables(parallel) == tables
+
+
+def test_sqlite_system_time_of_array_gps_millis():
+    gps_millis = 1390000000123.
+    system_time = SqliteWriterPool()._system_time(gps_millis)
+
+    # gnss_lib_py gives gps_millis as 0-d arrays
+    assert SqliteWriterPool()._system_time(np.array(gps_millis)) == system_time
+    assert SqliteWriterPool()._system_time(np.array([gps_millis])[0]) == system_time
+    expected = pd.Timestamp(glp.gps_millis_to_datetime(gps_millis)).tz_localize(None)
+    assert abs(pd.Timestamp(system_time) - expected) <= pd.Timedelta(microseconds=1)
@@ -0,0 +1,318 @@
+""" Convert many UBX files at once with a process pool """
+
+import os
+import glob
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+
+from ubx_parser import UbxParser
+from ubx_writers import DEFAULT_BUFFER_SIZE, OUTPUT_FORMATS
+
+# file in each output directory recording what it was converted from
+MANIFEST_NAME = "ubx_batch.json"
+
+# file name patterns searched for in input directories
+UBX_PATTERNS = ["*.ubx", "*.ubx.gz", "*.ubx.xz", "*.ubx.zst"]
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def find_ubx_files(inputs, output_root):
+    """Expand directories and globs into UBX files and output directories.
+
+    Files found in a directory keep their path relative to it below
+    ``output_root``, files given directly or by a glob get a directory
+    named after the file like ``ubx_parser.py`` uses.
+
+    Parameters
+    ----------
+    inputs : list
+        UBX files, directories searched recursively and glob patterns.
+    output_root : string
+        Directory under which each file's output directory is made.
+
+    Returns
+    -------
+    files : list
+        (input path, output directory) of each UBX file, in order and
+        without duplicates.
+
+    """
+    files = dict()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths = sorted(path for ubx_pattern in UBX_PATTERNS
+                           for path in glob.glob(os.path.join(pattern, "**", ubx_pattern),
+                                                 recursive=True))
+            relative = [os.path.relpath(path, pattern) for path in paths]
+        else:
+            paths = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+            relative = [os.path.basename(path) for path in paths]
+        for path, name in zip(paths, relative):
+            output_dir = os.path.join(output_root, os.path.dirname(name),
+                                      os.path.basename(name).split(".")[0])
+            files.setdefault(os.path.realpath(path), (path, output_dir))
+
+    output_dirs = [output_dir for path, output_dir in files.values()]
+    if len(set(output_dirs)) != len(output_dirs):
+        raise ValueError("several input files map to the same output directory, "
+                         "pass their parent directory instead of a glob")
+    return list(files.values())
+
+
+def input_stamp(input_path, use_hash=False):
+    """Describe an input file's current content.
+
+    Parameters
+    ----------
+    input_path : string
+        Path to UBX file.
+    use_hash : bool
+        If True, include the SHA-256 of the content, otherwise only the
+        size and modification time.
+
+    Returns
+    -------
+    stamp : dict
+        Size and modification time, or size and content hash.
+
+    """
+    stat = os.stat(input_path)
+    if not use_hash:
+        return {"size" : stat.st_size, "mtime" : stat.st_mtime}
+    digest = hashlib.sha256()
+    with open(input_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return {"size" : stat.st_size, "sha256" : digest.hexdigest()}
+
+
+def read_manifest(output_dir):
+    """Read the manifest of an output directory.
+
+    Parameters
+    ----------
+    output_dir : string
+        Output directory of a UBX file.
+
+    Returns
+    -------
+    manifest : dict
+        The manifest, empty if there is none.
+
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def is_up_to_date(manifest, options, stamp):
+    """Check whether a file's outputs match its current content.
+
+    Parameters
+    ----------
+    manifest : dict
+        Manifest of the file's output directory, see ``read_manifest``.
+    options : dict
+        Parser options the outputs must have been written with.
+    stamp : dict
+        Current ``input_stamp`` of the file. A manifest written with
+        a hash never matches a stamp without one and vice versa.
+
+    Returns
+    -------
+    up_to_date : bool
+        True if the manifest matches and all output files exist.
+
+    """
+    return manifest.get("options") == options and manifest.get("input") == stamp \
+           and all(os.path.exists(path) for path in manifest.get("files", []))
+
+
+def remove_stale_outputs(output_dir, old_files, new_files):
+    """Delete the outputs of an earlier conversion that the new one didn't write.
+
+    Parameters
+    ----------
+    output_dir : string
+        Output directory of the file. Only files inside it are deleted.
+    old_files : list
+        Output files listed in the previous manifest.
+    new_files : list
+        Output files listed in the new manifest.
+
+    """
+    root = os.path.realpath(output_dir) + os.sep
+    kept = set(os.path.realpath(path) for path in new_files)
+    for path in old_files:
+        real_path = os.path.realpath(path)
+        if real_path not in kept and real_path.startswith(root) and os.path.exists(real_path):
+            os.remove(real_path)
+
+
+def _convert_file(task):
+    """Parse one UBX file in a worker process and write its manifest.
+
+    With ``use_hash`` the input is hashed here, once, and compared with
+    the manifest before parsing, so unchanged files are skipped without
+    hashing them twice. Outputs of the previous conversion that aren't
+    written again, e.g. after narrowing ``include``, are removed.
+
+    Parameters
+    ----------
+    task : tuple
+        (input_path, output directory, parser options, use_hash, force).
+
+    Returns
+    -------
+    result : tuple
+        (input_path, converted, bytes read, epochs written, seconds),
+        converted being False if the outputs were up to date.
+
+    """
+    input_path, output_dir, options, use_hash, force = task
+    stamp = input_stamp(input_path, use_hash)
+    previous = read_manifest(output_dir)
+    if not force and is_up_to_date(previous, options, stamp):
+        return input_path, False, stamp["size"], previous.get("n_epochs", 0), 0.
+    start_time = time.perf_counter()
+    parser = UbxParser(input_path, output_dir=output_dir, **options)
+    seconds = time.perf_counter() - start_time
+
+    manifest = {
+        "input_path" : os.path.realpath(input_path),
+        "input" : stamp,
+        "options" : options,
+        "n_epochs" : parser.n_epochs,
+        "files" : sorted(parser.ubx_csv_files.values()),
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    remove_stale_outputs(output_dir, previous.get("files", []), manifest["files"])
+    return input_path, True, stamp["size"], parser.n_epochs, seconds
+
+
+def convert_ubx_files(inputs, output_root, workers=1, use_hash=False, force=False,
+                      **options):
+    """Convert UBX files in parallel, skipping those already converted.
+
+    Each file is parsed by one worker process into its own output
+    directory with a manifest of the input's size and mtime (or
+    content hash) and the parser options. A later run skips files
+    whose manifest still matches, checking mtimes up front and hashes
+    in the workers.
+
+    Parameters
+    ----------
+    inputs : list
+        UBX files, directories searched recursively and glob patterns.
+    output_root : string
+        Directory under which each file's output directory is made.
+    workers : int
+        Number of worker processes.
+    use_hash : bool
+        If True, detect changed inputs by content hash instead of size
+        and modification time.
+    force : bool
+        If True, convert all files even if their outputs are up to date.
+    **options
+        ``UbxParser`` options such as ``output_format`` or ``include``.
+
+    Returns
+    -------
+    summary : dict
+        Number of converted and skipped files, bytes read, epochs
+        written and wall clock seconds.
+
+    """
+    start_time = time.perf_counter()
+    tasks = []
+    skipped = 0
+    for input_path, output_dir in find_ubx_files(inputs, output_root):
+        # hashing is left to the workers, which need the hash for the manifest
+        if not force and not use_hash \
+           and is_up_to_date(read_manifest(output_dir), options, input_stamp(input_path)):
+            print("Up to date:", input_path)
+            skipped += 1
+            continue
+        tasks.append((input_path, output_dir, options, use_hash, force))
+
+    converted = 0
+    n_bytes = 0
+    n_epochs = 0
+    if len(tasks) > 0:
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            for input_path, done, size, epochs, seconds in pool.imap_unordered(_convert_file, tasks):
+                if not done:
+                    print("Up to date:", input_path)
+                    skipped += 1
+                    continue
+                print(f"Converted {input_path}: {size/1E6:.1f} MB, {epochs} epochs "
+                      f"in {seconds:.1f} s")
+                converted += 1
+                n_bytes += size
+                n_epochs += epochs
+
+    return {"converted" : converted, "skipped" : skipped, "bytes" : n_bytes,
+            "epochs" : n_epochs, "seconds" : time.perf_counter() - start_time}
+
+
+def print_summary(summary):
+    """Print the throughput of a batch conversion.
+
+    Parameters
+    ----------
+    summary : dict
+        Output of ``convert_ubx_files``.
+
+    """
+    seconds = max(summary["seconds"], 1E-9)
+    print(f"{summary['converted']} files converted, {summary['skipped']} up to date")
+    print(f"{summary['bytes']/1E6:.1f} MB and {summary['epochs']} epochs in {seconds:.1f} s: "
+          f"{summary['bytes']/1E6/seconds:.2f} MB/s, {summary['epochs']/seconds:.1f} epochs/s")
+
+
+def setup_parser():
+  """Parse command line arguments.
+
+  """
+  parser = argparse.ArgumentParser(description='Parse many ubx files in parallel')
+  parser.add_argument('inputs', type=str, nargs='+',
+                      help="UBX files, directories (searched recursively) or glob patterns")
+  parser.add_argument('-o','--output-root', type=str, required=True,
+                      help="directory under which each file's output directory is made")
+  parser.add_argument('-j','--workers', type=int, default=0,
+                      help="number of processes, 0 (default) uses all cores")
+  parser.add_argument('--hash', dest="use_hash", action="store_true",
+                      help="detect changed inputs by content hash instead of size and mtime")
+  parser.add_argument('--force', action="store_true", help="convert files even if up to date")
+  parser.add_argument('--engine', type=str, default="mmap", choices=["mmap","pyubx2"],
+                      help="read frames from a memory map or with pyubx2's UBXReader")
+  parser.add_argument('--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE,
+                      help="write buffer size in bytes for each csv file")
+  parser.add_argument('--format', dest="output_format", type=str, default="csv", choices=OUTPUT_FORMATS,
+                      help="write csv files, one columnar parquet/feather/npz file per message type "
+                           "or the sensors database tables")
+  parser.add_argument('--include', type=str, nargs='+', default=None,
+                      help="only write these identities, shell-style patterns e.g. NAV-PVT 'NAV-SA*'")
+  parser.add_argument('--exclude', type=str, nargs='+', default=None,
+                      help="don't write these identities, shell-style patterns e.g. 'RXM-*' 'MON-*'")
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  parser = setup_parser()
+  summary = convert_ubx_files(parser.inputs, parser.output_root,
+                              workers=parser.workers if parser.workers > 0 else os.cpu_count(),
+                              use_hash=parser.use_hash, force=parser.force,
+                              engine=parser.engine, buffer_size=parser.buffer_size,
+                              output_format=parser.output_format,
+                              include=parser.include, exclude=parser.exclude)
+  print_summary(summary)
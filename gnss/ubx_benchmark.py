@@ -0,0 +1,335 @@
+""" Benchmarks for the UBX parser """
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+import pyubx2
+from pyubx2 import UBXReader, UBX_PROTOCOL
+
+from ubx_parser import UbxParser
+from ubx_scanner import UbxScanner, ubx_identity
+from ubx_schema import UbxSchemaCache, tabulate_message
+from ubx_generator import UbxGenerator
+
+# seconds of synthetic data for each parser benchmark size
+BENCH_SIZES = {"small" : 60, "medium" : 300, "large" : 1800}
+
+# generator settings of the parser benchmark captures, changing them
+# makes results incomparable with earlier runs
+BENCH_GENERATOR = dict(rate=10., n_svs=30, n_sigs=40, n_meas=20, corruption=0.001, seed=0)
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                "results", "benchmark")
+
+
+def bench_schema(input_path, repeats=5):
+    """Compare per-message tabulation cost with and without schema cache.
+
+    All messages are decoded up front so only the conversion of
+    attributes into labels and rows is timed. Both paths must give the
+    same result for every message.
+
+    Parameters
+    ----------
+    input_path : string
+        Path to UBX file.
+    repeats : int
+        Number of timing runs, the fastest one is reported.
+
+    Returns
+    -------
+    results : dict
+        Identity to (number of messages, uncached seconds per message,
+        cached seconds per message).
+
+    """
+
+    conversions = UbxParser._ubx_name_conversions()
+
+    messages = dict()
+    with open(input_path, 'rb') as stream:
+        for raw_data, parsed_data in UBXReader(stream, protfilter=UBX_PROTOCOL):
+            messages.setdefault(parsed_data.identity, []).append(parsed_data)
+
+    results = dict()
+    for identity, identity_messages in sorted(messages.items()):
+        schemas = UbxSchemaCache(conversions)
+        for parsed_data in identity_messages:
+            if schemas.tabulate(parsed_data) != tabulate_message(parsed_data, conversions):
+                raise RuntimeError("schema cache output differs for " + identity)
+
+        uncached = min(_time_per_message(lambda msg: tabulate_message(msg, conversions),
+                                         identity_messages) for _ in range(repeats))
+        cached = min(_time_per_message(schemas.tabulate, identity_messages)
+                     for _ in range(repeats))
+        results[identity] = (len(identity_messages), uncached, cached)
+
+    return results
+
+
+def _time_per_message(tabulate, messages):
+    start = time.perf_counter()
+    for parsed_data in messages:
+        tabulate(parsed_data)
+    return (time.perf_counter() - start) / len(messages)
+
+
+def print_schema_results(results):
+    """Print a table of the schema cache benchmark.
+
+    Parameters
+    ----------
+    results : dict
+        Output of ``bench_schema``.
+
+    """
+    print(f"{'identity':<16}{'messages':>10}{'uncached us':>14}{'cached us':>12}{'speedup':>10}")
+    for identity, (count, uncached, cached) in results.items():
+        print(f"{identity:<16}{count:>10}{uncached*1E6:>14.2f}{cached*1E6:>12.2f}"
+              f"{uncached/cached:>9.1f}x")
+
+
+def bench_capture(size, data_dir=DEFAULT_DATA_DIR):
+    """Get the synthetic capture of a benchmark size, writing it once.
+
+    Captures are kept in ``data_dir`` so later runs, e.g. on other
+    commits, parse exactly the same bytes.
+
+    Parameters
+    ----------
+    size : string
+        One of ``BENCH_SIZES``.
+    data_dir : string
+        Directory of the benchmark captures.
+
+    Returns
+    -------
+    input_path : string
+        Path of the capture.
+
+    """
+    input_path = os.path.join(data_dir, f"bench_{size}_{BENCH_SIZES[size]}s.ubx")
+    if not os.path.exists(input_path):
+        os.makedirs(data_dir, exist_ok=True)
+        UbxGenerator(**BENCH_GENERATOR).write(input_path + ".tmp", BENCH_SIZES[size])
+        os.replace(input_path + ".tmp", input_path)
+    return input_path
+
+
+def bench_parser(sizes=("small", "medium"), repeats=3, data_dir=DEFAULT_DATA_DIR,
+                 identity_size="small", **options):
+    """Time ``UbxParser`` on synthetic captures of several sizes.
+
+    Every run parses a whole capture in a fresh process, so peak RSS
+    is that run's alone and nothing is cached from earlier runs. The
+    cost of each identity is the extra time of writing only that
+    identity over writing nothing, per message of that identity. Both
+    runs are made back to back in each repeat and the median of their
+    differences is reported, clamped at 0. Costs below the spread of
+    the runs writing nothing are flagged as noise.
+
+    Parameters
+    ----------
+    sizes : list
+        Names of ``BENCH_SIZES`` to run.
+    repeats : int
+        Number of runs per measurement, the fastest run of each size
+        and the median difference of each identity are reported.
+    data_dir : string
+        Directory of the benchmark captures.
+    identity_size : string
+        Size used to measure per-identity costs, None to skip them.
+    **options
+        ``UbxParser`` options such as ``engine`` or ``output_format``.
+
+    Returns
+    -------
+    results : dict
+        Environment, capture and timing results, ready to be saved as
+        json and compared with ``print_parser_results``.
+
+    """
+    results = {"environment" : _environment(), "generator" : BENCH_GENERATOR,
+               "options" : options, "sizes" : dict(), "identities" : dict()}
+
+    for size in sizes:
+        input_path = bench_capture(size, data_dir)
+        counts = _identity_counts(input_path)
+        runs = [_run_isolated(input_path, options) for _ in range(repeats)]
+        seconds = min(run["seconds"] for run in runs)
+        n_bytes = os.path.getsize(input_path)
+        n_messages = sum(counts.values())
+        results["sizes"][size] = {
+            "bytes" : n_bytes,
+            "sha256" : _file_hash(input_path),
+            "messages" : n_messages,
+            "epochs" : runs[0]["epochs"],
+            "seconds" : seconds,
+            "msgs_per_s" : n_messages / seconds,
+            "mb_per_s" : n_bytes / 1E6 / seconds,
+            "epochs_per_s" : runs[0]["epochs"] / seconds,
+            "peak_rss_mb" : max(run["peak_rss_mb"] for run in runs),
+        }
+
+    if identity_size is not None:
+        input_path = bench_capture(identity_size, data_dir)
+        counts = _identity_counts(input_path)
+        for identity, count in sorted(counts.items()):
+            bases = []
+            differences = []
+            for _ in range(repeats):
+                base = _run_isolated(input_path, dict(options, include=[]))["seconds"]
+                seconds = _run_isolated(input_path, dict(options, include=[identity]))["seconds"]
+                bases.append(base)
+                differences.append(seconds - base)
+            difference = float(np.median(differences))
+            noise = max(bases) - min(bases)
+            results["identities"][identity] = {"messages" : count,
+                                               "us_per_msg" : max(difference, 0.) / count * 1E6,
+                                               "noise_us_per_msg" : noise / count * 1E6,
+                                               "below_noise" : difference <= noise}
+
+    return results
+
+
+def _run_isolated(input_path, options):
+    """Parse a file in a new process and measure it."""
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(_run_parser, (input_path, options))
+
+
+def _run_parser(input_path, options):
+    output_dir = tempfile.mkdtemp(prefix="ubx-bench-")
+    try:
+        start = time.perf_counter()
+        parser = UbxParser(input_path, output_dir=output_dir, **options)
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 / 1E6 if sys.platform == "darwin" else 1 / 1024
+    return {"seconds" : seconds, "epochs" : parser.n_epochs,
+            "peak_rss_mb" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale}
+
+
+def _identity_counts(input_path):
+    starts, ends, msg_classes, msg_ids = UbxScanner(input_path).index()
+    codes, counts = np.unique((msg_classes.astype(np.int64) << 8) | msg_ids, return_counts=True)
+    return {ubx_identity(code >> 8, code & 0xFF) or f"0x{code:04x}" : count
+            for code, count in zip(codes.tolist(), counts.tolist())}
+
+
+def _file_hash(input_path):
+    digest = hashlib.sha256()
+    with open(input_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.realpath(__file__)),
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit" : commit, "python" : platform.python_version(),
+            "numpy" : np.__version__, "pyubx2" : pyubx2.version,
+            "machine" : platform.machine(), "cpus" : os.cpu_count()}
+
+
+def print_parser_results(results, baseline=None):
+    """Print the parser benchmark, optionally next to an earlier run.
+
+    Parameters
+    ----------
+    results : dict
+        Output of ``bench_parser``.
+    baseline : dict
+        Earlier output of ``bench_parser`` to compare with, e.g. from
+        another commit. Sizes whose captures differ aren't compared.
+
+    """
+    environment = results["environment"]
+    print(f"commit {environment['commit']}, python {environment['python']}, "
+          f"numpy {environment['numpy']}, pyubx2 {environment['pyubx2']}")
+    if baseline is not None:
+        print(f"baseline commit {baseline['environment']['commit']}")
+
+    print(f"{'size':<8}{'MB':>8}{'messages':>10}{'msgs/s':>11}{'MB/s':>8}"
+          f"{'epochs/s':>10}{'peak MB':>9}{'speedup':>9}")
+    for size, run in results["sizes"].items():
+        line = (f"{size:<8}{run['bytes']/1E6:>8.1f}{run['messages']:>10}"
+                f"{run['msgs_per_s']:>11.0f}{run['mb_per_s']:>8.2f}"
+                f"{run['epochs_per_s']:>10.0f}{run['peak_rss_mb']:>9.1f}")
+        old = None if baseline is None else baseline["sizes"].get(size)
+        if old is not None and old["sha256"] == run["sha256"]:
+            line += f"{old['seconds']/run['seconds']:>8.2f}x"
+        print(line)
+
+    if len(results["identities"]) > 0:
+        print(f"{'identity':<16}{'messages':>10}{'us/msg':>10}{'speedup':>9}")
+        for identity, cost in results["identities"].items():
+            line = f"{identity:<16}{cost['messages']:>10}{cost['us_per_msg']:>10.2f}"
+            old = None if baseline is None else baseline["identities"].get(identity)
+            if cost.get("below_noise"):
+                # no speedup from a cost the run to run spread could explain
+                line += f"  below noise ({cost['noise_us_per_msg']:.2f} us/msg)"
+            elif old is not None and cost["us_per_msg"] > 0 and not old.get("below_noise"):
+                line += f"{old['us_per_msg']/cost['us_per_msg']:>8.2f}x"
+            print(line)
+
+
+def setup_parser():
+  """Parse command line arguments.
+
+  """
+  parser = argparse.ArgumentParser(description='Benchmark the ubx parser')
+  parser.add_argument('-i','--input', type=str, default=None,
+                      help="UBX file to benchmark the schema cache with")
+  parser.add_argument('--suite', action="store_true",
+                      help="benchmark the parser on synthetic captures")
+  parser.add_argument('--repeats', type=int, default=None,
+                      help="number of timing runs, 5 for the schema cache and 3 for the suite")
+  parser.add_argument('--sizes', type=str, nargs='+', default=["small", "medium"],
+                      choices=list(BENCH_SIZES), help="capture sizes of the suite")
+  parser.add_argument('--no-identities', action="store_true",
+                      help="skip the per-identity cost runs of the suite")
+  parser.add_argument('--data-dir', type=str, default=DEFAULT_DATA_DIR,
+                      help="directory of the synthetic captures, kept between runs")
+  parser.add_argument('--engine', type=str, default="mmap", choices=["mmap","pyubx2"],
+                      help="parser engine of the suite")
+  parser.add_argument('--save', type=str, default=None, help="write the suite results to a json file")
+  parser.add_argument('--compare', type=str, default=None,
+                      help="json file of an earlier suite run, e.g. on another commit, to compare with")
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  parser = setup_parser()
+  if parser.input is not None:
+    print_schema_results(bench_schema(parser.input, parser.repeats or 5))
+  if parser.suite:
+    results = bench_parser(parser.sizes, parser.repeats or 3, parser.data_dir,
+                           None if parser.no_identities else parser.sizes[0],
+                           engine=parser.engine)
+    baseline = None
+    if parser.compare is not None:
+      with open(parser.compare, 'r') as f:
+        baseline = json.load(f)
+    print_parser_results(results, baseline)
+    if parser.save is not None:
+      with open(parser.save, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,331 @@
+""" Synthetic UBX captures for testing and benchmarking the parser """
+
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from ubx_scanner import (UBX_SYNC_1, UBX_SYNC_2, NAV_SAT_HEADER, NAV_SAT_BLOCK,
+                         NAV_SIG_HEADER, NAV_SIG_BLOCK, RXM_RAWX_HEADER, RXM_RAWX_BLOCK)
+
+GPS_EPOCH = datetime(1980, 1, 6)
+GPS_LEAP_SECONDS = 18
+
+NAV_PVT_PAYLOAD = np.dtype([("iTOW", "<u4"), ("year", "<u2"), ("month", "u1"), ("day", "u1"),
+                            ("hour", "u1"), ("min", "u1"), ("second", "u1"), ("valid", "u1"),
+                            ("tAcc", "<u4"), ("nano", "<i4"), ("fixType", "u1"),
+                            ("flags", "u1"), ("flags2", "u1"), ("numSV", "u1"),
+                            ("lon", "<i4"), ("lat", "<i4"), ("height", "<i4"), ("hMSL", "<i4"),
+                            ("hAcc", "<u4"), ("vAcc", "<u4"), ("velN", "<i4"), ("velE", "<i4"),
+                            ("velD", "<i4"), ("gSpeed", "<i4"), ("headMot", "<i4"),
+                            ("sAcc", "<u4"), ("headAcc", "<u4"), ("pDOP", "<u2"),
+                            ("flags3", "<u2"), ("reserved0", "<u4"), ("headVeh", "<i4"),
+                            ("magDec", "<i2"), ("magAcc", "<u2")])
+
+NAV_TIMEGPS_PAYLOAD = np.dtype([("iTOW", "<u4"), ("fTOW", "<i4"), ("week", "<i2"),
+                                ("leapS", "i1"), ("valid", "u1"), ("tAcc", "<u4")])
+
+# (gnssId, number of satellites, signal ids) of the simulated constellations
+CONSTELLATIONS = [(0, 32, (0, 3)), (2, 36, (0, 6)), (3, 37, (0, 2)), (6, 24, (0, 2))]
+
+
+def ubx_frame(msg_class, msg_id, payload):
+    """Wrap a payload into a UBX frame with its checksum.
+
+    Parameters
+    ----------
+    msg_class : int
+        UBX message class.
+    msg_id : int
+        UBX message id.
+    payload : bytes
+        Message payload.
+
+    Returns
+    -------
+    frame : bytes
+        Complete frame including sync characters and checksum.
+
+    """
+    body = bytes((msg_class, msg_id)) + len(payload).to_bytes(2, "little") + payload
+    sums = np.cumsum(np.frombuffer(body, dtype=np.uint8), dtype=np.int64)
+    return bytes((UBX_SYNC_1, UBX_SYNC_2)) + body + bytes((int(sums[-1]) & 0xFF,
+                                                           int(sums.sum()) & 0xFF))
+
+
+class UbxGenerator():
+
+    def __init__(self, rate=10., n_svs=30, n_sigs=40, n_meas=0, corruption=0.,
+                 seed=0, start_week=2300, start_tow=100.):
+        """Deterministic generator of valid UBX navigation epochs.
+
+        Every epoch holds NAV-TIMEGPS, NAV-PVT, NAV-SAT, NAV-SIG,
+        optionally RXM-RAWX, and ends with NAV-EOE, like a receiver
+        configured for the Bee. Satellites move slowly across the sky
+        and the receiver drives along a straight line, so values change
+        smoothly between epochs. The same arguments always give the
+        same bytes.
+
+        Parameters
+        ----------
+        rate : float
+            Navigation epochs per second.
+        n_svs : int
+            Satellites in each NAV-SAT message.
+        n_sigs : int
+            Signals in each NAV-SIG message.
+        n_meas : int
+            Measurements in each RXM-RAWX message, 0 for no RXM-RAWX.
+        corruption : float
+            Probability of each frame being corrupted by a flipped
+            byte, a truncation or junk bytes in front of it.
+        seed : int
+            Seed of the random number generator.
+        start_week : int
+            GPS week of the first epoch.
+        start_tow : float
+            GPS time of week in seconds of the first epoch.
+
+        """
+        self.rate = rate
+        self.n_svs = n_svs
+        self.n_sigs = n_sigs
+        self.n_meas = n_meas
+        self.corruption = corruption
+        self.rng = np.random.default_rng(seed)
+        self.start_week = start_week
+        self.start_tow = start_tow
+
+        satellites = [(gnss_id, sv_id) for gnss_id, count, sig_ids in CONSTELLATIONS
+                      for sv_id in range(1, count + 1)]
+        chosen = self.rng.choice(len(satellites), size=max(n_svs, 1),
+                                 replace=n_svs > len(satellites))
+        self.gnss_ids = np.array([satellites[i][0] for i in chosen], dtype=np.uint8)
+        self.sv_ids = np.array([satellites[i][1] for i in chosen], dtype=np.uint8)
+        self.elev0 = self.rng.uniform(5, 85, len(chosen))
+        self.azim0 = self.rng.uniform(0, 360, len(chosen))
+        self.cno0 = self.rng.uniform(25, 48, len(chosen))
+
+        self.n_frames = 0
+        self.n_corrupted = 0
+
+    def epochs(self, duration):
+        """Yield the bytes of each epoch.
+
+        Parameters
+        ----------
+        duration : float
+            Seconds of data to generate.
+
+        Yields
+        ------
+        data : bytes
+            Frames of one navigation epoch, including any corruption.
+
+        """
+        for epoch in range(int(round(duration * self.rate))):
+            tow = self.start_tow + epoch / self.rate
+            week = self.start_week + int(tow // 604800)
+            tow = tow % 604800
+            i_tow = int(round(tow * 1E3))
+            frames = [ubx_frame(0x01, 0x20, self.nav_timegps(i_tow, week)),
+                      ubx_frame(0x01, 0x07, self.nav_pvt(i_tow, week, epoch)),
+                      ubx_frame(0x01, 0x35, self.nav_sat(i_tow, epoch)),
+                      ubx_frame(0x01, 0x43, self.nav_sig(i_tow, epoch))]
+            if self.n_meas > 0:
+                frames.append(ubx_frame(0x02, 0x15, self.rxm_rawx(tow, week, epoch)))
+            frames.append(ubx_frame(0x01, 0x61, i_tow.to_bytes(4, "little")))
+            self.n_frames += len(frames)
+            if self.corruption > 0:
+                frames = [self.corrupt(frame) for frame in frames]
+            yield b"".join(frames)
+
+    def write(self, output_path, duration):
+        """Write a capture to a file.
+
+        Parameters
+        ----------
+        output_path : string
+            Path of the ``.ubx`` file.
+        duration : float
+            Seconds of data to generate.
+
+        Returns
+        -------
+        n_bytes : int
+            Size of the file.
+
+        """
+        n_bytes = 0
+        with open(output_path, 'wb', buffering=1024 * 1024) as f:
+            for data in self.epochs(duration):
+                f.write(data)
+                n_bytes += len(data)
+        return n_bytes
+
+    def corrupt(self, frame):
+        if self.rng.random() >= self.corruption:
+            return frame
+        self.n_corrupted += 1
+        kind = self.rng.integers(3)
+        if kind == 0:
+            # flipped byte, the checksum no longer matches
+            data = bytearray(frame)
+            data[self.rng.integers(2, len(data))] ^= 0xFF
+            return bytes(data)
+        if kind == 1:
+            # frame cut short, e.g. by a lost packet
+            return frame[:self.rng.integers(1, len(frame))]
+        # junk in front, sometimes with a false sync pair
+        junk = self.rng.integers(0, 256, self.rng.integers(1, 16), dtype=np.uint8).tobytes()
+        if self.rng.random() < 0.5:
+            junk = bytes((UBX_SYNC_1, UBX_SYNC_2)) + junk
+        return junk + frame
+
+    def nav_timegps(self, i_tow, week):
+        payload = np.zeros(1, dtype=NAV_TIMEGPS_PAYLOAD)
+        payload["iTOW"] = i_tow
+        payload["fTOW"] = self.rng.integers(-500000, 500000)
+        payload["week"] = week
+        payload["leapS"] = GPS_LEAP_SECONDS
+        payload["valid"] = 0x07
+        payload["tAcc"] = self.rng.integers(5, 50)
+        return payload.tobytes()
+
+    def nav_pvt(self, i_tow, week, epoch):
+        t = epoch / self.rate
+        utc = GPS_EPOCH + timedelta(weeks=week, milliseconds=i_tow) \
+              - timedelta(seconds=GPS_LEAP_SECONDS)
+        payload = np.zeros(1, dtype=NAV_PVT_PAYLOAD)
+        payload["iTOW"] = i_tow
+        payload["year"] = utc.year
+        payload["month"] = utc.month
+        payload["day"] = utc.day
+        payload["hour"] = utc.hour
+        payload["min"] = utc.minute
+        payload["second"] = utc.second
+        payload["valid"] = 0x07
+        payload["tAcc"] = self.rng.integers(10, 40)
+        payload["nano"] = utc.microsecond * 1000
+        payload["fixType"] = 3
+        payload["flags"] = 0x01
+        payload["flags2"] = 0xE0
+        payload["numSV"] = min(self.n_svs, 255)
+        # driving north east at about 10 m/s
+        payload["lon"] = int(round((-122.3937 + 6E-5 * t) * 1E7))
+        payload["lat"] = int(round((37.7955 + 6E-5 * t) * 1E7))
+        payload["height"] = 10000 + self.rng.integers(-500, 500)
+        payload["hMSL"] = 40000 + self.rng.integers(-500, 500)
+        payload["hAcc"] = self.rng.integers(500, 3000)
+        payload["vAcc"] = self.rng.integers(800, 5000)
+        payload["velN"] = 6670 + self.rng.integers(-100, 100)
+        payload["velE"] = 5270 + self.rng.integers(-100, 100)
+        payload["velD"] = self.rng.integers(-50, 50)
+        payload["gSpeed"] = 8500 + self.rng.integers(-100, 100)
+        payload["headMot"] = 3830000 + self.rng.integers(-20000, 20000)
+        payload["sAcc"] = self.rng.integers(50, 300)
+        payload["headAcc"] = self.rng.integers(50000, 500000)
+        payload["pDOP"] = self.rng.integers(90, 250)
+        payload["magDec"] = 1300
+        payload["magAcc"] = 50
+        return payload.tobytes()
+
+    def sky(self, epoch):
+        """Elevation, azimuth and C/N0 of each satellite at an epoch."""
+        t = epoch / self.rate
+        elev = np.clip(self.elev0 + 0.002 * t, -90, 90)
+        azim = (self.azim0 + 0.004 * t) % 360
+        cno = np.clip(self.cno0 + self.rng.normal(0, 1, len(self.cno0)), 0, 60)
+        return elev, azim, cno
+
+    def nav_sat(self, i_tow, epoch):
+        elev, azim, cno = self.sky(epoch)
+        header = np.zeros(1, dtype=NAV_SAT_HEADER)
+        header["iTOW"] = i_tow
+        header["version"] = 1
+        header["numSvs"] = self.n_svs
+        blocks = np.zeros(self.n_svs, dtype=NAV_SAT_BLOCK)
+        blocks["gnssId"] = self.gnss_ids[:self.n_svs]
+        blocks["svId"] = self.sv_ids[:self.n_svs]
+        blocks["cno"] = cno[:self.n_svs]
+        blocks["elev"] = elev[:self.n_svs]
+        blocks["azim"] = azim[:self.n_svs]
+        blocks["prRes"] = self.rng.normal(0, 30, self.n_svs).astype(np.int16)
+        used = (cno[:self.n_svs] > 30).astype(np.uint32)
+        # qualityInd 7, svUsed, healthy, ephemeris orbits and ephemeris available
+        blocks["flags"] = 7 | (used << 3) | (1 << 4) | (1 << 8) | (1 << 11)
+        return header.tobytes() + blocks.tobytes()
+
+    def nav_sig(self, i_tow, epoch):
+        elev, azim, cno = self.sky(epoch)
+        satellite = np.arange(self.n_sigs) % len(self.gnss_ids)
+        second_signal = np.arange(self.n_sigs) >= len(self.gnss_ids)
+        header = np.zeros(1, dtype=NAV_SIG_HEADER)
+        header["iTOW"] = i_tow
+        header["numSigs"] = self.n_sigs
+        blocks = np.zeros(self.n_sigs, dtype=NAV_SIG_BLOCK)
+        blocks["gnssId"] = self.gnss_ids[satellite]
+        blocks["svId"] = self.sv_ids[satellite]
+        sig_ids = {gnss_id : sig_ids for gnss_id, count, sig_ids in CONSTELLATIONS}
+        blocks["sigId"] = [sig_ids[gnss_id][int(second)]
+                           for gnss_id, second in zip(blocks["gnssId"].tolist(),
+                                                      second_signal.tolist())]
+        blocks["prRes"] = self.rng.normal(0, 30, self.n_sigs).astype(np.int16)
+        blocks["cno"] = np.clip(cno[satellite] - 3 * second_signal, 0, 60)
+        blocks["qualityInd"] = 7
+        blocks["corrSource"] = 0
+        blocks["ionoModel"] = 2
+        used = (blocks["cno"] > 30).astype(np.uint16)
+        # healthy, pr smoothed, pr/cr/do used
+        blocks["sigFlags"] = 1 | (1 << 2) | (used << 3) | (used << 4) | (used << 5)
+        return header.tobytes() + blocks.tobytes()
+
+    def rxm_rawx(self, tow, week, epoch):
+        elev, azim, cno = self.sky(epoch)
+        satellite = np.arange(self.n_meas) % len(self.gnss_ids)
+        header = np.zeros(1, dtype=RXM_RAWX_HEADER)
+        header["rcvTow"] = tow
+        header["week"] = week
+        header["leapS"] = GPS_LEAP_SECONDS
+        header["numMeas"] = self.n_meas
+        header["recStat"] = 0x01
+        blocks = np.zeros(self.n_meas, dtype=RXM_RAWX_BLOCK)
+        ranges = 2E7 + 1E5 * (90 - elev[satellite])
+        blocks["prMes"] = ranges + self.rng.normal(0, 3, self.n_meas)
+        blocks["cpMes"] = ranges / 0.19029367 + self.rng.normal(0, 0.01, self.n_meas)
+        blocks["doMes"] = self.rng.normal(0, 2000, self.n_meas)
+        blocks["gnssId"] = self.gnss_ids[satellite]
+        blocks["svId"] = self.sv_ids[satellite]
+        blocks["locktime"] = min(epoch * int(1000 / self.rate), 64500)
+        blocks["cno"] = cno[satellite]
+        blocks["prStdev"] = 5
+        blocks["cpStdev"] = 2
+        blocks["doStdev"] = 6
+        blocks["trkStat"] = 0x07
+        return header.tobytes() + blocks.tobytes()
+
+
+def setup_parser():
+  """Parse command line arguments.
+
+  """
+  parser = argparse.ArgumentParser(description='Write a synthetic ubx capture')
+  parser.add_argument('-o','--output', type=str, required=True, help="UBX file to write")
+  parser.add_argument('--duration', type=float, default=60., help="seconds of data")
+  parser.add_argument('--rate', type=float, default=10., help="navigation epochs per second")
+  parser.add_argument('--svs', type=int, default=30, help="satellites per NAV-SAT message")
+  parser.add_argument('--sigs', type=int, default=40, help="signals per NAV-SIG message")
+  parser.add_argument('--meas', type=int, default=0,
+                      help="measurements per RXM-RAWX message, 0 for no RXM-RAWX")
+  parser.add_argument('--corruption', type=float, default=0.,
+                      help="probability of each frame being corrupted")
+  parser.add_argument('--seed', type=int, default=0, help="random seed")
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  parser = setup_parser()
+  generator = UbxGenerator(parser.rate, parser.svs, parser.sigs, parser.meas,
+                           parser.corruption, parser.seed)
+  n_bytes = generator.write(parser.output, parser.duration)
+  print(f"Wrote {generator.n_frames} frames ({generator.n_corrupted} corrupted), "
+        f"{n_bytes/1E6:.2f} MB to {parser.output}")
@@ -0,0 +1,255 @@
+""" Navigation epoch byte-offset index for UBX files """
+
+import os
+import mmap
+import argparse
+
+import numpy as np
+import gnss_lib_py as glp
+
+from ubx_scanner import UbxScanner, ubx_identity
+
+INDEX_SUFFIX = ".idx.npz"
+
+# NAV-TIMEGPS payload
+TIMEGPS_DTYPE = np.dtype([("iTOW", "<u4"), ("fTOW", "<i4"), ("week", "<i2"),
+                          ("leapS", "i1"), ("valid", "u1"), ("tAcc", "<u4")])
+
+
+class UbxEpochIndex():
+
+    def __init__(self, gps_millis, starts, ends, identities, identity_masks,
+                 input_size=0, input_mtime=0.):
+        """Byte offsets, times and message types of each navigation epoch.
+
+        Epoch ``i`` covers the bytes from the end of the previous
+        NAV-EOE frame (or the start of the file) to the end of its own
+        NAV-EOE frame, which is exactly what the parser groups into one
+        epoch. Use ``build`` to create it and ``load_or_build`` to reuse
+        the sidecar file next to the ``.ubx`` file.
+
+        Parameters
+        ----------
+        gps_millis : np.ndarray
+            Epoch time from its last NAV-TIMEGPS message, NaN if that
+            message is missing or its week/time of week aren't valid.
+        starts : np.ndarray
+            Byte offset where each epoch starts.
+        ends : np.ndarray
+            Byte offset just past each epoch's NAV-EOE frame.
+        identities : np.ndarray
+            UBX identities found in the file.
+        identity_masks : np.ndarray
+            Bit-packed (epochs x identities) flags of which identities
+            each epoch contains.
+        input_size : int
+            Size of the indexed file in bytes.
+        input_mtime : float
+            Modification time of the indexed file.
+
+        """
+        self.gps_millis = gps_millis
+        self.starts = starts
+        self.ends = ends
+        self.identities = identities
+        self.identity_masks = identity_masks
+        self.input_size = input_size
+        self.input_mtime = input_mtime
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def build(cls, input_path):
+        """Index a UBX file with a single scan.
+
+        Frame locations come from ``UbxScanner.index`` and the
+        NAV-TIMEGPS payloads are decoded together as one structured
+        array, so no message is decoded one by one.
+
+        Parameters
+        ----------
+        input_path : string
+            Path to UBX file.
+
+        Returns
+        -------
+        index : UbxEpochIndex
+            Index of all complete epochs in the file.
+
+        """
+        stat = os.stat(input_path)
+        starts, ends, msg_classes, msg_ids = UbxScanner(input_path).index()
+
+        eoe = (msg_classes == 0x01) & (msg_ids == 0x61)
+        epoch_ends = ends[eoe]
+        epoch_starts = np.concatenate(([0], epoch_ends[:-1])).astype(np.int64)
+        n_epochs = len(epoch_ends)
+
+        # epoch of each frame, frames after the last NAV-EOE don't belong to one
+        frame_epochs = np.searchsorted(epoch_ends, ends, side="left")
+        in_epoch = frame_epochs < n_epochs
+
+        codes, identity_codes = np.unique((msg_classes.astype(np.int64) << 8) | msg_ids,
+                                          return_inverse=True)
+        identities = np.array([ubx_identity(code >> 8, code & 0xFF) or f"0x{code:04x}"
+                               for code in codes.tolist()])
+        masks = np.zeros((n_epochs, len(codes)), dtype=bool)
+        masks[frame_epochs[in_epoch], identity_codes[in_epoch]] = True
+
+        gps_millis = np.full(n_epochs, np.nan)
+        timegps = (msg_classes == 0x01) & (msg_ids == 0x20) & (ends - starts == 24) & in_epoch
+        if np.any(timegps):
+            with open(input_path, 'rb') as stream:
+                with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    data = np.frombuffer(mm, dtype=np.uint8)
+                    payloads = data[starts[timegps, None] + 6 + np.arange(16)]
+                    del data
+            fields = payloads.view(TIMEGPS_DTYPE).ravel()
+            # the parser uses the last NAV-TIMEGPS of each epoch
+            timegps_epochs = frame_epochs[timegps]
+            last = np.r_[timegps_epochs[1:] != timegps_epochs[:-1], True]
+            fields = fields[last]
+            valid = (fields["valid"] & 0x03) == 0x03
+            gps_tow = fields["iTOW"] * 1E-3 + fields["fTOW"] * 1E-9
+            epoch_millis = np.atleast_1d(glp.tow_to_gps_millis(fields["week"].astype(np.int64),
+                                                               gps_tow))
+            gps_millis[timegps_epochs[last]] = np.where(valid, epoch_millis, np.nan)
+
+        return cls(gps_millis, epoch_starts, epoch_ends.astype(np.int64), identities,
+                   np.packbits(masks, axis=1), stat.st_size, stat.st_mtime)
+
+    @classmethod
+    def load_or_build(cls, input_path, rebuild=False):
+        """Load the sidecar index, rebuilding it if missing or stale.
+
+        Parameters
+        ----------
+        input_path : string
+            Path to UBX file.
+        rebuild : bool
+            If True, always rebuild the index.
+
+        Returns
+        -------
+        index : UbxEpochIndex
+            Index of all complete epochs in the file.
+
+        """
+        index_path = input_path + INDEX_SUFFIX
+        stat = os.stat(input_path)
+        if not rebuild and os.path.exists(index_path):
+            index = cls.load(index_path)
+            if index.input_size == stat.st_size and index.input_mtime == stat.st_mtime:
+                return index
+        index = cls.build(input_path)
+        index.save(index_path)
+        return index
+
+    @classmethod
+    def load(cls, index_path):
+        """Load an index file.
+
+        Parameters
+        ----------
+        index_path : string
+            Path to the ``.idx.npz`` file.
+
+        Returns
+        -------
+        index : UbxEpochIndex
+            Loaded index.
+
+        """
+        with np.load(index_path) as arrays:
+            return cls(arrays["gps_millis"], arrays["starts"], arrays["ends"],
+                       arrays["identities"], arrays["identity_masks"],
+                       int(arrays["input_size"]), float(arrays["input_mtime"]))
+
+    def save(self, index_path):
+        """Save the index as a compressed ``.npz`` file.
+
+        Parameters
+        ----------
+        index_path : string
+            Path to the ``.idx.npz`` file.
+
+        """
+        with open(index_path, 'wb') as f:
+            np.savez_compressed(f, gps_millis=self.gps_millis, starts=self.starts,
+                                ends=self.ends, identities=self.identities,
+                                identity_masks=self.identity_masks,
+                                input_size=self.input_size, input_mtime=self.input_mtime)
+
+    def epoch_identities(self, epoch):
+        """List the identities contained in an epoch.
+
+        Parameters
+        ----------
+        epoch : int
+            Epoch number.
+
+        Returns
+        -------
+        identities : list
+            UBX identities of the epoch's messages.
+
+        """
+        mask = np.unpackbits(self.identity_masks[epoch], count=len(self.identities))
+        return self.identities[mask.astype(bool)].tolist()
+
+    def byte_ranges(self, start_millis=None, end_millis=None):
+        """Find the byte ranges of the epochs within a time range.
+
+        Parameters
+        ----------
+        start_millis : float
+            Earliest epoch gps_millis to include, None for no limit.
+        end_millis : float
+            Latest epoch gps_millis to include, None for no limit.
+
+        Returns
+        -------
+        byte_ranges : list
+            (start, stop) byte offsets of each run of consecutive
+            epochs in the time range.
+
+        """
+        times = self.gps_millis
+        if len(times) > 0 and np.all(np.diff(times[~np.isnan(times)]) >= 0):
+            # times increase through the file, search the sorted times
+            valid = np.flatnonzero(~np.isnan(times))
+            first = np.searchsorted(times[valid], -np.inf if start_millis is None
+                                    else start_millis, side="left")
+            last = np.searchsorted(times[valid], np.inf if end_millis is None
+                                   else end_millis, side="right")
+            if first >= last:
+                return []
+            return [(int(self.starts[valid[first]]), int(self.ends[valid[last - 1]]))]
+
+        selected = ~np.isnan(times)
+        if start_millis is not None:
+            selected &= times >= start_millis
+        if end_millis is not None:
+            selected &= times <= end_millis
+        edges = np.diff(np.r_[0, selected.astype(np.int8), 0])
+        return [(int(self.starts[first]), int(self.ends[last - 1]))
+                for first, last in zip(np.flatnonzero(edges == 1),
+                                       np.flatnonzero(edges == -1))]
+
+
+def setup_parser():
+  """Parse command line arguments.
+
+  """
+  parser = argparse.ArgumentParser(description='Build the epoch index of a ubx file')
+  parser.add_argument('-i','--input', type=str, required=True, help="UBX file to index")
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  parser = setup_parser()
+  index = UbxEpochIndex.load_or_build(parser.input, rebuild=True)
+  valid = index.gps_millis[~np.isnan(index.gps_millis)]
+  print(len(index), "epochs written to", parser.input + INDEX_SUFFIX)
+  if len(valid) > 0:
+    print("gps_millis from", valid[0], "to", valid[-1])
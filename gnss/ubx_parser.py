@@ -4,109 +4,585 @@ __author__ = "D. Knowles"
 __date__ = "02 Oct 2024"
 
 import os
-import csv
+import json
+import time
+import asyncio
+import shutil
+import fnmatch
 import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
 
 import gnss_lib_py as glp
 from pyubx2 import UBXReader, UBX_PROTOCOL
+from pyubx2.ubxtypes_core import UBX_MSGIDS
+from pyubx2.exceptions import UBXMessageError, UBXParseError, UBXTypeError
+
+from ubx_index import UbxEpochIndex
+from ubx_schema import UbxSchemaCache, tabulate_message
+from ubx_scanner import UbxScanner, decode_native, ubx_identity
+from ubx_stream import (ubx_stream_frames, ubx_file_frames, is_compressed, open_ubx_input,
+                        STREAM_QUEUE_SIZE)
+from ubx_writers import (make_writer_pool, ColumnarWriterPool, DEFAULT_BUFFER_SIZE, OUTPUT_FORMATS,
+                         SENSORS_DB_TABLES)
+
+# epoch ranges handed out per worker process, more than one balances load
+CHUNKS_PER_WORKER = 4
+
+# messages always decoded because they define the navigation epochs
+EPOCH_IDENTITIES = ("NAV-TIMEGPS", "NAV-EOE")
+
+# shortest and longest wait in seconds between checks for new bytes in follow mode
+FOLLOW_MIN_POLL = 0.05
+FOLLOW_MAX_POLL = 1.0
 
 
 class UbxParser():
 
-    def __init__(self, input_path):
+    def __init__(self, input_path, engine="mmap", fallback=True,
+                 buffer_size=DEFAULT_BUFFER_SIZE, flush_on_eoe=False,
+                 output_format="csv", workers=1, output_dir=None,
+                 byte_range=None, schema_cache=True, include=None, exclude=None,
+                 follow=False, checkpoint_path=None, idle_timeout=None,
+                 time_range=None, stream_address=None, gpsd=False,
+                 queue_size=STREAM_QUEUE_SIZE, session=None):
         """Parse all UBX messages from file and write to csv.
 
         Parameters
         ----------
         input_path : string
-            Path to UBX file
+            Path to UBX file, None when parsing ``stream_address``.
+            ``.gz``, ``.xz`` and ``.zst`` files are decompressed chunk
+            by chunk while parsing, which doesn't support ``workers``,
+            ``byte_range``, ``follow`` or ``time_range``.
+        engine : string
+            Message source. "mmap" scans a memory map of the file for
+            frames and "pyubx2" reads the file with pyubx2's UBXReader.
+        fallback : bool
+            Only used by the "mmap" engine. If True, messages without
+            a native decoder are decoded with pyubx2, otherwise they
+            are skipped.
+        buffer_size : int
+            Write buffer size in bytes for each open csv file. Larger
+            buffers use more memory but fewer write syscalls.
+        flush_on_eoe : bool
+            If True, flush the csv files at the end of every epoch.
+        output_format : string
+            "csv" writes rows as they are parsed. "parquet", "feather"
+            and "npz" collect each identity into typed columns and
+            write one columnar file per identity at the end. "sqlite"
+            inserts the navigation messages into the tables of the
+            on-device sensors database, see ``SqliteWriterPool``.
+        workers : int
+            Number of processes. If more than one, the file is split
+            at NAV-EOE boundaries and the epoch ranges are parsed in
+            parallel, giving the same output as a single process.
+            Requires the "mmap" engine.
+        output_dir : string
+            Directory for the output files. Defaults to
+            ``results/<input file name>`` in the bee-sensors directory.
+        byte_range : tuple
+            (start, stop) byte offsets to parse. ``start`` must be the
+            start of the file or the end of a NAV-EOE frame. Only
+            supported by the "mmap" engine.
+        schema_cache : bool
+            If True, tabulate messages through a schema compiled once
+            per identity and attribute layout instead of inspecting
+            every attribute name of every message.
+        include : list
+            Identity patterns to write, e.g. ``["NAV-PVT", "NAV-SA*"]``.
+            Defaults to all identities.
+        exclude : list
+            Identity patterns not to write, e.g. ``["RXM-*", "MON-*"]``.
+            Frames of identities that are not written are skipped from
+            their class/id header without decoding the payload, except
+            NAV-TIMEGPS and NAV-EOE which are always decoded to time
+            the epochs.
+        follow : bool
+            If True, keep parsing new bytes as the file grows. Progress
+            is committed to a checkpoint after every batch of new data
+            and a later run resumes from it instead of starting over.
+            Requires the "mmap" engine and csv output.
+        checkpoint_path : string
+            Checkpoint file for follow mode. Defaults to
+            ``checkpoint.json`` in the output directory.
+        idle_timeout : float
+            Stop following the file or stream after this many seconds
+            without new bytes. None follows until interrupted, 0 parses
+            what is new and returns.
+        time_range : tuple
+            (start, end) gps_millis of the epochs to parse, either can
+            be None for no limit. The epoch index sidecar file next to
+            the UBX file is built on first use and then used to read
+            only the bytes of matching epochs. Requires the "mmap"
+            engine and is parsed in a single process.
+        stream_address : tuple
+            (host, port) of gpsd or a TCP server to parse live instead
+            of a file. Frames are reassembled across packets and epochs
+            are written as they complete until the connection closes.
+            Requires the "mmap" engine.
+        gpsd : bool
+            If True, ``stream_address`` is a gpsd port and gpsd is asked
+            to pass the receiver's raw bytes through.
+        queue_size : int
+            Number of socket reads buffered ahead of the parser when
+            parsing a stream.
+        session : string
+            Session written to every row of the "sqlite" output format.
+            Defaults to the input file name without extensions.
 
         """
 
         self.input_path = input_path      # path to UBX input file
+        self.engine = engine              # source of UBX messages
+        self.fallback = fallback          # decode with pyubx2 if no native decoder
+        self.buffer_size = buffer_size    # write buffer size of each csv file
+        self.flush_on_eoe = flush_on_eoe  # flush csv files at the end of every epoch
+        self.output_format = output_format # format of the output files
+        self.workers = workers            # number of parsing processes
+        self.byte_range = byte_range      # (start, stop) byte offsets to parse
+        if output_format == "sqlite" and include is None:
+            # only decode what goes into the sensors database tables
+            include = list(SENSORS_DB_TABLES)
+        self.include = include            # identity patterns to write
+        self.exclude = exclude            # identity patterns not to write
+        self.identity_outputs = dict()    # whether each identity is written
+        self.frame_decodes = dict()       # whether each (class, id) is decoded
+        self.stream_address = stream_address # (host, port) to parse live
+        self.gpsd = gpsd                  # stream_address is a gpsd port
+        self.queue_size = queue_size      # socket reads buffered ahead of the parser
+        if output_dir is None:
+            if self.input_path is None:
+                name = "_".join(str(part) for part in self.stream_address)
+            else:
+                name = os.path.basename(self.input_path).split(".")[0]
+            output_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                      "results",name)
+        self.output_dir = output_dir      # directory of the output files
+        if session is None:
+            session = os.path.basename(os.path.normpath(self.output_dir))
+        self.session = session            # session of the sqlite output rows
+        self.follow = follow              # keep parsing as the file grows
+        if checkpoint_path is None:
+            checkpoint_path = os.path.join(self.output_dir, "checkpoint.json")
+        self.checkpoint_path = checkpoint_path # follow mode checkpoint file
+        self.idle_timeout = idle_timeout  # seconds to follow without new bytes
+        self.time_range = time_range      # (start, end) gps_millis to parse
+        self.writers = None               # open csv writers while parsing
+        self.n_epochs = 0                 # number of epochs written
         self.ubx_csv_files = dict()       # dictionary of csv file paths for each message type
 
+        self.epoch_gps_millis = None      # timestamp of epoch being assembled
+        self.epoch_csv_data = {}          # data of epoch being assembled
+        self.epoch_start = 0              # byte offset just past the last NAV-EOE
+        self.frame_end = 0                # byte offset just past the last frame read
+
         self.conversions = self._ubx_name_conversions()
+        self.schemas = UbxSchemaCache(self.conversions) if schema_cache else None
 
         self.save_ubx_msgs_to_csv()
     
 
+    def ubx_messages(self, start=None, stop=None):
+        """Yield parsed UBX messages from the input file in order.
+
+        Parameters
+        ----------
+        start : int
+            Byte offset to start reading frames from. Defaults to the
+            start of ``byte_range``. Only supported by the "mmap" engine.
+        stop : int
+            Byte offset to stop reading frames at. Defaults to the end
+            of ``byte_range``.
+
+        Yields
+        ------
+        parsed_data : pyubx2.UBXMessage or UbxNativeMessage
+            Parsed UBX message.
+
+        """
+
+        if self.engine == "pyubx2":
+            if self.byte_range is not None or start is not None:
+                raise ValueError("byte_range requires the mmap engine")
+            msgfilter = ""
+            if self.include is not None or self.exclude is not None:
+                msgfilter = tuple(int.from_bytes(msg_key, "big")
+                                  for msg_key, identity in UBX_MSGIDS.items()
+                                  if identity in EPOCH_IDENTITIES
+                                  or self.outputs_identity(identity))
+            with open_ubx_input(self.input_path) as stream:
+                ubr = UBXReader(stream, protfilter=UBX_PROTOCOL, msgfilter=msgfilter)
+                for raw_data, parsed_data in ubr:
+                    if parsed_data is not None:
+                        yield parsed_data
+            return
+
+        if self.engine != "mmap":
+            raise ValueError("Unknown UBX parsing engine: " + str(self.engine))
+
+        if is_compressed(self.input_path):
+            if self.byte_range is not None or start is not None or stop is not None:
+                raise ValueError("byte ranges can't be read from compressed input")
+            yield from self.decode_frames(ubx_file_frames(self.input_path))
+            return
+
+        if self.byte_range is not None:
+            start = self.byte_range[0] if start is None else start
+            stop = self.byte_range[1] if stop is None else stop
+        yield from self.decode_frames(UbxScanner(self.input_path, start=start or 0, stop=stop))
+
+    def decode_frames(self, frames):
+        """Decode scanned frames natively or with pyubx2.
+
+        Parameters
+        ----------
+        frames : iterable
+            (offset, msg_class, msg_id, frame) of each frame in order.
+
+        Yields
+        ------
+        parsed_data : pyubx2.UBXMessage or UbxNativeMessage
+            Parsed UBX message.
+
+        """
+
+        for offset, msg_class, msg_id, frame in frames:
+            self.frame_end = offset + len(frame)
+            decode = self.frame_decodes.get((msg_class, msg_id))
+            if decode is None:
+                identity = ubx_identity(msg_class, msg_id)
+                decode = identity in EPOCH_IDENTITIES or self.outputs_identity(identity)
+                self.frame_decodes[(msg_class, msg_id)] = decode
+            if not decode:
+                # skip the frame by its length without touching the payload
+                frame.release()
+                continue
+
+            parsed_data = decode_native(msg_class, msg_id, frame)
+            if parsed_data is None and self.fallback:
+                try:
+                    parsed_data = UBXReader.parse(bytes(frame))
+                except (UBXMessageError, UBXParseError, UBXTypeError):
+                    # skip undecodable messages like UBXReader does
+                    parsed_data = None
+            frame.release()
+            if parsed_data is not None:
+                yield parsed_data
+
+    def outputs_identity(self, identity):
+        """Check whether an identity is written to the output.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-PVT``. None for unknown messages.
+
+        Returns
+        -------
+        output : bool
+            True if the identity passes the include and exclude patterns.
+
+        """
+        output = self.identity_outputs.get(identity)
+        if output is None:
+            if identity is None:
+                output = self.include is None
+            else:
+                output = ((self.include is None
+                           or any(fnmatch.fnmatchcase(identity, pattern) for pattern in self.include))
+                          and not any(fnmatch.fnmatchcase(identity, pattern)
+                                      for pattern in (self.exclude or [])))
+            self.identity_outputs[identity] = output
+        return output
+
     def save_ubx_msgs_to_csv(self):
+        """Parse the input file and write each epoch to csv.
 
-        with open(self.input_path, 'rb') as stream:
-            ubr = UBXReader(stream, protfilter=UBX_PROTOCOL)
-            
-            epoch_gps_millis = None # timestamp of epoch
-            epoch_csv_data = {}     # data for epoch
+        The per-identity csv files are kept open while parsing and
+        closed even if parsing fails part way through.
 
-            for raw_data, parsed_data in ubr:
+        """
 
-                # if end of epoch, then write all epoch data to CSV if a valid gpstime was found
-                if parsed_data.identity == "NAV-EOE":
-                    # only write if epoch timestamp is valid
-                    if epoch_gps_millis is not None:
-                        self.write_data_to_csv(epoch_csv_data, epoch_gps_millis)
+        if self.stream_address is not None:
+            asyncio.run(self.stream_ubx_msgs())
+            return
 
-                    # reset epoch data
-                    epoch_gps_millis = None
-                    epoch_csv_data = {}
-                    continue
+        if is_compressed(self.input_path) \
+           and (self.follow or self.time_range is not None or self.workers > 1):
+            raise ValueError("compressed input is read as a stream, follow, time_range "
+                             "and workers need an uncompressed file")
+
+        if self.follow:
+            if self.time_range is not None:
+                raise ValueError("time_range can't be used in follow mode")
+            self.follow_ubx_msgs()
+            return
+
+        if self.time_range is not None:
+            self.save_ubx_msgs_in_time_range()
+            return
+
+        if self.workers > 1:
+            self.save_ubx_msgs_parallel()
+            return
 
-                if parsed_data.identity == "NAV-TIMEGPS":
-                    epoch_gps_millis = self.get_gps_millis_from_gpstime(parsed_data)
-
-                # # convert name to CamelCase
-                # new_identity = "Ubx" + "".join([w.capitalize() for w in parsed_data.identity.split("-")])
-                # print(new_identity)
-                msg_metadata = dict()       # message data that's the same for whole message
-                msg_per_sv_data = dict()    # message data that changes for each satellite
-                msg_per_sv_labels = []      # unique labels for per satellite data
-
-                for name, value in parsed_data.__dict__.items():
-                    if name[0] == "_" or "reserved" in name or "CFG" in name:
-                        # ignore private and reserved attributes
-                        continue
-                    if "_" not in name:
-                        # save metadata
-                        if name in self.conversions and self.conversions[name][1] is not None:
-                            value = self.conversions[name][1][value]
-                        msg_metadata[self.conversions.get(name,[name])[0]] = value
+        with make_writer_pool(self.output_format, self.buffer_size,
+                              self.flush_on_eoe, self.session) as self.writers:
+            self.assemble_epochs(self.ubx_messages())
+
+    def save_ubx_msgs_parallel(self):
+        """Parse ranges of epochs in parallel and merge them in order.
+
+        One scan of the file finds the end of every NAV-EOE frame. The
+        file is split at those offsets into byte ranges of similar size
+        that each start with an empty epoch, exactly like the serial
+        parser after a NAV-EOE. Each range is parsed by a worker
+        process into a temporary directory and the per-identity outputs
+        are appended to the final files in file order. A csv file's
+        header comes from the first range that contains the identity.
+
+        """
+
+        if self.engine != "mmap":
+            raise ValueError("parallel parsing requires the mmap engine")
+
+        starts, ends, msg_classes, msg_ids = UbxScanner(self.input_path).index()
+        eoe_ends = ends[(msg_classes == 0x01) & (msg_ids == 0x61)]
+        file_size = os.path.getsize(self.input_path)
+
+        n_chunks = self.workers * CHUNKS_PER_WORKER
+        targets = np.arange(1, n_chunks) * file_size // n_chunks
+        cuts = eoe_ends[np.minimum(np.searchsorted(eoe_ends, targets),
+                                   len(eoe_ends) - 1)] if len(eoe_ends) > 0 else []
+        boundaries = [0] + sorted(set(int(cut) for cut in cuts) - {0, file_size}) + [file_size]
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        parts_dir = tempfile.mkdtemp(prefix=".parts-", dir=self.output_dir)
+        options = dict(engine=self.engine, fallback=self.fallback,
+                       buffer_size=self.buffer_size, output_format=self.output_format,
+                       schema_cache=self.schemas is not None,
+                       include=self.include, exclude=self.exclude, session=self.session)
+        tasks = [(self.input_path, options, (start, stop),
+                  os.path.join(parts_dir, str(chunk)))
+                 for chunk, (start, stop) in enumerate(zip(boundaries[:-1], boundaries[1:]))]
+
+        try:
+            with make_writer_pool(self.output_format, self.buffer_size,
+                                  session=self.session) as self.writers, \
+                 multiprocessing.Pool(min(self.workers, len(tasks))) as pool:
+                for part_files, part_columns, n_epochs in pool.imap(_parse_epoch_range, tasks):
+                    self.n_epochs += n_epochs
+                    if part_columns is not None:
+                        self.writers.merge(part_columns, self.output_dir)
+                        for identity in part_columns.paths:
+                            if identity in self.writers.paths:
+                                self.ubx_csv_files.setdefault(identity, self.writers.paths[identity])
                     else:
-                        temp_name = name.split("_")[0]
-                        temp_name = self.conversions.get(temp_name,[temp_name])[0]
-
-                        # save per-sv data
-                        idx = int(name.split("_")[1])
-                        if idx not in msg_per_sv_data:
-                            msg_per_sv_data[idx] = dict()
-                        
-                        if name.split("_")[0] in self.conversions and self.conversions[name.split("_")[0]][1] is not None:
-                            value = self.conversions[name.split("_")[0]][1][value]
-                        msg_per_sv_data[idx][temp_name] = value
-
-                        # add to unique labels if not already there
-                        if temp_name not in msg_per_sv_labels:
-                            msg_per_sv_labels.append(temp_name)
-
-                # merge metadata and per-sv data
-                csv_data = []
-                labels = list(msg_metadata.keys()) + msg_per_sv_labels
-                
-                if len(msg_per_sv_data) == 0:
-                    # no satellite data, just write metadata
-                    row = list(msg_metadata.values())
-                    csv_data.append(row)
-                else:
-                    for sv_idx in sorted(msg_per_sv_data.keys()):
-                        row = list(msg_metadata.values())
-                        row += [msg_per_sv_data[sv_idx].get(label, None) for label in msg_per_sv_labels]    
-                        csv_data.append(row)
-
-                # add message data to epoch data
-                if parsed_data.identity in epoch_csv_data and parsed_data.identity.split("-")[0] == "NAV":
-                    print("Warning: duplicate",parsed_data.identity,"identity found in epoch")
+                        self._append_csv_parts(part_files)
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+
+    def save_ubx_msgs_in_time_range(self):
+        """Parse only the epochs whose gps_millis is in the time range.
+
+        The epoch index gives the byte range of every run of matching
+        epochs. Each run starts just after a NAV-EOE, so the parser
+        seeks straight to it with an empty epoch, and the cost is
+        proportional to the length of the range.
+
+        """
+
+        if self.engine != "mmap":
+            raise ValueError("time_range requires the mmap engine")
+
+        index = UbxEpochIndex.load_or_build(self.input_path)
+        with make_writer_pool(self.output_format, self.buffer_size,
+                              self.flush_on_eoe, self.session) as self.writers:
+            for start, stop in index.byte_ranges(*self.time_range):
+                self.assemble_epochs(self.ubx_messages(start=start, stop=stop))
+
+    async def stream_ubx_msgs(self):
+        """Parse UBX messages live from gpsd or a TCP byte stream.
+
+        Frames completed by each socket read go through the same epoch
+        assembly and writers as a file, and the output files are
+        flushed whenever the parser has caught up with the stream.
+
+        """
+
+        if self.engine != "mmap":
+            raise ValueError("stream parsing requires the mmap engine")
+
+        host, port = self.stream_address
+        with make_writer_pool(self.output_format, self.buffer_size,
+                              self.flush_on_eoe, self.session) as self.writers:
+            async for frames, caught_up in ubx_stream_frames(host, port, self.gpsd,
+                                                             self.queue_size,
+                                                             self.idle_timeout):
+                self.assemble_epochs(self.decode_frames(frames))
+                if caught_up:
+                    self.writers.flush()
+
+    def follow_ubx_msgs(self):
+        """Parse a growing file incrementally, resuming from a checkpoint.
+
+        Whenever the file has grown, the new frames are read from the
+        end of the last complete frame and the epoch being assembled is
+        carried over to the next batch. After each batch the csv files
+        are flushed and the checkpoint is committed with the offset
+        just past the last NAV-EOE, which starts an empty epoch, and
+        the size of each csv file at that point. Between batches the
+        wait for new bytes backs off from ``FOLLOW_MIN_POLL`` to
+        ``FOLLOW_MAX_POLL`` seconds.
+
+        """
+
+        if self.engine != "mmap" or self.output_format != "csv":
+            raise ValueError("follow mode requires the mmap engine and csv output")
+
+        self.load_checkpoint()
+        scan_offset = self.epoch_start
+        scanned_size = None
+        delay = FOLLOW_MIN_POLL
+        last_data_time = time.monotonic()
+
+        with make_writer_pool(self.output_format, self.buffer_size,
+                              self.flush_on_eoe, self.session) as self.writers:
+            for identity, path in self.ubx_csv_files.items():
+                self.writers.open(identity, path)
+
+            while True:
+                size = os.path.getsize(self.input_path)
+                if size < scan_offset:
+                    raise RuntimeError(self.input_path + " is smaller than the checkpoint offset")
+
+                if size != scanned_size:
+                    self.frame_end = scan_offset
+                    self.assemble_epochs(self.ubx_messages(start=scan_offset))
+                    scan_offset = self.frame_end
+                    scanned_size = size
+                    self.writers.flush()
+                    self.save_checkpoint()
+                    delay = FOLLOW_MIN_POLL
+                    last_data_time = time.monotonic()
+                    continue
+
+                if self.idle_timeout is not None \
+                   and time.monotonic() - last_data_time >= self.idle_timeout:
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, FOLLOW_MAX_POLL)
+
+    def load_checkpoint(self):
+        """Restore follow mode progress from the checkpoint file.
+
+        The csv files are truncated to their committed sizes, dropping
+        rows of epochs written after the checkpoint was saved. Without
+        a usable checkpoint parsing starts from the beginning.
+
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint["input_path"] != os.path.realpath(self.input_path) \
+           or checkpoint["offset"] > os.path.getsize(self.input_path):
+            print("Warning: checkpoint doesn't match",self.input_path,"parsing from start")
+            return
+
+        self.epoch_start = checkpoint["offset"]
+        for identity, (path, size) in checkpoint["files"].items():
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+            self.ubx_csv_files[identity] = path
+
+    def save_checkpoint(self):
+        """Atomically write the follow mode checkpoint file.
+
+        The checkpoint holds the offset just past the last NAV-EOE, so
+        the partial epoch after it is read again on resume, and the
+        path and committed size of each csv file.
+
+        """
+        checkpoint = {
+            "input_path" : os.path.realpath(self.input_path),
+            "offset" : self.epoch_start,
+            "files" : {identity : (path, os.path.getsize(path))
+                       for identity, path in self.ubx_csv_files.items()},
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_path)), exist_ok=True)
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def _append_csv_parts(self, part_files):
+        """Append one epoch range's csv files to the output files.
+
+        Parameters
+        ----------
+        part_files : dict
+            Path of the range's csv file for each identity.
+
+        """
+        for identity, part_path in part_files.items():
+            with open(part_path, 'rb') as src:
+                if identity in self.ubx_csv_files:
+                    src.readline()  # header already written by earlier range
+                    mode = 'ab'
                 else:
-                    epoch_csv_data[parsed_data.identity] = (labels, csv_data)
+                    self.ubx_csv_files[identity] = os.path.join(self.output_dir,
+                                                                os.path.basename(part_path))
+                    mode = 'wb'
+                with open(self.ubx_csv_files[identity], mode) as dst:
+                    shutil.copyfileobj(src, dst, self.buffer_size)
+            os.remove(part_path)
+
+    def assemble_epochs(self, messages):
+        """Group messages into navigation epochs and write them out.
+
+        Parameters
+        ----------
+        messages : iterable
+            Parsed UBX messages in stream order.
+
+        """
+
+        for parsed_data in messages:
+
+            # if end of epoch, then write all epoch data to CSV if a valid gpstime was found
+            if parsed_data.identity == "NAV-EOE":
+                # only write if epoch timestamp is valid
+                if self.epoch_gps_millis is not None:
+                    self.write_data_to_csv(self.epoch_csv_data, self.epoch_gps_millis)
+                    self.writers.end_epoch()
+                    self.n_epochs += 1
+
+                # reset epoch data
+                self.epoch_gps_millis = None
+                self.epoch_csv_data = {}
+                self.epoch_start = self.frame_end
+                continue
+
+            if parsed_data.identity == "NAV-TIMEGPS":
+                self.epoch_gps_millis = self.get_gps_millis_from_gpstime(parsed_data)
+
+            if not self.outputs_identity(parsed_data.identity):
+                continue
+
+            if self.schemas is not None:
+                labels, csv_data = self.schemas.tabulate(parsed_data)
+            else:
+                labels, csv_data = tabulate_message(parsed_data, self.conversions)
+
+            # add message data to epoch data
+            if parsed_data.identity in self.epoch_csv_data and parsed_data.identity.split("-")[0] == "NAV":
+                print("Warning: duplicate",parsed_data.identity,"identity found in epoch")
+            else:
+                self.epoch_csv_data[parsed_data.identity] = (labels, csv_data)
 
     def write_data_to_csv(self, epoch_csv_data, epoch_gps_millis):
         """Write epoch data to csv files.
@@ -117,40 +593,33 @@ class UbxParser():
             Dictionary of parsed UBX messages for an epoch.
         epoch_gps_millis : float
             GPS time in milliseconds for the epoch.
-        ubx_csv_files : dict
-            Dictionary of csv file paths for each message type.
 
         """
         # write to csv
         for identity, (labels, csv_data) in epoch_csv_data.items():
 
             if len(self.ubx_csv_files) == 0 or identity not in self.ubx_csv_files:
-                dir_name = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
-                                        "results",os.path.basename(self.input_path).split(".")[0])
                 if len(self.ubx_csv_files) == 0:
-                    # make results directory if it doesn't exist in root of bee-sensors directory
-                    os.makedirs(dir_name, exist_ok=True)
+                    # make results directory if it doesn't exist
+                    os.makedirs(self.output_dir, exist_ok=True)
 
                 # write labels to csv
                 if identity not in self.ubx_csv_files:
-                    self.ubx_csv_files[identity] = os.path.join(dir_name, identity.replace("-","_") + ".csv")
-                    with open(self.ubx_csv_files[identity], 'w') as f:
-                        writer = csv.writer(f)
-                        if identity.split("-")[0] == "RXM":
-                            # don't use gps_millis (of NAV solution) for RXM messages
-                            writer.writerow(labels)
-                        else:
-                            writer.writerow(["gps_millis"] + labels)
+                    self.ubx_csv_files[identity] = self.writers.output_path(self.output_dir, identity)
+                    if identity.split("-")[0] == "RXM":
+                        # don't use gps_millis (of NAV solution) for RXM messages
+                        self.writers.open(identity, self.ubx_csv_files[identity], labels)
+                    else:
+                        self.writers.open(identity, self.ubx_csv_files[identity], ["gps_millis"] + labels)
 
             if identity.split("-")[0] != "RXM":
                 # add gps_millis to each row of data
                 csv_data = [[epoch_gps_millis] \
                             + row for row in csv_data]
+                labels = ["gps_millis"] + labels
 
             # write data to csv files
-            with open(self.ubx_csv_files[identity], 'a') as f:
-                writer = csv.writer(f)
-                writer.writerows(csv_data)
+            self.writers.writerows(identity, csv_data, labels)
 
     def get_gps_millis_from_gpstime(self, parsed_data):
         """Get gps_millis from gpstime message
@@ -179,7 +648,8 @@ class UbxParser():
 
         return gps_millis
     
-    def _ubx_name_conversions(self):
+    @staticmethod
+    def _ubx_name_conversions():
         """Conver between UBX names and glp/readable names.
 
         Returns
@@ -215,15 +685,105 @@ class UbxParser():
 
 
 
+class _EpochRangeParser(UbxParser):
+    """Parser for one epoch range of the parallel mode.
+
+    Columnar output is kept in memory instead of being written so the
+    parent process can merge it with the other ranges.
+
+    """
+
+    def save_ubx_msgs_to_csv(self):
+        if self.output_format == "csv":
+            super().save_ubx_msgs_to_csv()
+            return
+        # sqlite rows are collected as columns and inserted by the parent
+        self.writers = ColumnarWriterPool("npz" if self.output_format == "sqlite"
+                                          else self.output_format)
+        self.assemble_epochs(self.ubx_messages())
+
+
+def _parse_epoch_range(task):
+    """Parse one byte range of epochs in a worker process.
+
+    Parameters
+    ----------
+    task : tuple
+        (input_path, parser options, byte range, output directory).
+
+    Returns
+    -------
+    ubx_csv_files : dict
+        Path of the range's output file for each identity.
+    columns : ColumnarWriterPool
+        Collected columns for columnar output formats, otherwise None.
+    n_epochs : int
+        Number of epochs written.
+
+    """
+    input_path, options, byte_range, output_dir = task
+    parser = _EpochRangeParser(input_path, output_dir=output_dir,
+                               byte_range=byte_range, **options)
+    if parser.output_format == "csv":
+        return parser.ubx_csv_files, None, parser.n_epochs
+    return parser.ubx_csv_files, parser.writers, parser.n_epochs
+
+
 def setup_parser():
   """Parse command line arguments.
   
   """
   parser = argparse.ArgumentParser(description='Parse ubx file')
   parser.add_argument('-i','--input', type=str, default="", help="UBX file to parse")
+  parser.add_argument('--engine', type=str, default="mmap", choices=["mmap","pyubx2"],
+                      help="read frames from a memory map or with pyubx2's UBXReader")
+  parser.add_argument('--no-fallback', dest="fallback", action="store_false",
+                      help="skip messages the mmap engine can't decode natively instead of using pyubx2")
+  parser.add_argument('--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE,
+                      help="write buffer size in bytes for each csv file")
+  parser.add_argument('--flush-on-eoe', action="store_true",
+                      help="flush csv files at the end of every navigation epoch")
+  parser.add_argument('--format', dest="output_format", type=str, default="csv", choices=OUTPUT_FORMATS,
+                      help="write csv files, one columnar parquet/feather/npz file per message type "
+                           "or the sensors database tables")
+  parser.add_argument('-j','--workers', type=int, default=1,
+                      help="number of processes, 0 uses all cores")
+  parser.add_argument('--include', type=str, nargs='+', default=None,
+                      help="only write these identities, shell-style patterns e.g. NAV-PVT 'NAV-SA*'")
+  parser.add_argument('--exclude', type=str, nargs='+', default=None,
+                      help="don't write these identities, shell-style patterns e.g. 'RXM-*' 'MON-*'")
+  parser.add_argument('-f','--follow', action="store_true",
+                      help="keep parsing as the file grows, resuming from the checkpoint of an earlier run")
+  parser.add_argument('--checkpoint', type=str, default=None,
+                      help="follow mode checkpoint file, defaults to checkpoint.json in the output directory")
+  parser.add_argument('--idle-timeout', type=float, default=None,
+                      help="stop following after this many seconds without new data, 0 parses new data once")
+  parser.add_argument('--start-millis', type=float, default=None,
+                      help="only parse epochs at or after this gps_millis, uses the epoch index")
+  parser.add_argument('--end-millis', type=float, default=None,
+                      help="only parse epochs at or before this gps_millis, uses the epoch index")
+  parser.add_argument('--tcp', type=str, default=None, metavar="HOST:PORT",
+                      help="parse live from a TCP byte stream instead of a file, e.g. 192.168.0.10:9090")
+  parser.add_argument('--gpsd', action="store_true",
+                      help="the --tcp address is a gpsd port, ask it for the raw receiver bytes")
+  parser.add_argument('--queue-size', type=int, default=STREAM_QUEUE_SIZE,
+                      help="socket reads buffered ahead of the parser with --tcp")
+  parser.add_argument('--session', type=str, default=None,
+                      help="session of the rows written with --format sqlite, defaults to the file name")
   return parser.parse_args()
 
 if __name__ == '__main__':
   parser = setup_parser()
-  if parser.input != "":
-    UbxParser(parser.input)
\ No newline at end of file
+  if parser.input != "" or parser.tcp is not None:
+    UbxParser(parser.input if parser.tcp is None else None, engine=parser.engine, fallback=parser.fallback,
+              buffer_size=parser.buffer_size, flush_on_eoe=parser.flush_on_eoe,
+              output_format=parser.output_format,
+              workers=parser.workers if parser.workers > 0 else os.cpu_count(),
+              include=parser.include, exclude=parser.exclude,
+              follow=parser.follow, checkpoint_path=parser.checkpoint,
+              idle_timeout=parser.idle_timeout,
+              time_range=None if parser.start_millis is None and parser.end_millis is None
+                         else (parser.start_millis, parser.end_millis),
+              stream_address=None if parser.tcp is None
+                             else (parser.tcp.rsplit(":", 1)[0], int(parser.tcp.rsplit(":", 1)[1])),
+              gpsd=parser.gpsd, queue_size=parser.queue_size, session=parser.session)
\ No newline at end of file
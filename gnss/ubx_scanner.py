@@ -0,0 +1,504 @@
+""" Zero-copy UBX frame scanner over memory-mapped files """
+
+import os
+import mmap
+import struct
+from functools import lru_cache
+
+import numpy as np
+from pyubx2.ubxtypes_core import UBX_MSGIDS, SCALROUND
+
+UBX_SYNC_1 = 0xB5               # first UBX sync character
+UBX_SYNC_2 = 0x62               # second UBX sync character
+UBX_HEADER_LENGTH = 6           # sync chars, class, id and 2 byte length
+UBX_FRAME_OVERHEAD = 8          # header plus 2 byte checksum
+UBX_MAX_FRAME_LENGTH = 0xFFFF + UBX_FRAME_OVERHEAD
+
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+class UbxScanner():
+
+    def __init__(self, input_path, block_size=DEFAULT_BLOCK_SIZE,
+                 start=0, stop=None):
+        """Iterate over valid UBX frames in a file without copying them.
+
+        The file is memory mapped and scanned in blocks. Within each
+        block the ``0xB5 0x62`` sync pairs are found with a vectorized
+        byte search and every candidate's length and 8-bit Fletcher
+        checksum are validated in bulk from running byte sums.
+        Candidates that fail validation or that start inside an already
+        accepted frame are discarded.
+
+        Parameters
+        ----------
+        input_path : string
+            Path to UBX file
+        block_size : int
+            Number of bytes searched for sync pairs per block.
+        start : int
+            Byte offset to start scanning from. Should be a frame
+            boundary such as the end of a NAV-EOE frame.
+        stop : int
+            Byte offset to stop scanning at. Only frames that start
+            before ``stop`` are returned. Defaults to the end of file.
+
+        """
+
+        self.input_path = input_path
+        self.block_size = block_size
+        self.start = start
+        self.stop = stop
+
+    def __iter__(self):
+        """Yield every valid UBX frame in file order.
+
+        Yields
+        ------
+        offset : int
+            Byte offset of the frame's first sync character in the file.
+        msg_class : int
+            UBX message class.
+        msg_id : int
+            UBX message id.
+        frame : memoryview
+            Complete frame including header and checksum. The view
+            points directly into the memory map and must not be kept
+            around after iteration has finished.
+
+        """
+
+        if os.path.getsize(self.input_path) == 0:
+            return
+
+        with open(self.input_path, 'rb') as stream:
+            mm = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mm)
+            data = np.frombuffer(mm, dtype=np.uint8)
+            try:
+                for starts, ends in self._blocks(data):
+                    for start, end in zip(starts.tolist(), ends.tolist()):
+                        yield start, view[start+2], view[start+3], view[start:end]
+            finally:
+                del data
+                view.release()
+                try:
+                    mm.close()
+                except BufferError:
+                    # a consumer still holds a frame view, the map is
+                    # released once that view is garbage collected
+                    pass
+
+    def index(self):
+        """Locate every valid UBX frame without yielding them one by one.
+
+        Returns
+        -------
+        starts : np.ndarray
+            Byte offsets of the frames' first sync characters.
+        ends : np.ndarray
+            Byte offsets just past the frames' checksums.
+        msg_classes : np.ndarray
+            UBX message class of each frame.
+        msg_ids : np.ndarray
+            UBX message id of each frame.
+
+        """
+
+        empty = np.zeros(0, dtype=np.int64)
+        if os.path.getsize(self.input_path) == 0:
+            return empty, empty, empty.astype(np.uint8), empty.astype(np.uint8)
+
+        with open(self.input_path, 'rb') as stream:
+            with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = np.frombuffer(mm, dtype=np.uint8)
+                blocks = list(self._blocks(data))
+                starts = np.concatenate([empty] + [block[0] for block in blocks])
+                ends = np.concatenate([empty] + [block[1] for block in blocks])
+                msg_classes = data[starts + 2].copy()
+                msg_ids = data[starts + 3].copy()
+                del data
+
+        return starts, ends, msg_classes, msg_ids
+
+    def _blocks(self, data):
+        """Yield the accepted frames of each block in file order.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Entire UBX byte stream as a uint8 array.
+
+        Yields
+        ------
+        starts : np.ndarray
+            Byte offsets of the frames' first sync characters.
+        ends : np.ndarray
+            Byte offsets just past the frames' checksums.
+
+        """
+        stop = len(data) if self.stop is None else min(self.stop, len(data))
+        next_pos = self.start
+        for block_start in range(self.start, stop, self.block_size):
+            starts, ends = scan_frames(data, block_start,
+                                       min(block_start + self.block_size, stop))
+            starts, ends = resolve_frames(starts, ends, next_pos)
+            if len(ends) > 0:
+                next_pos = int(ends[-1])
+            yield starts, ends
+
+
+def scan_frames(data, start, stop):
+    """Find valid UBX frames whose sync pair starts in a byte range.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Entire UBX byte stream as a uint8 array.
+    start : int
+        First byte offset to search for sync pairs.
+    stop : int
+        Byte offset after the last one searched for sync pairs. Frames
+        that begin before ``stop`` but end after it are still returned.
+
+    Returns
+    -------
+    starts : np.ndarray
+        Byte offsets of the valid frames' first sync characters.
+    ends : np.ndarray
+        Byte offsets just past the valid frames' checksums.
+
+    """
+
+    window = data[start:min(stop + UBX_MAX_FRAME_LENGTH, len(data))]
+    n_search = min(stop, len(data)) - start
+
+    sync = np.flatnonzero((window[:-1] == UBX_SYNC_1) & (window[1:] == UBX_SYNC_2))
+    sync = sync[(sync < n_search) & (sync + UBX_HEADER_LENGTH <= len(window))]
+
+    lengths = window[sync + 4].astype(np.int64) | (window[sync + 5].astype(np.int64) << 8)
+    ends = sync + lengths + UBX_FRAME_OVERHEAD
+    complete = ends <= len(window)
+    sync = sync[complete]
+    ends = ends[complete]
+
+    # checksum covers class, id, length and payload: window[sync+2:ends-2]
+    # cumulative sums wrap at 256 which is exactly the Fletcher modulus
+    prefix_a = np.zeros(len(window) + 1, dtype=np.uint8)
+    np.cumsum(window, dtype=np.uint8, out=prefix_a[1:])
+    prefix_b = np.zeros(len(window) + 1, dtype=np.uint8)
+    np.cumsum(prefix_a[1:], dtype=np.uint8, out=prefix_b[1:])
+
+    first = sync + 2
+    last = ends - 2
+    ck_a = (prefix_a[last].astype(np.int64) - prefix_a[first]) & 0xFF
+    ck_b = (prefix_b[last].astype(np.int64) - prefix_b[first]
+            - (last - first) * prefix_a[first].astype(np.int64)) & 0xFF
+    valid = (ck_a == window[last]) & (ck_b == window[last + 1])
+
+    return sync[valid] + start, ends[valid] + start
+
+
+def resolve_frames(starts, ends, next_pos):
+    """Drop frames that start inside an earlier accepted frame.
+
+    A sync pair can appear inside a payload and, rarely, be followed by
+    bytes that pass the checksum. Frames are accepted in order and any
+    frame starting before the end of the previously accepted one is
+    discarded.
+
+    Parameters
+    ----------
+    starts : np.ndarray
+        Byte offsets of valid frames in increasing order.
+    ends : np.ndarray
+        Byte offsets just past each valid frame.
+    next_pos : int
+        End of the last frame accepted before these.
+
+    Returns
+    -------
+    starts : np.ndarray
+        Byte offsets of the accepted frames.
+    ends : np.ndarray
+        Byte offsets just past the accepted frames.
+
+    """
+    if len(starts) == 0:
+        return starts, ends
+    prev_ends = np.maximum.accumulate(np.concatenate(([next_pos], ends[:-1])))
+    if np.all(starts >= prev_ends):
+        # no overlapping frames, the common case
+        return starts, ends
+
+    keep = np.zeros(len(starts), dtype=bool)
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        if start >= next_pos:
+            keep[i] = True
+            next_pos = end
+    return starts[keep], ends[keep]
+
+
+def ubx_identity(msg_class, msg_id):
+    """Look up the identity string for a class/id header.
+
+    Parameters
+    ----------
+    msg_class : int
+        UBX message class.
+    msg_id : int
+        UBX message id.
+
+    Returns
+    -------
+    identity : string
+        UBX identity such as ``NAV-PVT``, or None if unknown.
+
+    """
+    return UBX_MSGIDS.get(bytes((msg_class, msg_id)))
+
+
+class UbxNativeMessage():
+
+    def __init__(self, identity, fields):
+        """Natively decoded UBX message.
+
+        Mirrors the attributes ``pyubx2.UBXMessage`` sets for the same
+        message so both can be tabulated by the same code.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-EOE``.
+        fields : list
+            (name, value) pairs in payload order.
+
+        """
+        self._identity = identity
+        self.__dict__.update(fields)
+
+    @property
+    def identity(self):
+        return self._identity
+
+
+class UbxBlockMessage():
+
+    def __init__(self, identity, fields, blocks):
+        """Natively decoded UBX message with a repeated block section.
+
+        Instead of one ``name_NN`` attribute per block value like
+        ``pyubx2.UBXMessage``, each attribute of the repeated blocks is
+        kept as one NumPy column so the message can be tabulated in bulk
+        with ``ubx_schema.tabulate_blocks``.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-SAT``.
+        fields : list
+            (name, value) pairs of the header in payload order.
+        blocks : list
+            (name, np.ndarray) column of each block attribute in payload
+            order, one value per block.
+
+        """
+        self._identity = identity
+        self.fields = fields
+        self.blocks = blocks
+
+    @property
+    def identity(self):
+        return self._identity
+
+    def __len__(self):
+        return len(self.blocks[0][1]) if len(self.blocks) > 0 else 0
+
+
+def decode_nav_eoe(payload):
+    i_tow, = struct.unpack_from("<I", payload)
+    return UbxNativeMessage("NAV-EOE", [("iTOW", i_tow)])
+
+
+def decode_nav_timegps(payload):
+    i_tow, f_tow, week, leap_s, valid, t_acc = struct.unpack_from("<IihbBI", payload)
+    return UbxNativeMessage("NAV-TIMEGPS", [("iTOW", i_tow),
+                                            ("fTOW", f_tow),
+                                            ("week", week),
+                                            ("leapS", leap_s),
+                                            ("towValid", valid & 0x01),
+                                            ("weekValid", (valid >> 1) & 0x01),
+                                            ("leapSValid", (valid >> 2) & 0x01),
+                                            ("tAcc", t_acc),
+                                            ])
+
+
+# Layouts of messages with repeated blocks, following the pyubx2 definitions
+# so the decoded attributes are the same. Bitfields list (name, bits) from
+# the least significant bit, scaled attributes are (dtype, scale).
+NAV_SAT_HEADER = np.dtype([("iTOW", "<u4"), ("version", "u1"), ("numSvs", "u1"),
+                           ("reserved0", "<u2")])
+NAV_SAT_BLOCK = np.dtype([("gnssId", "u1"), ("svId", "u1"), ("cno", "u1"), ("elev", "i1"),
+                          ("azim", "<i2"), ("prRes", "<i2"), ("flags", "<u4")])
+NAV_SAT_BITFIELDS = {
+    "flags": [("qualityInd", 3), ("svUsed", 1), ("health", 2), ("diffCorr", 1),
+              ("smoothed", 1), ("orbitSource", 3), ("ephAvail", 1), ("almAvail", 1),
+              ("anoAvail", 1), ("aopAvail", 1), ("reserved13", 1), ("sbasCorrUsed", 1),
+              ("rtcmCorrUsed", 1), ("slasCorrUsed", 1), ("spartnCorrUsed", 1),
+              ("prCorrUsed", 1), ("crCorrUsed", 1), ("doCorrUsed", 1), ("clasCorrUsed", 1),
+              ("lppCorrUsed", 1), ("hasCorrUsed", 1)],
+}
+
+NAV_SIG_HEADER = np.dtype([("iTOW", "<u4"), ("version", "u1"), ("numSigs", "u1"),
+                           ("reserved0", "<u2")])
+NAV_SIG_BLOCK = np.dtype([("gnssId", "u1"), ("svId", "u1"), ("sigId", "u1"), ("freqId", "u1"),
+                          ("prRes", "<i2"), ("cno", "u1"), ("qualityInd", "u1"),
+                          ("corrSource", "u1"), ("ionoModel", "u1"), ("sigFlags", "<u2"),
+                          ("reserved1", "<u4")])
+NAV_SIG_BITFIELDS = {
+    "sigFlags": [("health", 2), ("prSmoothed", 1), ("prUsed", 1), ("crUsed", 1),
+                 ("doUsed", 1), ("prCorrUsed", 1), ("crCorrUsed", 1), ("doCorrUsed", 1),
+                 ("authStatus", 1)],
+}
+
+RXM_RAWX_HEADER = np.dtype([("rcvTow", "<f8"), ("week", "<u2"), ("leapS", "i1"),
+                            ("numMeas", "u1"), ("recStat", "u1"), ("reserved1", "V3")])
+RXM_RAWX_BLOCK = np.dtype([("prMes", "<f8"), ("cpMes", "<f8"), ("doMes", "<f4"),
+                           ("gnssId", "u1"), ("svId", "u1"), ("sigId", "u1"), ("freqId", "u1"),
+                           ("locktime", "<u2"), ("cno", "u1"), ("prStdev", "u1"),
+                           ("cpStdev", "u1"), ("doStdev", "u1"), ("trkStat", "u1"),
+                           ("reserved3", "u1")])
+RXM_RAWX_BITFIELDS = {
+    "recStat": [("leapSec", 1), ("clkReset", 1), ("reserved4", 4), ("msgSource", 2)],
+    "prStdev": [("prStd", 4)],
+    "cpStdev": [("cpStd", 4)],
+    "doStdev": [("doStd", 4)],
+    "trkStat": [("prValid", 1), ("cpValid", 1), ("halfCyc", 1), ("subHalfCyc", 1)],
+}
+
+SCALED_ATTRIBUTES = {"prRes": 0.1}
+
+
+def block_decoder(identity, header_dtype, count_name, block_dtype, bitfields):
+    """Make a decoder for a message with repeated blocks.
+
+    The header and all blocks are read with ``np.frombuffer``, so the
+    cost of a message hardly depends on its number of blocks.
+
+    Parameters
+    ----------
+    identity : string
+        UBX identity such as ``NAV-SAT``.
+    header_dtype : np.dtype
+        Layout of the payload before the repeated blocks.
+    count_name : string
+        Header attribute with the number of blocks.
+    block_dtype : np.dtype
+        Layout of one repeated block.
+    bitfields : dict
+        Bitfield attribute name to list of (name, bits) flags.
+
+    Returns
+    -------
+    decode : callable
+        Decodes a payload into a ``UbxBlockMessage``, or returns None
+        if the payload length doesn't match the number of blocks.
+
+    """
+
+    def decode(payload):
+        if len(payload) < header_dtype.itemsize:
+            return None
+        header = np.frombuffer(payload, dtype=header_dtype, count=1)[0]
+        count = int(header[count_name])
+        if len(payload) != header_dtype.itemsize + count * block_dtype.itemsize:
+            return None
+        # copy so no array keeps the memory map exported
+        data = np.frombuffer(payload, dtype=block_dtype, count=count,
+                             offset=header_dtype.itemsize).copy()
+
+        fields = []
+        for name in header_dtype.names:
+            fields.extend(_expand_attribute(name, header[name].item(), bitfields))
+        blocks = []
+        for name in block_dtype.names:
+            blocks.extend(_expand_attribute(name, data[name], bitfields))
+        return UbxBlockMessage(identity, fields, blocks)
+
+    return decode
+
+
+def _expand_attribute(name, values, bitfields):
+    """Yield (name, values) of an attribute or of each flag of a bitfield.
+
+    Reserved attributes and flags are dropped like pyubx2's tabulation
+    ignores them, scaled attributes are converted exactly as pyubx2 does.
+
+    """
+    if name.startswith("reserved"):
+        return
+    if name in bitfields:
+        offset = 0
+        for flag, bits in bitfields[name]:
+            if not flag.startswith("reserved"):
+                yield flag, (values >> offset) & ((1 << bits) - 1)
+            offset += bits
+    elif name in SCALED_ATTRIBUTES:
+        info = np.iinfo(values.dtype)
+        table = _scaled_values(values.dtype.str, SCALED_ATTRIBUTES[name])
+        yield name, table[values.astype(np.int64) - info.min]
+    else:
+        yield name, values
+
+
+@lru_cache(maxsize=None)
+def _scaled_values(dtype, scale):
+    """Scaled value of every integer of a small integer type.
+
+    pyubx2 stores ``round(value * scale, SCALROUND)``, a lookup table of
+    those exact Python floats avoids any rounding difference of a
+    vectorized ``np.round``.
+
+    """
+    info = np.iinfo(np.dtype(dtype))
+    return np.array([round(value * scale, SCALROUND)
+                     for value in range(info.min, info.max + 1)])
+
+
+# native decoders keyed by (class, id) with their exact payload length,
+# None if the decoder checks the length itself
+NATIVE_DECODERS = {
+    (0x01, 0x61): (4, decode_nav_eoe),
+    (0x01, 0x20): (16, decode_nav_timegps),
+    (0x01, 0x35): (None, block_decoder("NAV-SAT", NAV_SAT_HEADER, "numSvs",
+                                       NAV_SAT_BLOCK, NAV_SAT_BITFIELDS)),
+    (0x01, 0x43): (None, block_decoder("NAV-SIG", NAV_SIG_HEADER, "numSigs",
+                                       NAV_SIG_BLOCK, NAV_SIG_BITFIELDS)),
+    (0x02, 0x15): (None, block_decoder("RXM-RAWX", RXM_RAWX_HEADER, "numMeas",
+                                       RXM_RAWX_BLOCK, RXM_RAWX_BITFIELDS)),
+}
+
+
+def decode_native(msg_class, msg_id, frame):
+    """Decode a frame without pyubx2 if a native decoder exists.
+
+    Parameters
+    ----------
+    msg_class : int
+        UBX message class.
+    msg_id : int
+        UBX message id.
+    frame : memoryview
+        Complete UBX frame including header and checksum.
+
+    Returns
+    -------
+    parsed_data : UbxNativeMessage or UbxBlockMessage
+        Decoded message or None if the message can't be decoded natively.
+
+    """
+    decoder = NATIVE_DECODERS.get((msg_class, msg_id))
+    if decoder is None or (decoder[0] is not None
+                           and len(frame) - UBX_FRAME_OVERHEAD != decoder[0]):
+        return None
+    return decoder[1](frame[UBX_HEADER_LENGTH:-2])
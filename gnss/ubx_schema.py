@@ -0,0 +1,242 @@
+""" Conversion of parsed UBX messages into table rows """
+
+import numpy as np
+
+from ubx_scanner import UbxBlockMessage
+
+
+def tabulate_message(parsed_data, conversions):
+    """Convert a parsed message into labels and rows field by field.
+
+    Attributes without an underscore are metadata repeated on every
+    row. Attributes named ``<name>_<index>`` belong to a repeated
+    block, usually one per satellite, and each index becomes a row.
+
+    Parameters
+    ----------
+    parsed_data : pyubx2.UBXMessage or UbxNativeMessage
+        Parsed UBX message.
+    conversions : dict
+        UBX name to (readable name, value conversion dict or None).
+
+    Returns
+    -------
+    labels : list
+        Column labels.
+    csv_data : list
+        Rows of values, one per repeated block or a single row.
+
+    """
+
+    if isinstance(parsed_data, UbxBlockMessage):
+        return tabulate_blocks(parsed_data, conversions)
+
+    msg_metadata = dict()       # message data that's the same for whole message
+    msg_per_sv_data = dict()    # message data that changes for each satellite
+    msg_per_sv_labels = []      # unique labels for per satellite data
+
+    for name, value in parsed_data.__dict__.items():
+        if name[0] == "_" or "reserved" in name or "CFG" in name:
+            # ignore private and reserved attributes
+            continue
+        if "_" not in name:
+            # save metadata
+            if name in conversions and conversions[name][1] is not None:
+                value = conversions[name][1][value]
+            msg_metadata[conversions.get(name,[name])[0]] = value
+        else:
+            temp_name = name.split("_")[0]
+            temp_name = conversions.get(temp_name,[temp_name])[0]
+
+            # save per-sv data
+            idx = int(name.split("_")[1])
+            if idx not in msg_per_sv_data:
+                msg_per_sv_data[idx] = dict()
+
+            if name.split("_")[0] in conversions and conversions[name.split("_")[0]][1] is not None:
+                value = conversions[name.split("_")[0]][1][value]
+            msg_per_sv_data[idx][temp_name] = value
+
+            # add to unique labels if not already there
+            if temp_name not in msg_per_sv_labels:
+                msg_per_sv_labels.append(temp_name)
+
+    # merge metadata and per-sv data
+    csv_data = []
+    labels = list(msg_metadata.keys()) + msg_per_sv_labels
+
+    if len(msg_per_sv_data) == 0:
+        # no satellite data, just write metadata
+        row = list(msg_metadata.values())
+        csv_data.append(row)
+    else:
+        for sv_idx in sorted(msg_per_sv_data.keys()):
+            row = list(msg_metadata.values())
+            row += [msg_per_sv_data[sv_idx].get(label, None) for label in msg_per_sv_labels]
+            csv_data.append(row)
+
+    return labels, csv_data
+
+
+def tabulate_blocks(parsed_data, conversions):
+    """Convert a natively decoded block message into labels and rows.
+
+    Gives the same labels and rows as ``tabulate_message`` on the
+    pyubx2 message, but converts each block attribute as a whole column
+    and builds all rows at once.
+
+    Parameters
+    ----------
+    parsed_data : UbxBlockMessage
+        Message decoded by a native block decoder.
+    conversions : dict
+        UBX name to (readable name, value conversion dict or None).
+
+    Returns
+    -------
+    labels : list
+        Column labels.
+    csv_data : list
+        Rows of values, one per repeated block or a single row.
+
+    """
+
+    metadata = dict()
+    for name, value in parsed_data.fields:
+        label, lookup = conversions.get(name, (name, None))
+        metadata[label] = value if lookup is None else lookup[value]
+
+    if len(parsed_data) == 0:
+        # no satellite data, just write metadata
+        return list(metadata.keys()), [list(metadata.values())]
+
+    columns = dict()
+    for name, values in parsed_data.blocks:
+        label, lookup = conversions.get(name, (name, None))
+        columns[label] = values.tolist() if lookup is None else _lookup_column(values, lookup)
+
+    row = list(metadata.values())
+    return (list(metadata.keys()) + list(columns.keys()),
+            [row + list(values) for values in zip(*columns.values())])
+
+
+def _lookup_column(values, lookup):
+    """Convert a column through a conversion dict, once per unique value."""
+    keys, inverse = np.unique(values, return_inverse=True)
+    converted = np.empty(len(keys), dtype=object)
+    converted[:] = [lookup[key] for key in keys.tolist()]
+    return converted[inverse].tolist()
+
+
+class UbxSchema():
+
+    def __init__(self, names, conversions):
+        """Compiled plan to tabulate messages with one attribute layout.
+
+        All string handling of ``tabulate_message`` is done once here:
+        which attributes are skipped, which are metadata, the repeated
+        block index of the others, the output labels and the value
+        conversion of each attribute.
+
+        Parameters
+        ----------
+        names : tuple
+            Attribute names of the message in order.
+        conversions : dict
+            UBX name to (readable name, value conversion dict or None).
+
+        """
+
+        metadata = dict()       # label -> (attribute, conversion)
+        per_sv = dict()         # block index -> {label -> (attribute, conversion)}
+        per_sv_labels = []      # unique labels for per satellite data
+
+        for name in names:
+            if name[0] == "_" or "reserved" in name or "CFG" in name:
+                continue
+            base = name.split("_")[0]
+            label, lookup = conversions.get(base, (base, None))
+            convert = lookup.__getitem__ if lookup is not None else None
+            if "_" not in name:
+                metadata[label] = (name, convert)
+            else:
+                per_sv.setdefault(int(name.split("_")[1]), dict())[label] = (name, convert)
+                if label not in per_sv_labels:
+                    per_sv_labels.append(label)
+
+        self.labels = list(metadata.keys()) + per_sv_labels
+        self.metadata = list(metadata.values())
+        self.rows = [[per_sv[idx].get(label, (None, None)) for label in per_sv_labels]
+                     for idx in sorted(per_sv.keys())]
+
+    def tabulate(self, fields):
+        """Convert one message's attributes into rows.
+
+        Parameters
+        ----------
+        fields : dict
+            Attribute values of the message, ``parsed_data.__dict__``.
+
+        Returns
+        -------
+        labels : list
+            Column labels, shared by all messages with this layout.
+        csv_data : list
+            Rows of values, one per repeated block or a single row.
+
+        """
+        metadata = [fields[name] if convert is None else convert(fields[name])
+                    for name, convert in self.metadata]
+        if len(self.rows) == 0:
+            return self.labels, [metadata]
+        return self.labels, [metadata + [None if name is None
+                                         else fields[name] if convert is None
+                                         else convert(fields[name])
+                                         for name, convert in row]
+                             for row in self.rows]
+
+
+class UbxSchemaCache():
+
+    def __init__(self, conversions):
+        """Tabulate messages through per-layout compiled schemas.
+
+        A schema is compiled the first time an identity is seen with a
+        given attribute layout, e.g. NAV-SAT with a certain number of
+        satellites, and reused for every later message with that
+        layout.
+
+        Parameters
+        ----------
+        conversions : dict
+            UBX name to (readable name, value conversion dict or None).
+
+        """
+        self.conversions = conversions
+        self.schemas = dict()   # (identity, attribute names) -> UbxSchema
+
+    def tabulate(self, parsed_data):
+        """Convert a parsed message into labels and rows.
+
+        Parameters
+        ----------
+        parsed_data : pyubx2.UBXMessage or UbxNativeMessage
+            Parsed UBX message.
+
+        Returns
+        -------
+        labels : list
+            Column labels.
+        csv_data : list
+            Rows of values, one per repeated block or a single row.
+
+        """
+        if isinstance(parsed_data, UbxBlockMessage):
+            return tabulate_blocks(parsed_data, self.conversions)
+        fields = parsed_data.__dict__
+        key = (parsed_data.identity, tuple(fields))
+        schema = self.schemas.get(key)
+        if schema is None:
+            schema = UbxSchema(key[1], self.conversions)
+            self.schemas[key] = schema
+        return schema.tabulate(fields)
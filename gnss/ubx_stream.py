@@ -0,0 +1,389 @@
+""" UBX frames from byte streams: gpsd, TCP and compressed files """
+
+import gzip
+import lzma
+import time
+import asyncio
+import argparse
+
+import numpy as np
+
+from ubx_index import UbxEpochIndex
+from ubx_scanner import (UBX_SYNC_1, UBX_SYNC_2, UBX_HEADER_LENGTH, UBX_FRAME_OVERHEAD,
+                         scan_frames, resolve_frames)
+
+# bytes requested per socket read
+STREAM_READ_SIZE = 64 * 1024
+
+# socket reads buffered between the connection and the parser
+STREAM_QUEUE_SIZE = 64
+
+# asks gpsd to pass the receiver's bytes through unchanged
+GPSD_WATCH_RAW = b'?WATCH={"enable":true,"raw":2};\n'
+
+# decompressed bytes scanned at a time from compressed files
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+COMPRESSED_EXTENSIONS = (".gz", ".xz", ".zst")
+
+
+class UbxStreamScanner():
+
+    def __init__(self, exact=False):
+        """Reassemble UBX frames from a byte stream received in pieces.
+
+        Each piece is appended to the bytes left over from the last one
+        and scanned with the same vectorized search as ``UbxScanner``.
+        By default complete valid frames are returned right away and
+        only the bytes from the first sync pair after them whose frame
+        isn't complete yet are kept, which bounds the leftover to one
+        maximum length frame. A false sync pair in junk bytes therefore
+        never delays later frames.
+
+        Parameters
+        ----------
+        exact : bool
+            If True, frames after a sync pair whose frame isn't complete
+            yet are held back until it is, so a longer frame starting
+            there wins like it does when scanning a whole file. The
+            frames are then exactly those of ``UbxScanner`` on the same
+            bytes, once ``finish`` has been called at the end.
+
+        """
+        self.exact = exact
+        self.buffer = b""       # bytes not yet returned or dropped
+        self.offset = 0         # stream offset of the first buffered byte
+
+    def feed(self, data):
+        """Add received bytes and return the frames they complete.
+
+        Parameters
+        ----------
+        data : bytes
+            Next bytes of the stream.
+
+        Returns
+        -------
+        frames : list
+            (offset, msg_class, msg_id, frame) of each complete frame in
+            stream order, ``frame`` being a memoryview of the frame
+            bytes and ``offset`` its position in the stream.
+
+        """
+        buffer = self.buffer + data
+        array = np.frombuffer(buffer, dtype=np.uint8)
+
+        starts, ends = scan_frames(array, 0, len(array))
+        starts, ends = resolve_frames(starts, ends, 0)
+
+        if self.exact:
+            # first incomplete sync pair that isn't inside an accepted frame
+            pending = pending_frame_starts(array)
+            frame = np.searchsorted(starts, pending, side="left") - 1
+            covered = (frame >= 0) & (ends[np.maximum(frame, 0)] > pending) \
+                      if len(starts) > 0 else np.zeros(len(pending), dtype=bool)
+            hold = int(pending[~covered][0]) if np.any(~covered) else len(array)
+            returned = starts < hold
+            starts, ends = starts[returned], ends[returned]
+
+        frames = self._frames(buffer, starts, ends)
+        last_end = int(ends[-1]) if len(ends) > 0 else 0
+        if self.exact:
+            cut = max(last_end, hold)
+        else:
+            pending = pending_frame_starts(array[last_end:])
+            cut = last_end + (int(pending[0]) if len(pending) > 0 else len(array) - last_end)
+        self.buffer = buffer[cut:]
+        self.offset += cut
+        return frames
+
+    def finish(self):
+        """Return the frames held back at the end of the stream.
+
+        Returns
+        -------
+        frames : list
+            (offset, msg_class, msg_id, frame) of the remaining complete
+            frames, see ``feed``.
+
+        """
+        buffer = self.buffer
+        array = np.frombuffer(buffer, dtype=np.uint8)
+        starts, ends = resolve_frames(*scan_frames(array, 0, len(array)), 0)
+        frames = self._frames(buffer, starts, ends)
+        self.offset += len(buffer)
+        self.buffer = b""
+        return frames
+
+    def _frames(self, buffer, starts, ends):
+        view = memoryview(buffer)
+        return [(self.offset + start, buffer[start+2], buffer[start+3], view[start:end])
+                for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def pending_frame_starts(data):
+    """Find the sync pairs whose frames aren't complete yet.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Buffered stream bytes as a uint8 array.
+
+    Returns
+    -------
+    starts : np.ndarray
+        Offsets of the sync pairs that need more bytes to be validated,
+        including a first sync character at the very end.
+
+    """
+    n = len(data)
+    sync = np.flatnonzero((data[:-1] == UBX_SYNC_1) & (data[1:] == UBX_SYNC_2))
+    header = sync + UBX_HEADER_LENGTH <= n
+    lengths = np.zeros(len(sync), dtype=np.int64)
+    lengths[header] = data[sync[header] + 4].astype(np.int64) \
+                      | (data[sync[header] + 5].astype(np.int64) << 8)
+    pending = sync[~header | (sync + lengths + UBX_FRAME_OVERHEAD > n)]
+    if n > 0 and data[-1] == UBX_SYNC_1:
+        pending = np.append(pending, n - 1)
+    return pending
+
+
+def is_compressed(input_path):
+    """Check whether a file is read through a decompressor.
+
+    Parameters
+    ----------
+    input_path : string
+        Path to UBX file.
+
+    Returns
+    -------
+    compressed : bool
+        True for ``.gz``, ``.xz`` and ``.zst`` files.
+
+    """
+    return input_path.endswith(COMPRESSED_EXTENSIONS)
+
+
+def open_ubx_input(input_path):
+    """Open a UBX file for reading, decompressing it on the fly.
+
+    ``.zst`` files require the ``zstandard`` package.
+
+    Parameters
+    ----------
+    input_path : string
+        Path to a ``.ubx`` file, optionally compressed.
+
+    Returns
+    -------
+    stream : file object
+        Binary stream of the uncompressed bytes.
+
+    """
+    if input_path.endswith(".gz"):
+        return gzip.open(input_path, 'rb')
+    if input_path.endswith(".xz"):
+        return lzma.open(input_path, 'rb')
+    if input_path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError as error:
+            raise ImportError("zstandard is required for .zst input, "
+                              "install it with: pip install zstandard") from error
+        return zstandard.ZstdDecompressor().stream_reader(open(input_path, 'rb'),
+                                                          closefd=True)
+    return open(input_path, 'rb')
+
+
+def ubx_file_frames(input_path, chunk_size=DECOMPRESS_CHUNK_SIZE):
+    """Yield the frames of a compressed UBX file chunk by chunk.
+
+    Only one chunk of decompressed bytes plus the start of a frame
+    that straddles it are in memory at a time. The frames are the same
+    as ``UbxScanner`` gives for the uncompressed file.
+
+    Parameters
+    ----------
+    input_path : string
+        Path to a ``.ubx`` file, optionally compressed.
+    chunk_size : int
+        Decompressed bytes scanned at a time.
+
+    Yields
+    ------
+    offset : int
+        Offset of the frame in the uncompressed bytes.
+    msg_class : int
+        UBX message class.
+    msg_id : int
+        UBX message id.
+    frame : memoryview
+        Complete frame including header and checksum.
+
+    """
+    scanner = UbxStreamScanner(exact=True)
+    with open_ubx_input(input_path) as stream:
+        for data in iter(lambda: stream.read(chunk_size), b""):
+            yield from scanner.feed(data)
+    yield from scanner.finish()
+
+
+async def ubx_stream_frames(host, port, gpsd=False, queue_size=STREAM_QUEUE_SIZE,
+                            idle_timeout=None):
+    """Receive UBX frames from a TCP connection.
+
+    One task reads the socket into a queue of at most ``queue_size``
+    reads. When the consumer falls behind the reads stop and TCP flow
+    control holds the sender back, so memory use stays bounded.
+
+    Parameters
+    ----------
+    host : string
+        Address of gpsd or the TCP server.
+    port : int
+        Port of gpsd or the TCP server.
+    gpsd : bool
+        If True, ask gpsd to pass the raw receiver bytes through.
+    queue_size : int
+        Number of socket reads buffered ahead of the consumer.
+    idle_timeout : float
+        Stop after this many seconds without new bytes. None waits
+        until the connection is closed. A failed read, e.g. a reset
+        connection, is raised here either way.
+
+    Yields
+    ------
+    frames : list
+        (offset, msg_class, msg_id, frame) of the frames completed by
+        each read, see ``UbxStreamScanner.feed``.
+    caught_up : bool
+        True if no more received bytes are waiting.
+
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    if gpsd:
+        writer.write(GPSD_WATCH_RAW)
+        await writer.drain()
+
+    queue = asyncio.Queue(maxsize=queue_size)
+
+    async def receive():
+        try:
+            while True:
+                data = await reader.read(STREAM_READ_SIZE)
+                await queue.put(data)
+                if len(data) == 0:
+                    return
+        except Exception as error:
+            # handed to the consumer, which would otherwise wait forever
+            await queue.put(error)
+            raise
+
+    receiver = asyncio.create_task(receive())
+    scanner = UbxStreamScanner()
+    try:
+        while True:
+            try:
+                data = await asyncio.wait_for(queue.get(), idle_timeout)
+            except asyncio.TimeoutError:
+                if receiver.done() and not receiver.cancelled() \
+                   and receiver.exception() is not None:
+                    raise receiver.exception()
+                break
+            if isinstance(data, Exception):
+                raise data
+            if len(data) == 0:
+                break
+            yield scanner.feed(data), queue.empty()
+    finally:
+        receiver.cancel()
+        writer.close()
+
+
+async def serve_ubx_file(input_path, host="127.0.0.1", port=9090, speed=1.,
+                         packet_size=1024, save_index=False):
+    """Replay a recorded UBX file to every client that connects.
+
+    Epochs are sent at their recorded GPS times divided by ``speed``,
+    measured from the first epoch, and split into packets of
+    ``packet_size`` bytes so frames straddle packet boundaries like
+    they do on a real connection. The connection is closed at the end
+    of the file.
+
+    Parameters
+    ----------
+    input_path : string
+        Path to UBX file.
+    host : string
+        Address to listen on.
+    port : int
+        Port to listen on.
+    speed : float
+        Replay speed relative to real time, 0 sends as fast as possible.
+    packet_size : int
+        Bytes per packet.
+    save_index : bool
+        If True, reuse or write the epoch index sidecar file next to the
+        input, otherwise the index is built in memory and the input's
+        directory isn't written to.
+
+    """
+    if save_index:
+        index = UbxEpochIndex.load_or_build(input_path)
+    else:
+        index = UbxEpochIndex.build(input_path)
+    with open(input_path, 'rb') as f:
+        data = f.read()
+    # epoch byte ranges, bytes after the last NAV-EOE are sent at the end
+    bounds = np.concatenate((index.ends, [len(data)])).tolist()
+    times = np.concatenate((index.gps_millis, [np.nan]))
+    valid = np.flatnonzero(~np.isnan(times))
+    first_millis = times[valid[0]] if len(valid) > 0 else 0.
+
+    async def replay(reader, writer):
+        start_time = time.monotonic()
+        start = 0
+        try:
+            for stop, epoch_millis in zip(bounds, times.tolist()):
+                if speed > 0 and not np.isnan(epoch_millis):
+                    delay = start_time + (epoch_millis - first_millis) * 1E-3 / speed \
+                            - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                for packet_start in range(start, stop, packet_size):
+                    writer.write(data[packet_start:min(packet_start + packet_size, stop)])
+                    await writer.drain()
+                start = stop
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(replay, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def setup_parser():
+  """Parse command line arguments.
+
+  """
+  parser = argparse.ArgumentParser(description='Replay a ubx file over TCP like a gpsd raw port')
+  parser.add_argument('-i','--input', type=str, required=True, help="UBX file to replay")
+  parser.add_argument('--host', type=str, default="127.0.0.1", help="address to listen on")
+  parser.add_argument('--port', type=int, default=9090, help="port to listen on")
+  parser.add_argument('--speed', type=float, default=1.,
+                      help="replay speed relative to real time, 0 is as fast as possible")
+  parser.add_argument('--packet-size', type=int, default=1024, help="bytes per packet")
+  parser.add_argument('--save-index', action="store_true",
+                      help="reuse or write the epoch index sidecar file next to the input")
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  parser = setup_parser()
+  try:
+    asyncio.run(serve_ubx_file(parser.input, parser.host, parser.port,
+                               parser.speed, parser.packet_size, parser.save_index))
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,745 @@
+""" Output writers for parsed UBX messages """
+
+import os
+import csv
+import math
+import sqlite3
+from array import array
+from operator import itemgetter
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import gnss_lib_py as glp
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+OUTPUT_FORMATS = ["csv", "parquet", "feather", "npz", "sqlite"]
+
+# database written by the sqlite output format
+SENSORS_DB_NAME = "sensors.db"
+
+# rows buffered across all tables before they are inserted and committed
+SQLITE_BATCH_ROWS = 50000
+
+GPS_EPOCH_0 = datetime(1980, 1, 6, tzinfo=timezone.utc)
+MILLIS_PER_HOUR = 3600 * 1000
+
+# on-device sensors database table and columns of each UBX identity. Each
+# column is (name, type, source, divisor) where source is the parsed label,
+# or a tuple of one bit flag labels packed LSB first, and values are divided
+# by divisor to convert units, e.g. mm to m
+SENSORS_DB_TABLES = {
+    "NAV-PVT" : ("nav_pvt", [
+        ("itow_ms", "INTEGER", "iTOW", None),
+        ("year", "INTEGER", "year", None),
+        ("month", "INTEGER", "month", None),
+        ("day", "INTEGER", "day", None),
+        ("hour", "INTEGER", "hour", None),
+        ("min", "INTEGER", "min", None),
+        ("sec", "INTEGER", "second", None),
+        ("valid_date", "INTEGER", "validDate", None),
+        ("valid_time", "INTEGER", "validTime", None),
+        ("fully_resolved", "INTEGER", "fullyResolved", None),
+        ("valid_mag", "INTEGER", "validMag", None),
+        ("t_acc_ns", "INTEGER", "tAcc", None),
+        ("nano_ns", "INTEGER", "nano", None),
+        ("fix_type", "INTEGER", "fixType", None),
+        ("gnss_fix_ok", "INTEGER", "gnssFixOk", None),
+        ("diff_soln", "INTEGER", "diffSoln", None),
+        ("psm_state", "INTEGER", "psmState", None),
+        ("head_veh_valid", "INTEGER", "headVehValid", None),
+        ("carr_soln", "INTEGER", "carrSoln", None),
+        ("num_sv", "INTEGER", "numSV", None),
+        ("lon_deg", "REAL", "lon_rx_deg", None),
+        ("lat_deg", "REAL", "lat_rx_deg", None),
+        ("height_m", "REAL", "alt_rx_m", 1000),
+        ("hmsl_m", "REAL", "hMSL", 1000),
+        ("h_acc_m", "REAL", "hAcc", 1000),
+        ("v_acc_m", "REAL", "vAcc", 1000),
+        ("vel_n_m_s", "REAL", "velN", 1000),
+        ("vel_e_m_s", "REAL", "velE", 1000),
+        ("vel_d_m_s", "REAL", "velD", 1000),
+        ("g_speed_m_s", "REAL", "gSpeed", 1000),
+        ("head_mot_deg", "REAL", "headMot", None),
+        ("s_acc_m_s", "REAL", "sAcc", 1000),
+        ("head_acc_deg", "REAL", "headAcc", None),
+        ("pdop", "REAL", "pDOP", None),
+        ("invalid_llh", "INTEGER", "invalidLlh", None),
+        ("last_correction_age", "INTEGER", "lastCorrectionAge", None),
+        ("auth_time", "INTEGER", "authTime", None),
+        ("nma_fix_status", "INTEGER", "nmaFixStatus", None),
+        ("head_veh_deg", "REAL", "headVeh", None),
+        ("mag_dec_deg", "REAL", "magDec", None),
+        ("mag_acc_deg", "REAL", "magAcc", None),
+    ]),
+    "NAV-STATUS" : ("nav_status", [
+        ("itow_ms", "INTEGER", "iTOW", None),
+        ("gps_fix", "INTEGER", "gpsFix", None),
+        ("gps_fix_ok", "INTEGER", "gpsFixOk", None),
+        ("diff_soln", "INTEGER", "diffSoln", None),
+        ("wkn_set", "INTEGER", "wknSet", None),
+        ("tow_set", "INTEGER", "towSet", None),
+        ("diff_corr", "INTEGER", "diffCorr", None),
+        ("carr_soln_valid", "INTEGER", "carrSolnValid", None),
+        ("map_matching", "INTEGER", "mapMatching", None),
+        ("psm_state", "INTEGER", "psmState", None),
+        ("spoof_det_state", "INTEGER", "spoofDetState", None),
+        ("carr_soln", "INTEGER", "carrSoln", None),
+        ("ttff", "INTEGER", "ttff", None),
+        ("msss", "INTEGER", "msss", None),
+    ]),
+    "NAV-TIMEGPS" : ("nav_timegps", [
+        ("itow_ms", "INTEGER", "iTOW", None),
+        ("ftow_ns", "INTEGER", "fTOW", None),
+        ("week", "INTEGER", "week", None),
+        ("leap_s", "INTEGER", "leapS", None),
+        ("valid", "INTEGER", ("towValid", "weekValid", "leapSValid"), None),
+        ("t_acc_ns", "INTEGER", "tAcc", None),
+    ]),
+    "NAV-COV" : ("nav_cov", [
+        ("itow_ms", "INTEGER", "iTOW", None),
+        ("version", "INTEGER", "version", None),
+        ("posCovValid", "INTEGER", "posCovValid", None),
+        ("velCovValid", "INTEGER", "velCovValid", None),
+        ("pos_cov_n_n", "REAL", "posCovNN", None),
+        ("pos_cov_n_e", "REAL", "posCovNE", None),
+        ("pos_cov_n_d", "REAL", "posCovND", None),
+        ("pos_cov_e_e", "REAL", "posCovEE", None),
+        ("pos_cov_e_d", "REAL", "posCovED", None),
+        ("pos_cov_d_d", "REAL", "posCovDD", None),
+        ("vel_cov_n_n", "REAL", "velCovNN", None),
+        ("vel_cov_n_e", "REAL", "velCovNE", None),
+        ("vel_cov_n_d", "REAL", "velCovND", None),
+        ("vel_cov_e_e", "REAL", "velCovEE", None),
+        ("vel_cov_e_d", "REAL", "velCovED", None),
+        ("vel_cov_d_d", "REAL", "velCovDD", None),
+    ]),
+    "NAV-POSECEF" : ("nav_posecef", [
+        ("itow_ms", "INTEGER", "iTOW", None),
+        ("ecef_x", "REAL", "ecefX", 100),
+        ("ecef_y", "REAL", "ecefY", 100),
+        ("ecef_z", "REAL", "ecefZ", 100),
+        ("p_acc", "REAL", "pAcc", 100),
+    ]),
+    "NAV-VELECEF" : ("nav_velecef", [
+        ("itow_ms", "INTEGER", "iTOW", None),
+        ("ecef_vx", "REAL", "ecefVX", 100),
+        ("ecef_vy", "REAL", "ecefVY", 100),
+        ("ecef_vz", "REAL", "ecefVZ", 100),
+        ("s_acc", "REAL", "sAcc", 100),
+    ]),
+}
+
+
+def make_writer_pool(output_format="csv", buffer_size=DEFAULT_BUFFER_SIZE,
+                     flush_on_eoe=False, session=""):
+    """Create the writer pool for an output format.
+
+    Parameters
+    ----------
+    output_format : string
+        One of ``OUTPUT_FORMATS``.
+    buffer_size : int
+        Write buffer size in bytes for each csv file.
+    flush_on_eoe : bool
+        If True, flush csv files at the end of every epoch.
+    session : string
+        Session written to every row of the sqlite output format.
+
+    Returns
+    -------
+    writers : CsvWriterPool, ColumnarWriterPool or SqliteWriterPool
+        Writer pool with one output file or table per identity.
+
+    """
+    if output_format == "csv":
+        return CsvWriterPool(buffer_size, flush_on_eoe)
+    if output_format == "sqlite":
+        return SqliteWriterPool(session)
+    if output_format in OUTPUT_FORMATS:
+        return ColumnarWriterPool(output_format)
+    raise ValueError("Unknown output format: " + str(output_format))
+
+
+class CsvWriterPool():
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, flush_on_eoe=False):
+        """Keep one open, buffered csv writer per UBX identity.
+
+        Files stay open for the lifetime of the pool so each row costs
+        a buffer append instead of an open/close pair. Data reaches the
+        disk whenever a file's buffer fills up, on every end of epoch if
+        ``flush_on_eoe`` is set and when the pool is closed.
+
+        Parameters
+        ----------
+        buffer_size : int
+            Size of each file's write buffer in bytes.
+        flush_on_eoe : bool
+            If True, flush all files at the end of every epoch.
+
+        """
+
+        self.extension = ".csv"
+        self.buffer_size = buffer_size
+        self.flush_on_eoe = flush_on_eoe
+        self.files = dict()      # open file handle for each identity
+        self.writers = dict()    # csv writer for each identity
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def output_path(self, output_dir, identity):
+        """Path of an identity's output file in an output directory."""
+        return os.path.join(output_dir, identity.replace("-","_") + self.extension)
+
+    def open(self, identity, path, header=None):
+        """Open a csv file for an identity.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-PVT``.
+        path : string
+            Path of the csv file.
+        header : list
+            Column labels. If given the file is truncated and the labels
+            written as the first row, otherwise rows are appended.
+
+        """
+        f = open(path, 'w' if header is not None else 'a',
+                 buffering=self.buffer_size)
+        self.files[identity] = f
+        self.writers[identity] = csv.writer(f)
+        if header is not None:
+            self.writers[identity].writerow(header)
+
+    def writerows(self, identity, rows, labels=None):
+        """Write rows to an identity's csv file.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-PVT``.
+        rows : list
+            List of rows, each a list of values.
+        labels : list
+            Unused, the csv columns are fixed by the header.
+
+        """
+        self.writers[identity].writerows(rows)
+
+    def end_epoch(self):
+        """Signal the end of a navigation epoch."""
+        if self.flush_on_eoe:
+            self.flush()
+
+    def flush(self):
+        """Flush all open files."""
+        for f in self.files.values():
+            f.flush()
+
+    def close(self):
+        """Flush and close all open files."""
+        for f in self.files.values():
+            f.close()
+        self.files = dict()
+        self.writers = dict()
+
+
+class ColumnarWriterPool():
+
+    def __init__(self, output_format="parquet"):
+        """Accumulate each UBX identity into typed columns.
+
+        Every identity's rows are appended to one ``ColumnBuffer`` per
+        column while parsing. When the pool is closed, each identity is
+        written as a single Parquet, Feather or NumPy ``.npz`` file with
+        the same column names as the csv output. Parquet and Feather
+        require ``pyarrow``.
+
+        Parameters
+        ----------
+        output_format : string
+            One of "parquet", "feather" or "npz".
+
+        """
+
+        if output_format not in ("parquet", "feather", "npz"):
+            raise ValueError("Unknown columnar format: " + str(output_format))
+
+        self.output_format = output_format
+        self.extension = "." + output_format
+        self.paths = dict()      # output file path for each identity
+        self.columns = dict()    # column buffers for each identity
+        self.n_rows = dict()     # number of rows for each identity
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def output_path(self, output_dir, identity):
+        """Path of an identity's output file in an output directory."""
+        return os.path.join(output_dir, identity.replace("-","_") + self.extension)
+
+    def open(self, identity, path, header=None):
+        """Start collecting columns for an identity.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-PVT``.
+        path : string
+            Path of the output file.
+        header : list
+            Initial column labels.
+
+        """
+        self.paths[identity] = path
+        self.columns[identity] = {label : ColumnBuffer()
+                                  for label in (header or [])}
+        self.n_rows[identity] = 0
+
+    def writerows(self, identity, rows, labels=None):
+        """Append rows to an identity's columns.
+
+        Columns that first appear in a later epoch are back-filled with
+        missing values and columns absent from ``labels`` are padded.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-PVT``.
+        rows : list
+            List of rows, each a list of values.
+        labels : list
+            Column label of each value in the rows. Defaults to the
+            columns known so far.
+
+        """
+        columns = self.columns[identity]
+        if labels is None:
+            labels = list(columns.keys())
+        for label in labels:
+            if label not in columns:
+                columns[label] = ColumnBuffer(self.n_rows[identity])
+        buffers = [columns[label] for label in labels]
+        label_set = set(labels)
+        padded = [columns[label] for label in columns if label not in label_set]
+
+        for row in rows:
+            for buffer, value in zip(buffers, row):
+                buffer.append(value)
+            for buffer in buffers[len(row):] + padded:
+                buffer.append(None)
+        self.n_rows[identity] += len(rows)
+
+    def merge(self, other, output_dir):
+        """Append the columns collected by another pool.
+
+        Used to join the epoch ranges parsed by separate processes. The
+        result is the same as if this pool had received the other
+        pool's rows directly.
+
+        Parameters
+        ----------
+        other : ColumnarWriterPool
+            Pool holding the columns of the following epochs.
+        output_dir : string
+            Directory of the output files for identities new to this pool.
+
+        """
+        for identity, path in other.paths.items():
+            if identity not in self.paths:
+                self.open(identity, os.path.join(output_dir, os.path.basename(path)))
+            columns = self.columns[identity]
+            for label, buffer in other.columns[identity].items():
+                if label not in columns:
+                    columns[label] = ColumnBuffer(self.n_rows[identity])
+                columns[label].extend(buffer)
+            for label, buffer in columns.items():
+                if label not in other.columns[identity]:
+                    buffer.extend(ColumnBuffer(other.n_rows[identity]))
+            self.n_rows[identity] += other.n_rows[identity]
+
+    def end_epoch(self):
+        """Signal the end of a navigation epoch."""
+
+    def flush(self):
+        """Columns are only written when the pool is closed."""
+
+    def close(self):
+        """Write one columnar file per identity and free the columns."""
+        for identity, path in self.paths.items():
+            columns = {label : buffer.to_numpy()
+                       for label, buffer in self.columns[identity].items()}
+            if self.output_format == "npz":
+                np.savez_compressed(path, **columns)
+            else:
+                _write_arrow(path, columns, self.output_format)
+        self.paths = dict()
+        self.columns = dict()
+        self.n_rows = dict()
+
+
+class SqliteWriterPool():
+
+    def __init__(self, session=""):
+        """Insert UBX identities into the on-device sensors database tables.
+
+        The identities of ``SENSORS_DB_TABLES`` are written to the
+        ``nav_pvt``, ``nav_status``, ... tables of one ``sensors.db``
+        file in the output directory, with the column names and units
+        that ``replay/replay.py`` and the QA tools read. Rows are
+        buffered and inserted with ``executemany``, committing every
+        ``SQLITE_BATCH_ROWS`` rows, with WAL journaling and
+        synchronous=OFF while loading. Other identities are ignored.
+
+        Parameters
+        ----------
+        session : string
+            Session of every written row. Rows of the same session
+            already in the database are replaced.
+
+        """
+
+        self.extension = ".db"
+        self.session = session
+        self.connection = None   # open database connection
+        self.paths = dict()      # database path for each identity
+        self.inserts = dict()    # insert statement for each identity
+        self.plans = dict()      # row conversion for each (identity, labels)
+        self.pending = dict()    # rows not inserted yet for each identity
+        self.n_pending = 0       # number of rows not inserted yet
+        self.system_time = (None, None)  # last (gps_millis, system_time)
+        self.leap_seconds = (None, None) # (GPS hour, leap seconds throughout it)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def output_path(self, output_dir, identity):
+        """Path of the database in an output directory."""
+        return os.path.join(output_dir, SENSORS_DB_NAME)
+
+    def open(self, identity, path, header=None):
+        """Create an identity's table if it doesn't exist.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-PVT``.
+        path : string
+            Path of the database file.
+        header : list
+            If given, rows of this session already in the table are
+            deleted, otherwise rows are appended.
+
+        """
+        if identity not in SENSORS_DB_TABLES:
+            return
+        if self.connection is None:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=OFF")
+        table, columns = SENSORS_DB_TABLES[identity]
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                                "(id INTEGER PRIMARY KEY, "
+                                "system_time TEXT, session TEXT, "
+                                + ", ".join(f"{name} {kind}" for name, kind, _, _ in columns)
+                                + ")")
+        if header is not None:
+            self.connection.execute(f"DELETE FROM {table} WHERE session = ?", (self.session,))
+        names = ["system_time", "session"] + [name for name, _, _, _ in columns]
+        self.inserts[identity] = (f"INSERT INTO {table} ({', '.join(names)}) "
+                                  f"VALUES ({', '.join('?' * len(names))})")
+        self.paths[identity] = path
+        self.pending[identity] = []
+
+    def writerows(self, identity, rows, labels=None):
+        """Convert rows to table columns and buffer them for insertion.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-PVT``.
+        rows : list
+            List of rows, each a list of values.
+        labels : list
+            Column label of each value in the rows, starting with
+            ``gps_millis``.
+
+        """
+        if identity not in self.inserts:
+            return
+        key = (identity, tuple(labels))
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = self.plans[key] = self._row_plan(identity, labels)
+        get, scaled, packed = plan
+        pending = self.pending[identity]
+        prefix = (self.session,)
+        for row in rows:
+            values = list(get(row))
+            for column, divisor in scaled:
+                if values[column] is not None:
+                    values[column] /= divisor
+            for column, bits in packed:
+                value = 0
+                for position, shift in bits:
+                    value |= row[position] << shift
+                values[column] = value
+            pending.append((self._system_time(row[0]),) + prefix + tuple(values))
+        self.n_pending += len(rows)
+        if self.n_pending >= SQLITE_BATCH_ROWS:
+            self.flush()
+
+    def _row_plan(self, identity, labels):
+        """Plan the conversion from parsed rows to table values.
+
+        Parameters
+        ----------
+        identity : string
+            UBX identity such as ``NAV-PVT``.
+        labels : list
+            Column label of each value in the parsed rows.
+
+        Returns
+        -------
+        get : operator.itemgetter
+            Takes a parsed row and returns a tuple of the table columns'
+            source values, None if missing.
+        scaled : list
+            (column, divisor) of the columns to convert.
+        packed : list
+            (column, [(row position, bit shift), ...]) of the columns
+            packed from one bit flags.
+
+        """
+        positions = {label : position for position, label in enumerate(labels)}
+        missing = len(labels)
+        sources = []
+        scaled = []
+        packed = []
+        for column, (name, kind, source, divisor) in enumerate(SENSORS_DB_TABLES[identity][1]):
+            if isinstance(source, tuple):
+                packed.append((column, [(positions[label], shift)
+                                        for shift, label in enumerate(source)
+                                        if label in positions]))
+                sources.append(0)   # replaced by the packed value
+                continue
+            sources.append(positions.get(source, missing))
+            if divisor is not None and source in positions:
+                scaled.append((column, divisor))
+        get = itemgetter(*sources)
+        return (lambda row: get(row + [None])) if missing in sources else get, scaled, packed
+
+    def _system_time(self, gps_millis):
+        """UTC time string of an epoch, like the device's system_time.
+
+        Same as ``glp.gps_millis_to_datetime``, up to the rounding of
+        the microseconds, but the leap seconds are looked up once per
+        hour unless they change within that hour.
+
+        """
+        if gps_millis == self.system_time[0]:
+            return self.system_time[1]
+        gps_millis = float(gps_millis)    # also a 0-d array from gnss_lib_py
+        gps_time = GPS_EPOCH_0 + timedelta(milliseconds=gps_millis)
+        hour = int(gps_millis // MILLIS_PER_HOUR)
+        if hour != self.leap_seconds[0]:
+            first = glp.get_leap_seconds(hour * MILLIS_PER_HOUR)
+            last = glp.get_leap_seconds((hour + 1) * MILLIS_PER_HOUR - 1)
+            self.leap_seconds = (hour, first if first == last else None)
+        leap_seconds = self.leap_seconds[1]
+        if leap_seconds is None:
+            leap_seconds = glp.get_leap_seconds(gps_time)
+        system_time = (gps_time - timedelta(seconds=leap_seconds)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        self.system_time = (gps_millis, system_time)
+        return system_time
+
+    def merge(self, other, output_dir):
+        """Insert the columns collected by another pool.
+
+        Used to join the epoch ranges parsed by separate processes,
+        which collect their rows in a ``ColumnarWriterPool``.
+
+        Parameters
+        ----------
+        other : ColumnarWriterPool
+            Pool holding the columns of the following epochs.
+        output_dir : string
+            Directory of the database.
+
+        """
+        for identity in other.paths:
+            if identity not in SENSORS_DB_TABLES:
+                continue
+            labels = list(other.columns[identity].keys())
+            if identity not in self.paths:
+                self.open(identity, self.output_path(output_dir, identity), labels)
+            columns = [buffer.to_numpy().tolist() for buffer in other.columns[identity].values()]
+            self.writerows(identity, list(zip(*columns)), labels)
+
+    def end_epoch(self):
+        """Signal the end of a navigation epoch."""
+
+    def flush(self):
+        """Insert the buffered rows and commit them."""
+        if self.connection is None:
+            return
+        for identity, rows in self.pending.items():
+            if len(rows) > 0:
+                self.connection.executemany(self.inserts[identity], rows)
+                rows.clear()
+        self.connection.commit()
+        self.n_pending = 0
+
+    def close(self):
+        """Insert the remaining rows and close the database."""
+        if self.connection is None:
+            return
+        self.flush()
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.connection.close()
+        self.connection = None
+        self.inserts = dict()
+        self.pending = dict()
+
+
+class ColumnBuffer():
+
+    def __init__(self, n_missing=0):
+        """Growable column that keeps the narrowest type seen so far.
+
+        Values are stored in an int64 array until a float or missing
+        value arrives, then in a float64 array with NaN for missing
+        values, and in a plain list once any other type (bytes, str,
+        lists) or an integer outside int64 shows up.
+
+        Parameters
+        ----------
+        n_missing : int
+            Number of missing values the column starts with.
+
+        """
+        self.values = None           # array('q'), array('d') or list
+        self.n_missing = n_missing   # leading missing values before first value
+
+    def __len__(self):
+        return self.n_missing if self.values is None else len(self.values)
+
+    def append(self, value):
+        if isinstance(value, (np.generic, np.ndarray)) and np.ndim(value) == 0:
+            # e.g. gps_millis from gnss_lib_py
+            value = value.item()
+        values = self.values
+        if values is None:
+            if value is None:
+                self.n_missing += 1
+                return
+            if self.n_missing == 0 and isinstance(value, int):
+                values = array('q')
+            elif isinstance(value, (int, float)):
+                values = array('d', [math.nan] * self.n_missing)
+            else:
+                values = [None] * self.n_missing
+            self.values = values
+
+        if type(values) is list:
+            values.append(value)
+        elif value is None:
+            if values.typecode == 'q':
+                values = self._promote(array('d', values))
+            values.append(math.nan)
+        elif isinstance(value, float) and values.typecode == 'q':
+            self._promote(array('d', values)).append(value)
+        else:
+            try:
+                values.append(value)
+            except (TypeError, OverflowError):
+                self._promote(list(values)).append(value)
+
+    def extend(self, other):
+        """Append all values of another column.
+
+        Parameters
+        ----------
+        other : ColumnBuffer
+            Column whose values are appended in order.
+
+        """
+        if other.values is None:
+            for _ in range(other.n_missing):
+                self.append(None)
+        elif (self.values is not None and type(self.values) is not list
+              and type(other.values) is not list
+              and self.values.typecode == other.values.typecode):
+            self.values.extend(other.values)
+        else:
+            for value in other.values:
+                self.append(value)
+
+    def _promote(self, values):
+        self.values = values
+        return values
+
+    def to_numpy(self):
+        """Convert the column to a NumPy array.
+
+        Returns
+        -------
+        column : np.ndarray
+            int64 or float64 array for numeric columns, a fixed width
+            bytes or string array if all values share that type (missing
+            values become empty) and an object array otherwise.
+
+        """
+        if self.values is None:
+            return np.full(self.n_missing, np.nan)
+        if type(self.values) is not list:
+            return np.frombuffer(self.values, dtype=np.int64 if self.values.typecode == 'q'
+                                 else np.float64)
+        for kind in (bytes, str):
+            if all(value is None or isinstance(value, kind) for value in self.values):
+                return np.array([kind() if value is None else value
+                                 for value in self.values])
+        column = np.empty(len(self.values), dtype=object)
+        column[:] = self.values
+        return column
+
+
+def _write_arrow(path, columns, output_format):
+    """Write columns as a Parquet or Feather file with pyarrow.
+
+    Parameters
+    ----------
+    path : string
+        Path of the output file.
+    columns : dict
+        NumPy array for each column label.
+    output_format : string
+        Either "parquet" or "feather".
+
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("pyarrow is required for " + output_format
+                          + " output, install it with: pip install pyarrow") from error
+
+    table = pa.table({label : pa.array(column.tolist() if column.dtype == object else column)
+                      for label, column in columns.items()})
+    if output_format == "parquet":
+        pyarrow.parquet.write_table(table, path)
+    else:
+        pyarrow.feather.write_feather(table, path)
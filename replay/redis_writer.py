@@ -0,0 +1,325 @@
+"""Pooled, pipelined writer for pushing replay messages to Redis lists.
+
+Test against a local redis-server:
+    redis-server redis.conf
+    python3 redis_writer.py --count 100000
+    python3 redis_writer.py --count 100000 --engine async
+
+"""
+
+import time
+import asyncio
+import argparse
+import threading
+
+import redis
+import redis.asyncio
+
+# messages buffered before they are sent as one pipeline
+REDIS_BATCH_SIZE = 1000
+
+# seconds a buffered message waits at most before the buffer is sent
+REDIS_FLUSH_INTERVAL = 0.01
+
+# messages queued per list (or group of lists) before pushes wait for Redis
+ASYNC_QUEUE_SIZE = 10000
+
+# lists consumers read together, pushed over one connection to keep their
+# relative order: the navigation messages of an epoch follow their NavPvt
+ASYNC_ORDERED_LISTS = [["NavPvt", "NavCov", "NavPosecef", "NavStatus", "NavTimegps", "NavVelecef",
+                        "NavDop", "NavSat", "MonRf"]]
+
+# buckets of the pipeline latency histogram, bucket i counts latencies
+# below 2**i microseconds (and from 2**(i-1) on)
+LATENCY_BUCKETS = 32
+
+
+def latency_bucket(seconds):
+    """Returns the latency histogram bucket of a round trip."""
+    return min(int(seconds * 1e6).bit_length(), LATENCY_BUCKETS - 1)
+
+
+class ListCounters():
+    def __init__(self):
+        """Messages and bytes pushed per list, readable from another thread.
+
+        Counting a list that's already known only updates dict values.
+        Adding a list, which resizes the dicts, holds the lock that
+        snapshot() copies them under, so a metrics thread never sees a
+        dict change size.
+        """
+        self.messages = {}
+        self.bytes = {}
+        self.lock = threading.Lock()
+
+    def add(self, list_name, n_messages, n_bytes):
+        """Counts messages and their payload bytes for a list."""
+        try:
+            self.messages[list_name] += n_messages
+            self.bytes[list_name] += n_bytes
+        except KeyError:
+            with self.lock:
+                self.messages[list_name] = n_messages
+                self.bytes[list_name] = n_bytes
+
+    def snapshot(self):
+        """Returns copies of the messages and bytes per list."""
+        with self.lock:
+            return dict(self.messages), dict(self.bytes)
+
+
+class RedisWriter():
+    def __init__(self, host="127.0.0.1", port=6379, batch_size=REDIS_BATCH_SIZE,
+                 flush_interval=REDIS_FLUSH_INTERVAL):
+        """Pushes messages to Redis lists over one pooled connection.
+
+        Messages are buffered and sent as a single pipeline once
+        batch_size messages are waiting or the oldest has waited
+        flush_interval seconds. Consecutive messages to the same list
+        become one multi-value LPUSH, and the commands keep the order
+        the messages were pushed in, so every list ends up exactly as
+        with one LPUSH per message.
+        """
+        self.pool = redis.ConnectionPool(host=host, port=port)
+        self.client = redis.Redis(connection_pool=self.pool)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.pending = []           # [list name, payloads] runs in push order
+        self.n_pending = 0
+        self.first_pending_time = None
+        self.n_messages = 0         # messages sent
+        self.n_bytes = 0            # payload bytes sent
+        self.n_flushes = 0          # pipelines sent
+        self.push_seconds = 0.      # time spent sending pipelines
+        self.start_time = None      # time of the first push
+        self.list_counts = ListCounters()               # messages and bytes sent per list
+        self.latency_counts = [0] * LATENCY_BUCKETS     # pipeline round trips per latency bucket
+
+    def push(self, list_name, payload):
+        """Buffers a message for a list, sending the buffer when it's due."""
+        if len(self.pending) > 0 and self.pending[-1][0] == list_name:
+            self.pending[-1][1].append(payload)
+        else:
+            self.pending.append([list_name, [payload]])
+        self.n_pending += 1
+        if self.n_pending == 1:
+            self.first_pending_time = time.monotonic()
+            if self.start_time is None:
+                self.start_time = self.first_pending_time
+        if self.n_pending >= self.batch_size \
+           or time.monotonic() - self.first_pending_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Sends all buffered messages as one pipeline."""
+        if self.n_pending == 0:
+            return
+        start_time = time.monotonic()
+        pipeline = self.client.pipeline(transaction=False)
+        for list_name, payloads in self.pending:
+            pipeline.lpush(list_name, *payloads)
+            n_bytes = sum(len(payload) for payload in payloads)
+            self.n_bytes += n_bytes
+            self.list_counts.add(list_name, len(payloads), n_bytes)
+        pipeline.execute()
+        seconds = time.monotonic() - start_time
+        self.push_seconds += seconds
+        self.latency_counts[latency_bucket(seconds)] += 1
+        self.n_messages += self.n_pending
+        self.n_flushes += 1
+        self.pending = []
+        self.n_pending = 0
+
+    def messages_per_second(self):
+        """Returns the messages sent per second since the first push."""
+        if self.start_time is None:
+            return 0.
+        return self.n_messages / max(time.monotonic() - self.start_time, 1e-9)
+
+    def report(self):
+        """Prints the messages, bytes and pipelines sent and the achieved rate."""
+        print(f"Pushed {self.n_messages} messages ({self.n_bytes / 1e6:.1f} MB) in {self.n_flushes} pipelines: "
+              f"{self.messages_per_second():.0f} msgs/s, {self.push_seconds:.2f} s in Redis round trips")
+
+    def close(self):
+        """Sends the remaining messages and disconnects."""
+        self.flush()
+        self.pool.disconnect()
+
+
+class AsyncRedisWriter():
+    def __init__(self, host="127.0.0.1", port=6379, batch_size=REDIS_BATCH_SIZE,
+                 queue_size=ASYNC_QUEUE_SIZE, ordered_lists=ASYNC_ORDERED_LISTS):
+        """Pushes messages to Redis lists from asyncio, one connection per list.
+
+        Each list has a bounded queue drained by its own task over its
+        own connection, so a slow push to one list doesn't hold up the
+        others. A drain task sends whatever is queued, up to batch_size
+        messages, as one pipeline of multi-value LPUSHes. Messages to a
+        list keep their push order, and the lists of a group in
+        ordered_lists share one queue and connection so the order
+        between them is kept too. Pushing waits while a queue is full.
+        If a drain task fails, e.g. on a Redis error, the next push to
+        its lane and close() raise its error.
+        """
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.groups = {list_name: tuple(group) for group in ordered_lists for list_name in group}
+
+        self.lanes = {}             # list name or group -> (queue, drain task)
+        self.n_messages = 0         # messages sent
+        self.n_bytes = 0            # payload bytes sent
+        self.n_flushes = 0          # pipelines sent
+        self.push_seconds = 0.      # time drain tasks spent waiting on Redis, summed over lists
+        self.start_time = None      # time of the first push
+        self.end_time = None        # time the last message was sent
+        self.list_counts = ListCounters()               # messages and bytes sent per list
+        self.latency_counts = [0] * LATENCY_BUCKETS     # pipeline round trips per latency bucket
+
+    async def push(self, list_name, payload):
+        """Queues a message for a list, waiting while its queue is full."""
+        lane = self.lanes.get(list_name)
+        if lane is None:
+            lane = self.open_lane(list_name)
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        await self.put(lane, (list_name, payload))
+
+    async def put(self, lane, item):
+        """Queues an item for a lane's drain task, raising the task's error if it has stopped."""
+        queue, task = lane
+        if task.done():
+            raise drain_error(task)
+        if not queue.full():
+            queue.put_nowait(item)
+            return
+        put = asyncio.ensure_future(queue.put(item))
+        await asyncio.wait([put, task], return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            raise drain_error(task)
+
+    def open_lane(self, list_name):
+        """Starts the queue, connection and drain task of a list or its group."""
+        key = self.groups.get(list_name, list_name)
+        if key not in self.lanes:
+            queue = asyncio.Queue(maxsize=self.queue_size)
+            client = redis.asyncio.Redis(host=self.host, port=self.port)
+            self.lanes[key] = (queue, asyncio.create_task(self.drain(queue, client)))
+        self.lanes[list_name] = self.lanes[key]
+        return self.lanes[key]
+
+    async def drain(self, queue, client):
+        """Sends the queued messages of a lane until it gets None."""
+        try:
+            while True:
+                messages = [await queue.get()]
+                while len(messages) < self.batch_size and not queue.empty():
+                    messages.append(queue.get_nowait())
+                done = messages[-1] is None
+                if done:
+                    messages.pop()
+                if len(messages) > 0:
+                    await self.send(client, messages)
+                if done:
+                    return
+        finally:
+            await client.aclose()
+
+    async def send(self, client, messages):
+        """Sends messages as one pipeline, consecutive ones to a list in one LPUSH."""
+        start_time = time.monotonic()
+        runs = [[messages[0][0], []]]
+        for list_name, payload in messages:
+            if list_name != runs[-1][0]:
+                runs.append([list_name, []])
+            runs[-1][1].append(payload)
+        pipeline = client.pipeline(transaction=False)
+        for list_name, payloads in runs:
+            pipeline.lpush(list_name, *payloads)
+            n_bytes = sum(len(payload) for payload in payloads)
+            self.n_bytes += n_bytes
+            self.list_counts.add(list_name, len(payloads), n_bytes)
+        await pipeline.execute()
+        self.end_time = time.monotonic()
+        self.push_seconds += self.end_time - start_time
+        self.latency_counts[latency_bucket(self.end_time - start_time)] += 1
+        self.n_messages += len(messages)
+        self.n_flushes += 1
+
+    async def close(self):
+        """Sends the queued messages and closes the connections, raising the first drain task error."""
+        lanes = set(self.lanes.values())
+        self.lanes = {}
+        for lane in lanes:
+            try:
+                await self.put(lane, None)
+            except Exception:
+                pass    # raised below
+        results = await asyncio.gather(*[task for queue, task in lanes], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if len(errors) > 0:
+            raise errors[0]
+
+    def messages_per_second(self):
+        """Returns the messages sent per second between the first push and the last send."""
+        if self.start_time is None or self.end_time is None:
+            return 0.
+        return self.n_messages / max(self.end_time - self.start_time, 1e-9)
+
+    def report(self):
+        """Prints the messages, bytes and pipelines sent and the achieved rate."""
+        print(f"Pushed {self.n_messages} messages ({self.n_bytes / 1e6:.1f} MB) in {self.n_flushes} pipelines: "
+              f"{self.messages_per_second():.0f} msgs/s, {self.push_seconds:.2f} s waiting on Redis over all lists")
+
+
+def drain_error(task):
+    """Returns the error an AsyncRedisWriter drain task stopped with."""
+    if task.cancelled():
+        return RuntimeError("Redis drain task was cancelled")
+    return task.exception() or RuntimeError("Redis drain task stopped")
+
+
+async def push_async(writer, list_names, count, payload):
+    """Pushes count messages to the lists in turn through an AsyncRedisWriter."""
+    for i in range(count):
+        await writer.push(list_names[(i // 10) % len(list_names)], payload)
+    await writer.close()
+
+
+def main():
+    """Pushes synthetic messages to a local Redis to measure throughput."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Redis host")
+    parser.add_argument("--port", type=int, default=6379, help="Redis port")
+    parser.add_argument("--count", type=int, default=100000, help="Number of messages to push")
+    parser.add_argument("--size", type=int, default=100, help="Bytes per message")
+    parser.add_argument("--lists", type=int, default=4, help="Number of lists pushed to in turn")
+    parser.add_argument("--batch_size", type=int, default=REDIS_BATCH_SIZE, help="Messages per pipeline")
+    parser.add_argument("--engine", type=str, default="sync", choices=["sync", "async"], help="Writer to push with")
+    args = parser.parse_args()
+
+    list_names = [f"redis_writer_test_{i}" for i in range(args.lists)]
+    payload = bytes(args.size)
+    if args.engine == "async":
+        writer = AsyncRedisWriter(args.host, args.port, args.batch_size)
+        asyncio.run(push_async(writer, list_names, args.count, payload))
+    else:
+        writer = RedisWriter(args.host, args.port, args.batch_size)
+        for i in range(args.count):
+            writer.push(list_names[(i // 10) % args.lists], payload)
+        writer.close()
+    writer.report()
+
+    client = redis.Redis(host=args.host, port=args.port)
+    lengths = [client.llen(list_name) for list_name in list_names]
+    client.delete(*list_names)
+    if sum(lengths) != args.count:
+        raise RuntimeError(f"expected {args.count} messages in Redis, found {sum(lengths)}")
+
+
+if __name__ == "__main__":
+    main()
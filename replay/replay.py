@@ -7,15 +7,38 @@ Setup:
 
 Only pushes data the is after the first nav-pvt system time.
 
+Replay without a Redis server, e.g. to time reading and serializing:
+    python3 replay.py --db_path sensors.db --sink null
+
+Serialize a drive once and replay it many times:
+    python3 replay.py --db_path sensors.db --session <id> --compile drive.replay
+    python3 replay.py --artifact drive.replay
+
+Replay only part of a drive, from an offset from the session start or an
+absolute time. Once the database has been indexed with --create_indexes
+(which writes to it), only the rows in the window are read:
+    python3 replay.py --db_path sensors.db --session <id> --start 600 --end +10min30s
+    python3 replay.py --db_path sensors.db --start "2024-02-04 00:11:22" --end "2024-02-04 00:11:52"
+
+Write rates, serialization time, push latency, schedule lag and peak
+memory as JSON lines every second and a summary at the end:
+    python3 replay.py --db_path sensors.db --metrics metrics.jsonl
+
 """
 
 import sys
 import time
+import heapq
+import asyncio
+import itertools
 import signal
 import base64
 import sqlite3
+import pathlib
 import argparse
 import subprocess
+import multiprocessing
+from collections import namedtuple, deque
 
 import redis
 import numpy as np
@@ -23,6 +46,21 @@ import pandas as pd
 from tqdm import tqdm
 
 import sensordata_pb2 as sensordata
+from redis_writer import REDIS_BATCH_SIZE, LATENCY_BUCKETS, latency_bucket
+from replay_sinks import SINKS, make_sink
+from replay_artifact import ReplayArtifact, ReplayArtifactWriter
+from replay_metrics import ReplayMetrics, METRICS_INTERVAL, lag_percentiles
+
+# rows read from a table and serialized at a time, the replay holds a few
+# chunks per table in memory however long the session is
+READ_CHUNK_ROWS = 10000
+
+# whole seconds of a system time, the start of every format it's stored
+# in, with or without fractional seconds, so text ranges on it drop no rows
+SYSTEM_TIME_SECONDS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# when pacing, messages due within this many seconds are pushed without sleeping
+PACING_MIN_SLEEP = 0.001
 
 
 def main():
@@ -32,22 +70,161 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--db_path", type=str, default="sensors-v0-0-2.db", help="Path to the SQLite database file")
     parser.add_argument("--session", type=str, default="", help="Session ID to replay")
+    parser.add_argument("--workers", type=int, default=1, help="Processes serializing table chunks ahead of the replay")
+    parser.add_argument("--batch_size", type=int, default=REDIS_BATCH_SIZE, help="Messages sent to Redis per pipeline")
+    parser.add_argument("--speed", type=parse_speed, default="max", help="Replay speed relative to the recorded sync times, e.g. 1, 10x or max (as fast as possible)")
+    parser.add_argument("--engine", type=str, default="sync", choices=["sync", "async"], help="Push from one blocking loop or from asyncio with a connection per list")
+    parser.add_argument("--sink", type=str, default="redis", choices=SINKS, help="Push to Redis, in-process lists, a length-prefixed binary file or only count the messages")
+    parser.add_argument("--sink_path", type=str, default="replay.bin", help="Path of the file written by the file sink")
+    parser.add_argument("--compile", type=str, default=None, help="Write the scheduled messages to this replay artifact instead of replaying them")
+    parser.add_argument("--artifact", type=str, default=None, help="Replay from an artifact written with --compile instead of the database")
+    parser.add_argument("--metrics", type=str, default=None, help="Write replay metrics as JSON lines to this file, - for stdout")
+    parser.add_argument("--metrics_interval", type=float, default=METRICS_INTERVAL, help="Seconds between metrics lines")
+    parser.add_argument("--start", type=parse_window_time, default=None, help="Replay from this time, seconds from the session start (e.g. 90 or +1min30s) or an absolute time")
+    parser.add_argument("--end", type=parse_window_time, default=None, help="Replay until this time, seconds from the session start or an absolute time")
+    parser.add_argument("--create_indexes", action="store_true", help="Add time indexes to the database, writing to it, so windows and nav lookups don't scan or sort whole tables")
     args = parser.parse_args()
-
-    sr = SensorReplay(args.db_path, args.session)
+    if args.engine == "async" and args.sink != "redis":
+        parser.error("--engine async requires --sink redis")
+    if args.start is not None and args.end is not None and type(args.start) == type(args.end) and args.start >= args.end:
+        parser.error("--start must be before --end")
+
+    sr = SensorReplay(args.db_path, args.session, args.workers, args.batch_size, args.speed, args.engine,
+                      args.sink, args.sink_path, args.artifact, ReplayMetrics(args.metrics, args.metrics_interval),
+                      args.start, args.end, args.create_indexes)
     signal.signal(signal.SIGINT, sr.handle_exit)
-    sr.run_replay()
+    if args.compile is not None:
+        sr.compile(args.compile)
+    else:
+        sr.run_replay()
+
+def parse_speed(text):
+    """Parses a replay speed such as 1, 10x or max (infinite)."""
+    text = text.strip().lower()
+    if text == "max":
+        return float("inf")
+    speed = float(text[:-1] if text.endswith("x") else text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or max")
+    return speed
+
+
+def parse_window_time(text):
+    """Parses a replay window bound: an offset from the session start such as 90 or +1min30s, or an absolute time.
+
+    Offsets are returned as pd.Timedelta and absolute times as naive UTC
+    pd.Timestamp, like the recorded system times.
+    """
+    text = text.strip()
+    try:
+        try:
+            return pd.Timedelta(seconds=float(text))
+        except ValueError:
+            pass
+        if text.startswith("+"):
+            return pd.Timedelta(text[1:])
+        timestamp = pd.Timestamp(text)
+        return timestamp.tz_convert(None) if timestamp.tzinfo is not None else timestamp
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"expected seconds, +offset or a time, got {text}: {e}")
+
+
+def parse_system_times(system_times):
+    """Returns system time strings, with or without fractional seconds, as int64 ns."""
+    return pd.to_datetime(system_times, format="ISO8601").to_numpy(dtype="datetime64[ns]").astype(np.int64)
+
+
+def sqlite_uri(path, mode):
+    """Returns a URI opening a SQLite file in mode (ro or rw) without creating it."""
+    return f"{pathlib.Path(path).absolute().as_uri()}?mode={mode}"
+
+
+def fixed_point(column, scale):
+    """Returns a function that converts a column to integers like np.rint(x * scale) per row."""
+    return lambda columns: np.rint(columns[column] * scale).astype(np.int64)
+
+
+class SchedulePacer():
+    def __init__(self, speed):
+        """Paces rows by their sync time at speed times real time.
+
+        A row is due at start + (sync time - first sync time) / speed
+        on the monotonic clock, so waits are computed from the start and
+        delays never accumulate. Rows due within PACING_MIN_SLEEP are
+        sent without waiting. Lags are counted in the log2 buckets of
+        the Redis latency histogram, so memory stays fixed however many
+        rows are sent.
+        """
+        self.speed = speed
+        self.pacing = np.isfinite(speed)
+        self.start_time = None
+        self.start_sync_time = None
+        self.due_time = None
+        self.lag_counts = [0] * LATENCY_BUCKETS     # rows sent per lag bucket
+        self.max_lag = 0.                           # seconds
+
+    def wait_time(self, sync_time):
+        """Returns the seconds to wait before sending a row, 0 if it's due."""
+        if not self.pacing:
+            return 0.
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+            self.start_sync_time = sync_time
+        self.due_time = self.start_time + (sync_time - self.start_sync_time) * 1e-9 / self.speed
+        wait_time = self.due_time - time.monotonic()
+        return wait_time if wait_time > PACING_MIN_SLEEP else 0.
+
+    def sent(self):
+        """Records how late the row being sent is."""
+        if self.pacing:
+            lag = time.monotonic() - self.due_time
+            if lag > 0.:
+                self.lag_counts[latency_bucket(lag)] += 1
+                if lag > self.max_lag:
+                    self.max_lag = lag
+            else:
+                self.lag_counts[0] += 1
+
+    def report(self):
+        """Prints how late rows were sent relative to their due time."""
+        lags = lag_percentiles(self.lag_counts, self.max_lag)
+        if lags is not None:
+            print(f"Schedule lag at {self.speed:g}x: p50 < {lags['p50']:g} ms, p99 < {lags['p99']:g} ms, max {lags['max']:.2f} ms")
+
+
+def serialize_rows(task):
+    """Serializes a chunk of a table's rows, in a worker process or not, returning the payloads and seconds taken."""
+    start_time = time.perf_counter()
+    serializer_name, names, column_lists = task
+    serializer = getattr(SensorReplay.__new__(SensorReplay), serializer_name)
+    row_type = namedtuple("Row", names, rename=True)
+    payloads = [serializer(row_type._make(values)) for values in zip(*column_lists)]
+    return payloads, time.perf_counter() - start_time
+
 
 class SensorReplay():
-    def __init__(self, sensor_db_path, session = ""):
+    def __init__(self, sensor_db_path, session = "", workers = 1, batch_size = REDIS_BATCH_SIZE, speed = float("inf"), engine = "sync",
+                 sink = "redis", sink_path = "replay.bin", artifact_path = None, metrics = None, start = None, end = None,
+                 create_indexes = False):
 
 
         # Redis configuration
         self.redis_host = "127.0.0.1"
         self.redis_port = 6379
         self.redis_conf_file = "redis.conf"
+        self.sink_name = sink
+        self.sink = make_sink(sink, engine, self.redis_host, self.redis_port, batch_size, sink_path)
         self.sensor_db_path = sensor_db_path
+        self.artifact_path = artifact_path
+        self.metrics = ReplayMetrics() if metrics is None else metrics
+        self.serialize_seconds = {}     # per table, reading the rows into columns and serializing them
         self.session = session
+        self.workers = workers
+        self.speed = speed
+        self.engine = engine
+        self.start = start              # replay window, pd.Timedelta from the session start or pd.Timestamp
+        self.end = end
+        self.index_tables = create_indexes
 
         
         self.redis_table_to_list = {
@@ -84,79 +261,503 @@ class SensorReplay():
                                 "nav_pvt" : "system_time",
                               }
         self.itow_ms_tables = ["nav_cov", "nav_posecef", "nav_status", "nav_timegps", "nav_velecef"]
+
+        # protobuf fields computed over whole columns before serializing
+        self.derived_columns = {
+                                "nav_posecef" : {
+                                    "ecef_x_cm" : fixed_point("ecef_x", 100.),
+                                    "ecef_y_cm" : fixed_point("ecef_y", 100.),
+                                    "ecef_z_cm" : fixed_point("ecef_z", 100.),
+                                    "p_acc_cm" : fixed_point("p_acc", 100.),
+                                },
+                                "nav_pvt" : {
+                                    "valid_bits" : lambda c: (c["valid_date"] << 0) | (c["valid_time"] << 1) | (c["fully_resolved"] << 2) | (c["valid_mag"] << 3),
+                                    "flags_bits" : lambda c: (c["gnss_fix_ok"] << 0) | (c["diff_soln"] << 1) | (c["psm_state"] << 2) | (c["head_veh_valid"] << 5) | (c["carr_soln"] << 6),
+                                    "lon_dege7" : fixed_point("lon_deg", 1e7),
+                                    "lat_dege7" : fixed_point("lat_deg", 1e7),
+                                    "height_mm" : fixed_point("height_m", 1000),
+                                    "hmsl_mm" : fixed_point("hmsl_m", 1000),
+                                    "h_acc_mm" : fixed_point("h_acc_m", 1000),
+                                    "v_acc_mm" : fixed_point("v_acc_m", 1000),
+                                    "vel_n_mm_s" : fixed_point("vel_n_m_s", 1000),
+                                    "vel_e_mm_s" : fixed_point("vel_e_m_s", 1000),
+                                    "vel_d_mm_s" : fixed_point("vel_d_m_s", 1000),
+                                    "g_speed_mm_s" : fixed_point("g_speed_m_s", 1000),
+                                    "head_mot_dege5" : fixed_point("head_mot_deg", 1e5),
+                                    "s_acc_mm_s" : fixed_point("s_acc_m_s", 1000),
+                                    "head_acc_dege5" : fixed_point("head_acc_deg", 1e5),
+                                    "pdop_e2" : fixed_point("pdop", 100),
+                                    "flags3_bits" : lambda c: (c["invalid_llh"] << 0) | (c["last_correction_age"] << 1) | (c["auth_time"] << 13) | (c["nma_fix_status"] << 14),
+                                },
+                                "nav_status" : {
+                                    "flags_bits" : lambda c: (c["gps_fix_ok"] << 0) | (c["diff_soln"] << 1) | (c["wkn_set"] << 2) | (c["tow_set"] << 3),
+                                    "fix_stat_bits" : lambda c: (c["diff_corr"] << 0) | (c["carr_soln_valid"] << 1),
+                                    "flags2_bits" : lambda c: (c["psm_state"] << 0) | (c["spoof_det_state"] << 3) | (c["carr_soln"] << 6),
+                                },
+                                "nav_timegps" : {
+                                    "t_acc_ns_u32" : lambda c: c["t_acc_ns"].astype(np.uint32),
+                                },
+                                "nav_velecef" : {
+                                    "ecef_vx_cm_s" : fixed_point("ecef_vx", 100.),
+                                    "ecef_vy_cm_s" : fixed_point("ecef_vy", 100.),
+                                    "ecef_vz_cm_s" : fixed_point("ecef_vz", 100.),
+                                    "s_acc_cm_s" : fixed_point("s_acc", 100.),
+                                },
+                              }
         
-        self.sql_data = {}
+        self.columns = {}
+        self.payloads = {}
+        self.itow_ms_index = {}
+        self.first_itow_ms = {}
+        self.last_itow_ms = {}
         self.row_index = {}
-        self.system_timestamps = {}
-        nav_pvt_start_time = None
-        nav_pvt_start_itow_ms = None
-        for table in self.redis_table_to_list:
-            self.sql_data[table] = self.fetch_sqlite_table(table)
-            self.row_index[table] = 0
-            if table in self.system_time_columns:
-                self.sql_data[table]["sync_time"] = pd.to_datetime(self.sql_data[table][self.system_time_columns[table]],
-                                                                                        format="%Y-%m-%d %H:%M:%S.%f")
-                if table == "nav_pvt":
-                    nav_pvt_start_time = self.sql_data[table]["sync_time"][0]
-                    nav_pvt_start_itow_ms = self.sql_data[table]["itow_ms"][0]
-                elif nav_pvt_start_time is not None:
-                    self.sql_data[table] = self.sql_data[table][self.sql_data[table]["sync_time"] >= nav_pvt_start_time]
-                    self.sql_data[table].reset_index(drop=True, inplace=True)
-                if len(self.sql_data[table]) > 0:
-                    self.system_timestamps[table] = self.sql_data[table]["sync_time"][0]
-            else:
-                if nav_pvt_start_itow_ms is not None:
-                    self.sql_data[table] = self.sql_data[table][self.sql_data[table]["itow_ms"] >= nav_pvt_start_itow_ms]
-                    self.sql_data[table].reset_index(drop=True, inplace=True)
-
-        self.start_redis_server()
+        self.sync_times = {}
+        self.chunks = {}
+        self.pool = None
+        self.connection = None
+        if artifact_path is None:
+            self.open_database()
+
+    def open_database(self):
+        """Opens the sensors database and builds the WHERE clause of every table."""
+
+        # one read-only connection shared by every table's chunked query
+        if self.index_tables:
+            self.create_indexes()
+        self.connection = sqlite3.connect(sqlite_uri(self.sensor_db_path, "ro"), uri=True)
+        self.indexes = set(name for name, in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+
+        # rows of the session from the first recorded nav_pvt on, as SQL WHERE clauses
+        self.filters = {table: self.session_filter(table) for table in self.redis_table_to_list}
+        where, params = self.filters["nav_pvt"]
+        nav_pvt_start = self.connection.execute(f"SELECT system_time, itow_ms FROM nav_pvt{where} ORDER BY rowid LIMIT 1",
+                                                params).fetchone()
+        self.time_bounds = {}
+        if nav_pvt_start is not None:
+            for table in self.redis_table_to_list:
+                if table in self.itow_ms_tables:
+                    self.filters[table] = self.add_filter(self.filters[table], "itow_ms >= ?", nav_pvt_start[1])
+                elif table != "nav_pvt":
+                    self.add_time_bounds(table, start=pd.Timestamp(nav_pvt_start[0]).value)
+        if self.start is not None or self.end is not None:
+            self.add_window_filters(nav_pvt_start)
+        else:
+            for table in self.system_time_columns:
+                self.add_rowid_range(table)
+
+    def add_window_filters(self, nav_pvt_start):
+        """Narrows every table's WHERE clause to the rows between the start and end times.
+
+        Tables with a system time get a range on it. The itow_ms tables
+        are only looked up from nav_pvt rows, so they get the range
+        between the lowest and highest itow_ms of the nav_pvt rows in
+        the window. With the time indexes, see create_indexes, only the
+        window's rows are read and counted, otherwise the tables are
+        scanned.
+        """
+        session_start = self.session_start_time(nav_pvt_start)
+        start = None if self.start is None else self.window_time(self.start, session_start)
+        end = None if self.end is None else self.window_time(self.end, session_start)
+        for table in self.system_time_columns:
+            self.add_time_bounds(table, start, end)
+
+        unindexed = [table for table in self.system_time_columns if not self.add_rowid_range(table)]
+        if len(unindexed) > 0:
+            print(f"No time index on {', '.join(unindexed)}, scanning for the window, --create_indexes adds them")
+
+        # NULL bounds without nav_pvt rows in the window select nothing
+        where, params = self.filters["nav_pvt"]
+        nav_pvt = pd.read_sql_query(f"SELECT system_time, itow_ms FROM nav_pvt{where}", self.connection, params=params)
+        itow_ms = nav_pvt["itow_ms"].to_numpy()
+        in_window = self.time_mask("nav_pvt", parse_system_times(nav_pvt["system_time"]))
+        if in_window is not None:
+            itow_ms = itow_ms[in_window]
+        itow_ms_range = (int(itow_ms.min()), int(itow_ms.max())) if len(itow_ms) > 0 else (None, None)
+        for table in self.itow_ms_tables:
+            self.filters[table] = self.add_filter(self.filters[table], "itow_ms BETWEEN ? AND ?", *itow_ms_range)
+
+    def add_time_bounds(self, table, start=None, end=None):
+        """Limits a system time table to the rows with sync times from start until before end (ns).
+
+        SQL compares system times as text, where the same time with and
+        without fractional seconds differ, so the SQL range is widened to
+        whole seconds, and read_table drops the rows outside the exact
+        bounds by their parsed sync times.
+        """
+        column = self.system_time_columns[table]
+        bounds = self.time_bounds.setdefault(table, [None, None])
+        if start is not None:
+            start_second = pd.Timestamp(start).floor("s")
+            self.filters[table] = self.add_filter(self.filters[table], f"{column} >= ?", start_second.strftime(SYSTEM_TIME_SECONDS_FORMAT))
+            bounds[0] = start if bounds[0] is None else max(bounds[0], start)
+        if end is not None:
+            next_second = pd.Timestamp(end).floor("s") + pd.Timedelta(seconds=1)
+            self.filters[table] = self.add_filter(self.filters[table], f"{column} < ?", next_second.strftime(SYSTEM_TIME_SECONDS_FORMAT))
+            bounds[1] = end if bounds[1] is None else min(bounds[1], end)
+
+    def time_mask(self, table, sync_times):
+        """Returns which of a system time table's sync times are within its time bounds, None if all are."""
+        start, end = self.time_bounds.get(table, (None, None))
+        mask = np.ones(len(sync_times), dtype=bool)
+        if start is not None:
+            mask &= sync_times >= start
+        if end is not None:
+            mask &= sync_times < end
+        return None if mask.all() else mask
+
+    def add_rowid_range(self, table):
+        """Bounds a system time table's rowids to those of its filtered rows, returns False without a time index.
+
+        The table is read in rowid order without an index, so the rowid
+        range found through the time index keeps that scan to the rows
+        recorded during the session and filtered times, rather than
+        every session of the database.
+        """
+        index = f"{table}_session_time" if self.session != "" else f"{table}_time"
+        if index not in self.indexes:
+            return False
+        where, params = self.filters[table]
+        rowid_range = self.connection.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table} INDEXED BY {index}{where}", params).fetchone()
+        self.filters[table] = self.add_filter(self.filters[table], "rowid BETWEEN ? AND ?", *rowid_range)
+        return True
+
+    def session_start_time(self, nav_pvt_start):
+        """Returns the time (ns) replay window offsets count from: the first nav_pvt, else the earliest row."""
+        if nav_pvt_start is not None:
+            return pd.Timestamp(nav_pvt_start[0]).value
+        first_times = []
+        for table, column in self.system_time_columns.items():
+            where, params = self.filters[table]
+            first_times.append(self.connection.execute(f"SELECT MIN({column}) FROM {table}{where}", params).fetchone()[0])
+        first_times = [first_time for first_time in first_times if first_time is not None]
+        return pd.Timestamp(min(first_times)).value if len(first_times) > 0 else 0
+
+    def window_time(self, bound, session_start):
+        """Returns a replay window bound as ns, offsets counted from session_start (ns)."""
+        if isinstance(bound, pd.Timedelta):
+            return session_start + bound.value
+        return bound.value
 
     def adjust_itow_ms(self, itow_ms):
         
         return itow_ms
         # return int((itow_ms + 371345500) % 6.048E8)
 
-    def run_replay(self):
-        """Runs the replay loop."""
+    def time_column(self, table):
+        """Returns the column a table is ordered and filtered by."""
+        return self.system_time_columns.get(table, "itow_ms")
+
+    def session_column(self, table):
+        """Returns the column holding a table's session."""
+        return "session_id" if table == "gnss_auth" else "session"
+
+    def session_filter(self, table):
+        """Returns the (WHERE clause, parameters) selecting a table's session."""
+        if self.session == "":
+            return "", []
+        return f" WHERE {self.session_column(table)} = ?", [self.session]
+
+    def add_filter(self, table_filter, condition, *values):
+        """Returns a (WHERE clause, parameters) with one more condition."""
+        where, params = table_filter
+        return f"{where} AND {condition}" if where else f" WHERE {condition}", params + list(values)
+
+    def create_indexes(self):
+        """Indexes every table on (session, time column) if it isn't yet, only with --create_indexes.
+
+        This writes to the sensors database, which is otherwise only
+        read. The itow_ms tables are then read in itow_ms order without
+        sorting, and a session's or a window's rows are found without
+        scanning the system time tables. A window over all sessions also needs an
+        index on the time column alone. A read-only database is
+        replayed without them.
+        """
+        columns = {f"{table}_session_time": (table, f"{self.session_column(table)}, {self.time_column(table)}")
+                   for table in self.redis_table_to_list}
+        if self.session == "" and (self.start is not None or self.end is not None):
+            columns.update({f"{table}_time": (table, self.time_column(table)) for table in self.redis_table_to_list})
+        connection = sqlite3.connect(sqlite_uri(self.sensor_db_path, "ro"), uri=True)
+        indexes = set(name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+        connection.close()
+        missing = [index for index in columns if index not in indexes]
+        if len(missing) == 0:
+            return
+        try:
+            connection = sqlite3.connect(sqlite_uri(self.sensor_db_path, "rw"), uri=True)
+            for index in missing:
+                table, index_columns = columns[index]
+                print(f"Indexing {table} on ({index_columns})")
+                connection.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({index_columns})")
+            connection.commit()
+            connection.close()
+        except sqlite3.OperationalError as e:
+            print(f"Replaying without indexes: {e}")
+
+    def count_rows(self, table):
+        """Returns the number of rows of a table that are replayed."""
+        where, params = self.filters[table]
+        return self.connection.execute(f"SELECT COUNT(*) FROM {table}{where}", params).fetchone()[0]
+
+    def read_table(self, table, table_filter=None):
+        """Yields (columns, payloads) of a table's rows in time order, READ_CHUNK_ROWS at a time.
+
+        Each chunk is converted into NumPy column arrays, the fixed point
+        and bit field protobuf values are computed over whole columns and
+        every row is serialized into bytes. With a worker pool, up to
+        workers chunks are serialized ahead of the one being replayed.
+        System time tables are read in recorded (rowid) order, scanning
+        the table rather than an index so rows don't have to be sorted.
+        The itow_ms tables are ordered by itow_ms then rowid, so the first
+        recorded of several rows with the same itow_ms comes first.
+        """
+        where, params = self.filters[table] if table_filter is None else table_filter
+        if table in self.system_time_columns:
+            query = f"SELECT * FROM {table} NOT INDEXED{where} ORDER BY rowid"
+        else:
+            query = f"SELECT * FROM {table}{where} ORDER BY itow_ms, rowid"
+        pending = deque()
+        self.serialize_seconds.setdefault(table, 0.)
+        for df in pd.read_sql_query(query, self.connection, params=params, chunksize=READ_CHUNK_ROWS):
+            if len(df) == 0:
+                continue
+            start_time = time.perf_counter()
+            if table in self.system_time_columns:
+                sync_times = parse_system_times(df[self.system_time_columns[table]])
+                in_bounds = self.time_mask(table, sync_times)
+                if in_bounds is not None:
+                    # counted by count_rows in the whole second SQL range, but not replayed
+                    self.pbar.total -= len(df) - int(in_bounds.sum())
+                    df, sync_times = df[in_bounds], sync_times[in_bounds]
+                    if len(df) == 0:
+                        continue
+            columns = {name: df[name].to_numpy() for name in df.columns}
+            if table in self.system_time_columns:
+                columns["sync_time"] = sync_times
+            for name, derive in self.derived_columns.get(table, {}).items():
+                columns[name] = derive(columns)
+
+            names = list(columns)
+            task = (self.serializers[table].__name__, names, [columns[name].tolist() for name in names])
+            self.serialize_seconds[table] += time.perf_counter() - start_time
+            if self.pool is None:
+                yield columns, self.serialized(table, serialize_rows(task))
+            else:
+                pending.append((columns, self.pool.apply_async(serialize_rows, (task,))))
+                if len(pending) >= self.workers:
+                    columns, result = pending.popleft()
+                    yield columns, self.serialized(table, result.get())
+        while len(pending) > 0:
+            columns, result = pending.popleft()
+            yield columns, self.serialized(table, result.get())
+
+    def serialized(self, table, result):
+        """Adds the seconds a chunk took to serialize to its table's and returns its payloads."""
+        payloads, seconds = result
+        self.serialize_seconds[table] += seconds
+        return payloads
+
+    def load_chunk(self, table):
+        """Moves a table on to its next chunk, returns False once it has no more rows."""
+        chunk = next(self.chunks[table], None)
+        if chunk is None:
+            # the last chunk is kept for itow_ms lookups, nothing comes after it
+            if table in self.itow_ms_tables:
+                self.last_itow_ms[table] = float("inf")
+            return False
+        self.columns[table], self.payloads[table] = chunk
+        self.row_index[table] = 0
+        if table in self.system_time_columns:
+            self.sync_times[table] = self.columns[table]["sync_time"].tolist()
+        if table in self.itow_ms_tables:
+            self.build_itow_ms_index(table)
+
+        # messages pushed with every nav_pvt row
+        if table == "nav_pvt":
+            nav_pvt_system_times = self.columns["nav_pvt"]["system_time"].tolist()
+            nav_pvt_itow_ms = self.columns["nav_pvt"]["itow_ms"].tolist()
+            self.payloads["nav_dop"] = [self.serialize_nav_dop(system_time, itow_ms) for system_time, itow_ms in zip(nav_pvt_system_times, nav_pvt_itow_ms)]
+            self.payloads["nav_sat"] = [self.serialize_nav_sat(system_time, itow_ms) for system_time, itow_ms in zip(nav_pvt_system_times, nav_pvt_itow_ms)]
+            self.payloads["mon_rf"] = [self.serialize_mon_rf(system_time) for system_time in nav_pvt_system_times]
+        return True
+
+    def build_itow_ms_index(self, table):
+        """Maps each itow_ms of a table's chunk to its first row position."""
+        itow_ms, first_rows = np.unique(self.columns[table]["itow_ms"], return_index=True)
+        self.itow_ms_index[table] = dict(zip(itow_ms.tolist(), first_rows.tolist()))
+        self.first_itow_ms[table] = itow_ms[0].item()
+        self.last_itow_ms[table] = itow_ms[-1].item()
+
+    def find_itow_ms(self, table, itow_ms):
+        """Returns the payload of the first row of an itow_ms table with itow_ms, or None.
+
+        The table's chunks are ordered by itow_ms, so chunks ending
+        before itow_ms are skipped. If nav_pvt's itow_ms goes back, e.g.
+        at the next session or GPS week, the table is queried again from
+        itow_ms on.
+        """
+        if itow_ms < self.first_itow_ms[table]:
+            self.chunks[table] = self.read_table(table, self.add_filter(self.filters[table], "itow_ms >= ?", itow_ms))
+            self.itow_ms_index[table] = {}
+            self.first_itow_ms[table] = itow_ms
+            self.load_chunk(table)
+        while self.last_itow_ms[table] < itow_ms:
+            self.load_chunk(table)
+        match = self.itow_ms_index[table].get(itow_ms)
+        return None if match is None else self.payloads[table][match]
+
+    def merge_schedule(self):
+        """Yields (table, row index, sync time) of every row with a sync time in sync time order.
+
+        k-way merge of the tables' sync_time chunks with a heap of
+        (next sync time, table order, table) cursors, O(log k) per row.
+        Equal sync times go to the table loaded first, like taking the
+        min over the tables in load order. The row index is within the
+        table's current chunk, the next chunk is loaded once it's used up.
+        """
+        tables = [table for table in self.redis_table_to_list if table in self.system_time_columns]
+        heap = [(self.sync_times[table][0], order, table) for order, table in enumerate(tables) if self.load_chunk(table)]
+        heapq.heapify(heap)
+        while len(heap) > 0:
+            sync_time, order, table = heap[0]
+            row_index = self.row_index[table]
+            yield table, row_index, sync_time
+            row_index += 1
+            self.row_index[table] = row_index
+            if row_index < len(self.sync_times[table]) or self.load_chunk(table):
+                heapq.heapreplace(heap, (self.sync_times[table][self.row_index[table]], order, table))
+            else:
+                heapq.heappop(heap)
 
-        pbar = tqdm(total=sum([len(self.sql_data[table]) for table in self.sql_data]))
-        
-        while True:
+    def scheduled_messages(self):
+        """Yields (sync time, [(list name, payload), ...]) of every scheduled row in sync time order.
+
+        A nav_pvt row comes with the first row of each itow_ms table with
+        its itow_ms and its NavDop, NavSat and MonRf messages.
+        """
+        for min_key, row_index, sync_time in self.merge_schedule():
+            messages = [(self.redis_table_to_list[min_key], self.payloads[min_key][row_index])]
+            self.pbar.update(1)
 
-            # find the minimum timestamp
-            valid_timestamps = {k: v for k, v in self.system_timestamps.items() if v is not None}
-            if len(valid_timestamps) == 0:
-                break
-            min_key = min(valid_timestamps, key=valid_timestamps.get)
-            
-            # add the current min key to Redis
-            serialized_data = self.serializers[min_key](self.sql_data[min_key].iloc[self.row_index[min_key]])
-            self.push_to_redis(serialized_data, self.redis_table_to_list[min_key])
-            pbar.update(1)
-            
             # if it's a navigation message, also add the other navigation messages
             if min_key == "nav_pvt":
-                nav_pvt_itow_ms = self.sql_data[min_key].iloc[self.row_index[min_key]]["itow_ms"]
-                nav_pvt_system_time = self.sql_data[min_key].iloc[self.row_index[min_key]]["system_time"]
+                nav_pvt_itow_ms = self.columns[min_key]["itow_ms"][row_index].item()
 
                 for table in self.itow_ms_tables:
-                    data_row = self.sql_data[table].loc[self.sql_data[table]["itow_ms"] == nav_pvt_itow_ms]
-                    if len(data_row) > 0:
-                        serialized_data = self.serializers[table](data_row.iloc[0])
-                        self.push_to_redis(serialized_data, self.redis_table_to_list[table])
-                        pbar.update(1)
-                self.push_to_redis(self.serialize_nav_dop(nav_pvt_system_time, nav_pvt_itow_ms), "NavDop")
-                self.push_to_redis(self.serialize_nav_sat(nav_pvt_system_time, nav_pvt_itow_ms), "NavSat")
-                self.push_to_redis(self.serialize_mon_rf(nav_pvt_system_time), "MonRf")
-                
-            # update to the next timestamp
-            self.row_index[min_key] += 1
-            if self.row_index[min_key] >= len(self.sql_data[min_key]):
-                self.system_timestamps[min_key] = None
-            else:
-                self.system_timestamps[min_key] = self.sql_data[min_key]["sync_time"][self.row_index[min_key]]
+                    payload = self.find_itow_ms(table, nav_pvt_itow_ms)
+                    if payload is not None:
+                        messages.append((self.redis_table_to_list[table], payload))
+                        self.pbar.update(1)
+                messages.append(("NavDop", self.payloads["nav_dop"][row_index]))
+                messages.append(("NavSat", self.payloads["nav_sat"][row_index]))
+                messages.append(("MonRf", self.payloads["mon_rf"][row_index]))
+            yield sync_time, messages
+
+    def artifact_messages(self, artifact):
+        """Yields (schedule time, [(list name, payload)]) of every message of a replay artifact in the window.
+
+        Window offsets count from the artifact's first message, which is
+        where the compiled replay started.
+        """
+        start_time = None if self.start is None else self.window_time(self.start, artifact.first_time)
+        end_time = None if self.end is None else self.window_time(self.end, artifact.first_time)
+        for schedule_time, list_name, payload in artifact.messages(start_time, end_time):
+            self.pbar.update(1)
+            yield schedule_time, [(list_name, payload)]
+
+    def open_tables(self):
+        """Starts the chunked reads of every table and the progress bar over their rows."""
+        self.pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+        for table in self.redis_table_to_list:
+            self.chunks[table] = self.read_table(table)
+        for table in self.itow_ms_tables:
+            self.itow_ms_index[table] = {}
+            self.first_itow_ms[table] = float("-inf")
+            self.load_chunk(table)
+        self.pbar = tqdm(total=sum([self.count_rows(table) for table in self.redis_table_to_list]))
+
+    def close_tables(self):
+        """Stops the progress bar and the serializing workers."""
+        self.pbar.close()
+        if self.pool is not None:
+            self.pool.close()
+
+    def compile(self, artifact_path):
+        """Writes every scheduled message to a replay artifact instead of pushing it."""
+        self.open_tables()
+        writer = ReplayArtifactWriter(artifact_path)
+        for sync_time, messages in self.scheduled_messages():
+            for list_name, payload in messages:
+                writer.write(sync_time, list_name, payload)
+        writer.close()
+        self.close_tables()
+        print(f"Compiled {writer.n_messages} messages ({writer.offset / 1e6:.1f} MB) to {artifact_path}")
 
-        self.clear_redis()
+    def run_replay(self):
+        """Runs the replay loop."""
+
+        start_time = time.monotonic()
+        if self.sink_name == "redis":
+            self.start_redis_server()
+            start_time = time.monotonic()
+        pacer = SchedulePacer(self.speed)
+        self.metrics.start(self.sink, pacer, self.serialize_seconds)
+        if self.artifact_path is None:
+            self.open_tables()
+            messages = self.scheduled_messages()
+        else:
+            artifact = ReplayArtifact(self.artifact_path)
+            self.pbar = tqdm(total=len(artifact) if self.start is None and self.end is None else None)
+            messages = self.artifact_messages(artifact)
+        messages = iter(messages)
+        first = next(messages, None)
+        print(f"First message ready after {(time.monotonic() - start_time) * 1e3:.1f} ms")
+        if first is not None:
+            messages = itertools.chain([first], messages)
+
+        if self.engine == "async":
+            asyncio.run(self.replay_async(pacer, messages))
+        else:
+            self.replay_sync(pacer, messages)
+
+        if self.artifact_path is None:
+            self.close_tables()
+        else:
+            self.pbar.close()
+            artifact.close()
+        self.sink.report()
+        pacer.report()
+        self.metrics.stop()
+        if self.sink_name == "redis":
+            self.clear_redis()
+
+    def replay_sync(self, pacer, scheduled_messages):
+        """Pushes the scheduled messages to the sink, blocking on Redis with the redis sink."""
+        for sync_time, messages in scheduled_messages:
+            if pacer.wait_time(sync_time) > 0:
+                self.sink.flush()
+                time.sleep(max(pacer.due_time - time.monotonic(), 0.))
+            pacer.sent()
+            for list_name, payload in messages:
+                self.push_to_sink(payload, list_name)
+        self.sink.close()
+
+    async def replay_async(self, pacer, scheduled_messages):
+        """Queues the scheduled messages for the async writer's per list connections.
+
+        The scheduler gives the writer's tasks a turn while waiting for a
+        row to be due, when a queue is full and every batch_size rows
+        when replaying as fast as possible.
+        """
+        for n_rows, (sync_time, messages) in enumerate(scheduled_messages, 1):
+            wait_time = pacer.wait_time(sync_time)
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            elif n_rows % self.sink.batch_size == 0:
+                await asyncio.sleep(0)
+            pacer.sent()
+            for list_name, payload in messages:
+                await self.sink.push(list_name, payload)
+        await self.sink.close()
 
     def serialize_gnss(self, row):
         message = sensordata.GnssData()
@@ -251,44 +852,44 @@ class SensorReplay():
     def serialize_nav_posecef(self, row):
         message = sensordata.NavPosecef()
         message.itow_ms = self.adjust_itow_ms(row.itow_ms)
-        message.ecef_x_cm = int(np.rint(row.ecef_x * 100.))
-        message.ecef_y_cm = int(np.rint(row.ecef_y * 100.))
-        message.ecef_z_cm = int(np.rint(row.ecef_z * 100.))
-        message.p_acc_cm = int(np.rint(row.p_acc * 100.))
+        message.ecef_x_cm = row.ecef_x_cm
+        message.ecef_y_cm = row.ecef_y_cm
+        message.ecef_z_cm = row.ecef_z_cm
+        message.p_acc_cm = row.p_acc_cm
         return message.SerializeToString()
     
     def serialize_nav_pvt(self, row):
         message = sensordata.NavPvt()
         message.system_time = row.system_time
         message.itow_ms = self.adjust_itow_ms(row.itow_ms)
-        message.valid = (row.valid_date << 0) | (row.valid_time << 1) | (row.fully_resolved << 2) | (row.valid_mag << 3)
+        message.valid = row.valid_bits
         message.fix_type = row.fix_type
-        message.flags = (row.gnss_fix_ok << 0) | (row.diff_soln << 1) | (row.psm_state << 2) | (row.head_veh_valid << 5) | (row.carr_soln << 6)
+        message.flags = row.flags_bits
         message.num_sv = row.num_sv
-        message.lon_dege7 = int(np.rint(row.lon_deg * 1e7))
-        message.lat_dege7 = int(np.rint(row.lat_deg * 1e7))
-        message.height_mm = int(np.rint(row.height_m * 1000))
-        message.hmsl_mm = int(np.rint(row.hmsl_m * 1000))
-        message.h_acc_mm = int(np.rint(row.h_acc_m * 1000))
-        message.v_acc_mm = int(np.rint(row.v_acc_m * 1000))
-        message.vel_n_mm_s = int(np.rint(row.vel_n_m_s * 1000))
-        message.vel_e_mm_s = int(np.rint(row.vel_e_m_s * 1000))
-        message.vel_d_mm_s = int(np.rint(row.vel_d_m_s * 1000))
-        message.g_speed_mm_s = int(np.rint(row.g_speed_m_s * 1000))
-        message.head_mot_dege5 = int(np.rint(row.head_mot_deg * 1e5))
-        message.s_acc_mm_s = int(np.rint(row.s_acc_m_s * 1000))
-        message.head_acc_dege5 = int(np.rint(row.head_acc_deg * 1e5))
-        message.pdop = int(np.rint(row.pdop * 100))
-        message.flags3 = (row.invalid_llh << 0) | (row.last_correction_age << 1) | (row.auth_time << 13) | (row.nma_fix_status << 14)
+        message.lon_dege7 = row.lon_dege7
+        message.lat_dege7 = row.lat_dege7
+        message.height_mm = row.height_mm
+        message.hmsl_mm = row.hmsl_mm
+        message.h_acc_mm = row.h_acc_mm
+        message.v_acc_mm = row.v_acc_mm
+        message.vel_n_mm_s = row.vel_n_mm_s
+        message.vel_e_mm_s = row.vel_e_mm_s
+        message.vel_d_mm_s = row.vel_d_mm_s
+        message.g_speed_mm_s = row.g_speed_mm_s
+        message.head_mot_dege5 = row.head_mot_dege5
+        message.s_acc_mm_s = row.s_acc_mm_s
+        message.head_acc_dege5 = row.head_acc_dege5
+        message.pdop = row.pdop_e2
+        message.flags3 = row.flags3_bits
         return message.SerializeToString()
     
     def serialize_nav_status(self, row):
         message = sensordata.NavStatus()
         message.itow_ms = self.adjust_itow_ms(row.itow_ms)
         message.gps_fix = row.gps_fix
-        message.flags = (row.gps_fix_ok << 0) | (row.diff_soln << 1) | (row.wkn_set << 2) | (row.tow_set << 3)
-        message.fix_stat = (row.diff_corr << 0) | (row.carr_soln_valid << 1)
-        message.flags2 = (row.psm_state << 0) | (row.spoof_det_state << 3) | (row.carr_soln << 6)
+        message.flags = row.flags_bits
+        message.fix_stat = row.fix_stat_bits
+        message.flags2 = row.flags2_bits
         message.ttff = row.ttff
         message.msss = row.msss
         return message.SerializeToString()
@@ -300,16 +901,16 @@ class SensorReplay():
         message.week = row.week
         message.leap_s = row.leap_s
         message.valid = row.valid
-        message.t_acc_ns = np.uint32(row.t_acc_ns)
+        message.t_acc_ns = row.t_acc_ns_u32
         return message.SerializeToString()
     
     def serialize_nav_velecef(self, row):
         message = sensordata.NavVelecef()
         message.itow_ms = self.adjust_itow_ms(row.itow_ms)
-        message.ecef_vx_cm_s = int(np.rint(row.ecef_vx * 100.))
-        message.ecef_vy_cm_s = int(np.rint(row.ecef_vy * 100.))
-        message.ecef_vz_cm_s = int(np.rint(row.ecef_vz * 100.))
-        message.s_acc_cm_s = int(np.rint(row.s_acc * 100.))
+        message.ecef_vx_cm_s = row.ecef_vx_cm_s
+        message.ecef_vy_cm_s = row.ecef_vy_cm_s
+        message.ecef_vz_cm_s = row.ecef_vz_cm_s
+        message.s_acc_cm_s = row.s_acc_cm_s
         return message.SerializeToString()
     
     def serialize_nav_dop(self, nav_pvt_system_time, nav_pvt_itow_ms):
@@ -351,30 +952,9 @@ class SensorReplay():
         message.system_time = nav_pvt_system_time
         return message.SerializeToString()
 
-    def push_to_redis(self, serialized_data, list_name):
-        """Pushes the serialized data to a Redis list."""
-        redis_client = redis.StrictRedis(host=self.redis_host, port=self.redis_port, decode_responses=True)
-        redis_client.lpush(list_name, serialized_data)
-
-    def fetch_sqlite_table(self, table_name):
-
-        conn = sqlite3.connect(self.sensor_db_path)
-        cursor = conn.cursor()
-
-        query = f"SELECT * FROM {table_name}"
-
-        df = pd.read_sql_query(query, conn)
-
-        if self.session != "":
-            if table_name == "gnss_auth":
-                df = df[df["session_id"] == self.session]
-            else:
-                df = df[df["session"] == self.session]
-
-        df.reset_index(drop=True, inplace=True)
-
-        conn.close()
-        return df
+    def push_to_sink(self, serialized_data, list_name):
+        """Pushes the serialized data to a list of the sink."""
+        self.sink.push(list_name, serialized_data)
 
     def clear_redis(self):
         try:
@@ -408,8 +988,11 @@ class SensorReplay():
             raise e
 
     def handle_exit(self, signal, frame):
-        print("Clearing data on exit...")
-        self.clear_redis()
+        if self.sink_name == "redis":
+            print("Clearing data on exit...")
+            self.clear_redis()
+        else:
+            self.sink.close()
         sys.exit(0)
 
 if __name__ == "__main__":
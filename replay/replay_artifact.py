@@ -0,0 +1,161 @@
+"""Precompiled replay artifacts: scheduled messages ready to push.
+
+An artifact is written once from a sensors database with
+`python3 replay.py --db_path sensors.db --session <id> --compile drive.replay`
+and replayed any number of times with
+`python3 replay.py --artifact drive.replay`, skipping the SQLite load
+and the serialization.
+
+Layout, little endian:
+- header: ARTIFACT_HEADER, see ReplayArtifactWriter.close
+- records in push order: ARTIFACT_RECORD (schedule time in ns, list
+  id, payload length) followed by the payload
+- list names: uint16 length and UTF-8 name of each list id
+- index: (lowest and highest schedule time, offset of the first record)
+  of every ARTIFACT_INDEX_STRIDE records
+
+Schedule times mostly increase, but rows pushed in recorded order, e.g.
+imu rows with jittered times, can go back in time, hence the time range
+of each stride.
+
+"""
+
+import os
+import mmap
+import struct
+
+import numpy as np
+
+ARTIFACT_MAGIC = b"BEEREPLY"
+ARTIFACT_VERSION = 2
+
+# magic, version, messages, lists, index entries, first and last schedule
+# time, offset of the list names, offset of the index
+ARTIFACT_HEADER = struct.Struct("<8sIQIIqqQQ")
+
+# schedule time in ns, list id, payload length
+ARTIFACT_RECORD = struct.Struct("<qHI")
+
+# records between index entries
+ARTIFACT_INDEX_STRIDE = 4096
+
+ARTIFACT_INDEX_DTYPE = np.dtype([("min_time", "<i8"), ("max_time", "<i8"), ("offset", "<u8")])
+
+ARTIFACT_BUFFER_SIZE = 1024 * 1024
+
+
+class ReplayArtifactWriter():
+    def __init__(self, path):
+        """Writes scheduled messages to a replay artifact.
+
+        Messages are written in push order. The file is written
+        next to path and moved there by close(), so an interrupted
+        compile never leaves a partial artifact behind.
+        """
+        self.path = path
+        self.file = open(path + ".tmp", "wb", buffering=ARTIFACT_BUFFER_SIZE)
+        self.file.write(bytes(ARTIFACT_HEADER.size))
+        self.offset = ARTIFACT_HEADER.size
+        self.list_ids = {}
+        self.index = []
+        self.n_messages = 0
+        self.first_time = 0
+        self.last_time = 0
+
+    def write(self, schedule_time, list_name, payload):
+        """Appends a message due at schedule_time (ns) for a list."""
+        list_id = self.list_ids.get(list_name)
+        if list_id is None:
+            list_id = self.list_ids[list_name] = len(self.list_ids)
+        if self.n_messages % ARTIFACT_INDEX_STRIDE == 0:
+            self.index.append([schedule_time, schedule_time, self.offset])
+            if self.n_messages == 0:
+                self.first_time = schedule_time
+        else:
+            stride = self.index[-1]
+            stride[0] = min(stride[0], schedule_time)
+            stride[1] = max(stride[1], schedule_time)
+        self.last_time = schedule_time
+        self.file.write(ARTIFACT_RECORD.pack(schedule_time, list_id, len(payload)))
+        self.file.write(payload)
+        self.offset += ARTIFACT_RECORD.size + len(payload)
+        self.n_messages += 1
+
+    def close(self):
+        """Writes the list names, index and header and moves the artifact in place."""
+        names_offset = self.offset
+        for list_name in self.list_ids:
+            name = list_name.encode()
+            self.file.write(struct.pack("<H", len(name)) + name)
+            self.offset += 2 + len(name)
+        index_offset = self.offset
+        self.file.write(np.array([tuple(stride) for stride in self.index], dtype=ARTIFACT_INDEX_DTYPE).tobytes())
+        self.file.seek(0)
+        self.file.write(ARTIFACT_HEADER.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, self.n_messages, len(self.list_ids),
+                                             len(self.index), self.first_time, self.last_time, names_offset, index_offset))
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+class ReplayArtifact():
+    def __init__(self, path):
+        """Reads a replay artifact through a read-only memory map.
+
+        Opening only reads the header, list names and index. Messages
+        are read by unpacking each fixed size record header and slicing
+        the payload out of the map, without any other decoding.
+        """
+        self.path = path
+        self.file = open(path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < ARTIFACT_HEADER.size:
+            raise ValueError(f"{path} is too short to be a replay artifact")
+        (magic, version, self.n_messages, n_lists, n_index, self.first_time, self.last_time,
+         self.names_offset, index_offset) = ARTIFACT_HEADER.unpack_from(self.mmap, 0)
+        if magic != ARTIFACT_MAGIC:
+            raise ValueError(f"{path} is not a replay artifact")
+        if version != ARTIFACT_VERSION:
+            raise ValueError(f"{path} is a version {version} replay artifact, expected {ARTIFACT_VERSION}")
+
+        self.list_names = []
+        offset = self.names_offset
+        for _ in range(n_lists):
+            length, = struct.unpack_from("<H", self.mmap, offset)
+            self.list_names.append(self.mmap[offset + 2:offset + 2 + length].decode())
+            offset += 2 + length
+        self.index = np.frombuffer(self.mmap, dtype=ARTIFACT_INDEX_DTYPE, count=n_index, offset=index_offset) \
+                     if n_index > 0 else np.zeros(0, dtype=ARTIFACT_INDEX_DTYPE)
+
+    def __len__(self):
+        return self.n_messages
+
+    def messages(self, start_time=None, end_time=None):
+        """Yields (schedule time, list name, payload) of the messages from start_time (ns) until before end_time (ns).
+
+        Messages come in push order. Only the strides of the index whose
+        time range overlaps the window are read, and their records are
+        filtered one by one, as records can be out of schedule order.
+        """
+        strides = np.ones(len(self.index), dtype=bool)
+        if start_time is not None:
+            strides &= self.index["max_time"] >= start_time
+        if end_time is not None:
+            strides &= self.index["min_time"] < end_time
+        stride_ends = np.append(self.index["offset"][1:], np.uint64(self.names_offset))
+        data = self.mmap
+        list_names = self.list_names
+        unpack_record = ARTIFACT_RECORD.unpack_from
+        record_size = ARTIFACT_RECORD.size
+        for offset, end in zip(self.index["offset"][strides].tolist(), stride_ends[strides].tolist()):
+            while offset < end:
+                schedule_time, list_id, length = unpack_record(data, offset)
+                offset += record_size
+                if (start_time is None or schedule_time >= start_time) and (end_time is None or schedule_time < end_time):
+                    yield schedule_time, list_names[list_id], data[offset:offset + length]
+                offset += length
+
+    def close(self):
+        """Unmaps and closes the artifact."""
+        self.index = None
+        self.mmap.close()
+        self.file.close()
@@ -0,0 +1,156 @@
+"""Replay metrics written as JSON lines while replaying and summarized at the end.
+
+Each interval line has the messages and bytes per second of every list,
+the serialization seconds of every table so far, the Redis pipeline
+latency histogram, the schedule lag percentiles of the interval and the
+peak memory. Latencies and lags are counted in log2 buckets, so their
+percentiles are bucket upper bounds. The last line is the summary of the whole replay.
+
+"""
+
+import sys
+import json
+import time
+import resource
+import threading
+
+import numpy as np
+
+# seconds between metrics lines
+METRICS_INTERVAL = 1.
+
+
+class ReplayMetrics():
+    def __init__(self, path=None, interval=METRICS_INTERVAL):
+        """Collects replay metrics from the counters the replay keeps anyway.
+
+        The sink counts messages and bytes per list in ListCounters,
+        which can be copied from another thread, the Redis writers count
+        pipeline latencies in log2 buckets, the replay adds up the
+        serialization seconds per table and the pacer counts the lag of
+        every row in log2 buckets. A background thread reads these every
+        interval seconds and writes their change as a JSON line to path
+        ("-" for stdout), so the replay loop does no extra work per
+        message.
+        Without a path only the summary is made.
+        """
+        self.path = path
+        self.interval = interval
+        self.file = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self, sink, pacer, serialize_seconds):
+        """Starts measuring a replay into sink."""
+        self.sink = sink
+        self.pacer = pacer
+        self.serialize_seconds = serialize_seconds
+        self.start_time = time.monotonic()
+        self.last_time = self.start_time
+        self.last_messages = {}
+        self.last_bytes = {}
+        self.last_lag_counts = [0] * len(pacer.lag_counts)
+        if self.path is not None:
+            self.file = sys.stdout if self.path == "-" else open(self.path, "w")
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        """Writes a metrics line every interval until stopped."""
+        while not self.stopped.wait(self.interval):
+            self.write(self.interval_metrics())
+
+    def write(self, metrics):
+        """Writes one metrics line."""
+        self.file.write(json.dumps(metrics) + "\n")
+        self.file.flush()
+
+    def interval_metrics(self):
+        """Returns the metrics since the last line."""
+        now = time.monotonic()
+        seconds = max(now - self.last_time, 1e-9)
+        list_messages, list_bytes = self.sink.list_counts.snapshot()
+        lag_counts = list(self.pacer.lag_counts)
+        metrics = {
+            "type" : "interval",
+            "time_s" : round(now - self.start_time, 3),
+            "msgs_per_s" : round((sum(list_messages.values()) - sum(self.last_messages.values())) / seconds, 1),
+            "bytes_per_s" : round((sum(list_bytes.values()) - sum(self.last_bytes.values())) / seconds, 1),
+            "lists" : {list_name : {"msgs_per_s" : round((n - self.last_messages.get(list_name, 0)) / seconds, 1),
+                                    "bytes_per_s" : round((list_bytes.get(list_name, 0) - self.last_bytes.get(list_name, 0)) / seconds, 1)}
+                       for list_name, n in list_messages.items()},
+            "serialize_s" : {table : round(value, 4) for table, value in dict(self.serialize_seconds).items()},
+            "push_latency_us" : self.latency_histogram(),
+            "schedule_lag_ms" : lag_percentiles([count - last for count, last in zip(lag_counts, self.last_lag_counts)]),
+            "peak_rss_mb" : peak_rss_mb(),
+        }
+        self.last_time = now
+        self.last_messages = list_messages
+        self.last_bytes = list_bytes
+        self.last_lag_counts = lag_counts
+        return metrics
+
+    def latency_histogram(self):
+        """Returns the pipeline round trips per latency bucket, keyed by the bucket's upper bound in us."""
+        counts = getattr(self.sink, "latency_counts", None)
+        if counts is None:
+            return None
+        return {f"<{2 ** bucket}" : count for bucket, count in enumerate(counts) if count > 0}
+
+    def summary(self):
+        """Returns the metrics of the whole replay."""
+        seconds = max(time.monotonic() - self.start_time, 1e-9)
+        list_messages, list_bytes = self.sink.list_counts.snapshot()
+        return {
+            "type" : "summary",
+            "time_s" : round(seconds, 3),
+            "messages" : self.sink.n_messages,
+            "bytes" : self.sink.n_bytes,
+            "msgs_per_s" : round(self.sink.n_messages / seconds, 1),
+            "bytes_per_s" : round(self.sink.n_bytes / seconds, 1),
+            "lists" : {list_name : {"messages" : n, "bytes" : list_bytes[list_name]}
+                       for list_name, n in list_messages.items()},
+            "serialize_s" : {table : round(value, 4) for table, value in self.serialize_seconds.items()},
+            "push_latency_us" : self.latency_histogram(),
+            "schedule_lag_ms" : lag_percentiles(self.pacer.lag_counts, self.pacer.max_lag),
+            "peak_rss_mb" : peak_rss_mb(),
+        }
+
+    def stop(self):
+        """Stops the interval lines, writes the summary line and prints it."""
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+        summary = self.summary()
+        if self.file is not None:
+            self.write(summary)
+            if self.file is not sys.stdout:
+                self.file.close()
+        if len(summary["serialize_s"]) > 0:
+            print("Serialization seconds: " + ", ".join(f"{table} {value:.2f}" for table, value in summary["serialize_s"].items()))
+        if summary["push_latency_us"]:
+            p50, p99 = histogram_percentiles(self.sink.latency_counts, [0.5, 0.99])
+            print(f"Push latency: p50 < {p50} us, p99 < {p99} us")
+        print(f"Peak memory: {summary['peak_rss_mb']:.0f} MB")
+
+
+def lag_percentiles(lag_counts, max_lag=None):
+    """Returns the bucket upper bounds in ms of the p50 and p99 of a schedule lag histogram and its max, None without any."""
+    if sum(lag_counts) == 0:
+        return None
+    p50, p99 = histogram_percentiles(lag_counts, [0.5, 0.99])
+    lags = {"p50" : p50 / 1e3, "p99" : p99 / 1e3}
+    if max_lag is not None:
+        lags["max"] = round(max_lag * 1e3, 3)
+    return lags
+
+
+def histogram_percentiles(counts, quantiles):
+    """Returns the upper bound in us of the bucket holding each quantile of a latency histogram."""
+    cumulative = np.cumsum(counts)
+    return [2 ** int(np.searchsorted(cumulative, quantile * cumulative[-1])) for quantile in quantiles]
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in MB."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
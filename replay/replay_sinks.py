@@ -0,0 +1,150 @@
+"""Destinations for replayed messages: Redis, memory, a file or nowhere.
+
+Every sink has the interface of RedisWriter: push(list_name, payload),
+flush(), close(), messages_per_second() and report(), with n_messages
+and n_bytes counters and list_counts per list.
+
+"""
+
+import time
+import struct
+from collections import defaultdict, deque
+
+from redis_writer import RedisWriter, AsyncRedisWriter, ListCounters, REDIS_BATCH_SIZE
+
+SINKS = ["redis", "memory", "file", "null"]
+
+# write buffer size in bytes of the file sink
+FILE_SINK_BUFFER_SIZE = 1024 * 1024
+
+# list name length and payload length before each message in a sink file
+FILE_SINK_RECORD = struct.Struct("<HI")
+
+
+def make_sink(sink="redis", engine="sync", host="127.0.0.1", port=6379,
+              batch_size=REDIS_BATCH_SIZE, path="replay.bin"):
+    """Returns the sink replayed messages are pushed to.
+
+    The async engine pushes through AsyncRedisWriter, so it needs the
+    redis sink.
+    """
+    if sink == "redis":
+        if engine == "async":
+            return AsyncRedisWriter(host, port, batch_size)
+        return RedisWriter(host, port, batch_size)
+    if engine == "async":
+        raise ValueError(f"the async engine can't push to the {sink} sink, only to redis")
+    if sink == "memory":
+        return MemorySink()
+    if sink == "file":
+        return FileSink(path)
+    if sink == "null":
+        return NullSink()
+    raise ValueError(f"unknown sink {sink}, expected one of {SINKS}")
+
+
+class NullSink():
+    def __init__(self):
+        """Counts messages and bytes without keeping them.
+
+        Replaying into it measures reading, serializing and scheduling
+        on their own.
+        """
+        self.n_messages = 0
+        self.n_bytes = 0
+        self.start_time = None
+        self.list_counts = ListCounters()
+
+    def push(self, list_name, payload):
+        """Counts a message."""
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        self.n_messages += 1
+        self.n_bytes += len(payload)
+        # ListCounters.add inlined, this runs for every message
+        try:
+            self.list_counts.messages[list_name] += 1
+            self.list_counts.bytes[list_name] += len(payload)
+        except KeyError:
+            self.list_counts.add(list_name, 1, len(payload))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def messages_per_second(self):
+        """Returns the messages pushed per second since the first push."""
+        if self.start_time is None:
+            return 0.
+        return self.n_messages / max(time.monotonic() - self.start_time, 1e-9)
+
+    def report(self):
+        """Prints the messages and bytes pushed and the achieved rate."""
+        print(f"{type(self).__name__} got {self.n_messages} messages ({self.n_bytes / 1e6:.1f} MB): "
+              f"{self.messages_per_second():.0f} msgs/s")
+
+
+class MemorySink(NullSink):
+    def __init__(self):
+        """Keeps messages in in-process lists, like Redis lists without a server.
+
+        Pushes prepend like LPUSH, so lists[name][0] is the newest
+        message and pop() takes the oldest like a consumer's RPOP.
+        """
+        super().__init__()
+        self.lists = defaultdict(deque)
+
+    def push(self, list_name, payload):
+        """Prepends a message to a list."""
+        super().push(list_name, payload)
+        self.lists[list_name].appendleft(payload)
+
+    def pop(self, list_name):
+        """Removes and returns the oldest message of a list, None if it's empty."""
+        messages = self.lists.get(list_name)
+        return messages.pop() if messages else None
+
+
+class FileSink(NullSink):
+    def __init__(self, path):
+        """Writes messages to a binary file in push order.
+
+        Each message is its list name length (uint16) and payload length
+        (uint32), little endian, followed by the UTF-8 list name and the
+        payload. read_sink_file() reads them back.
+        """
+        super().__init__()
+        self.path = path
+        self.file = open(path, "wb", buffering=FILE_SINK_BUFFER_SIZE)
+        self.list_names = {}
+
+    def push(self, list_name, payload):
+        """Appends a message to the file."""
+        super().push(list_name, payload)
+        name = self.list_names.get(list_name)
+        if name is None:
+            name = self.list_names[list_name] = list_name.encode()
+        self.file.write(FILE_SINK_RECORD.pack(len(name), len(payload)))
+        self.file.write(name)
+        self.file.write(payload)
+
+    def flush(self):
+        """Writes the buffered messages to the file."""
+        self.file.flush()
+
+    def close(self):
+        """Writes the buffered messages and closes the file."""
+        self.file.close()
+
+
+def read_sink_file(path):
+    """Yields (list name, payload) of every message of a FileSink file in push order."""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(FILE_SINK_RECORD.size)
+            if len(header) < FILE_SINK_RECORD.size:
+                return
+            name_length, payload_length = FILE_SINK_RECORD.unpack(header)
+            yield f.read(name_length).decode(), f.read(payload_length)
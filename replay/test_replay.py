@@ -0,0 +1,482 @@
+""" Round trip tests of the replay paths on a synthetic sensors database, run with pytest """
+
+import os
+import json
+import time
+import base64
+import shutil
+import sqlite3
+import socket
+import subprocess
+
+import numpy as np
+import pandas as pd
+import redis
+import pytest
+
+import replay as replay_module
+import sensordata_pb2 as sensordata
+from replay import SensorReplay, SchedulePacer, parse_window_time
+from replay_sinks import MemorySink, make_sink, read_sink_file
+from replay_artifact import ReplayArtifact
+from replay_metrics import ReplayMetrics, histogram_percentiles, lag_percentiles
+
+# whole second the synthetic session starts at, the first nav_pvt is 150 us later
+SESSION_START = pd.Timestamp("2024-02-04 00:01:22")
+
+SESSION = "s1"
+
+
+def system_times(times, fractional=True):
+    """Formats times like the recorder, optionally without fractional seconds."""
+    return [time.strftime("%Y-%m-%d %H:%M:%S.%f" if fractional else "%Y-%m-%d %H:%M:%S")
+            for time in times]
+
+
+def write_sensors_db(path, seconds=20, imu_jitter_ms=0, seed=0, sessions=(SESSION,), repeat_itow_ms=False):
+    """Writes a sensors database with every replayed table of one session.
+
+    nav_pvt and the itow_ms tables are at 10 Hz, imu at 200 Hz,
+    magnetometer at 20 Hz, gnss at 1 Hz stored without fractional
+    seconds and gnss_auth every 5 s. imu times are jittered by up to
+    imu_jitter_ms, so they aren't in recorded order. With repeat_itow_ms,
+    the 4th nav row repeats the 3rd's itow_ms and the 7th goes back to
+    the 2nd's, in nav_pvt and every itow_ms table. With more sessions,
+    the rows of each are written in turn, those before SESSION an hour
+    earlier each and those after an hour later each.
+    """
+    rng = np.random.default_rng(seed)
+    tables = {}
+
+    n = seconds * 10
+    nav_times = SESSION_START + pd.Timedelta(microseconds=150) + pd.to_timedelta(np.arange(n) * 100, unit="ms")
+    itow_ms = 100000 + np.arange(n) * 100
+    if repeat_itow_ms:
+        itow_ms[3], itow_ms[6] = itow_ms[2], itow_ms[1]
+    nav = lambda: pd.DataFrame({"system_time": system_times(nav_times), "session": SESSION, "itow_ms": itow_ms})
+
+    nav_pvt = nav()
+    for column in ["fix_type", "num_sv", "valid_date", "valid_time", "fully_resolved", "valid_mag", "gnss_fix_ok",
+                   "diff_soln", "psm_state", "head_veh_valid", "carr_soln", "invalid_llh", "last_correction_age",
+                   "auth_time", "nma_fix_status"]:
+        nav_pvt[column] = rng.integers(0, 2, n)
+    for column in ["lon_deg", "lat_deg", "height_m", "hmsl_m", "h_acc_m", "v_acc_m", "vel_n_m_s", "vel_e_m_s",
+                   "vel_d_m_s", "g_speed_m_s", "head_mot_deg", "s_acc_m_s", "head_acc_deg", "pdop"]:
+        nav_pvt[column] = rng.uniform(0, 100, n)
+    tables["nav_pvt"] = nav_pvt
+
+    nav_status = nav()
+    for column in ["gps_fix", "gps_fix_ok", "diff_soln", "wkn_set", "tow_set", "diff_corr", "carr_soln_valid",
+                   "psm_state", "spoof_det_state", "carr_soln", "ttff", "msss"]:
+        nav_status[column] = rng.integers(0, 2, n)
+    tables["nav_status"] = nav_status
+
+    nav_cov = nav().assign(version=0, posCovValid=1, velCovValid=1)
+    for column in [f"{kind}_cov_{axes}" for kind in ["pos", "vel"] for axes in ["n_n", "n_e", "n_d", "e_e", "e_d", "d_d"]]:
+        nav_cov[column] = rng.normal(size=n)
+    tables["nav_cov"] = nav_cov
+
+    tables["nav_posecef"] = nav().assign(ecef_x=rng.uniform(-1e6, 1e6, n), ecef_y=rng.uniform(-1e6, 1e6, n),
+                                         ecef_z=rng.uniform(-1e6, 1e6, n), p_acc=rng.uniform(0, 5, n))
+    tables["nav_velecef"] = nav().assign(ecef_vx=rng.normal(size=n), ecef_vy=rng.normal(size=n),
+                                         ecef_vz=rng.normal(size=n), s_acc=rng.uniform(0, 1, n))
+    tables["nav_timegps"] = nav().assign(week=2300, ftow_ns=rng.integers(-500000, 500000, n), leap_s=18, valid=7,
+                                         t_acc_ns=rng.integers(0, 100, n))
+
+    # imu starts before the first nav_pvt, those rows aren't replayed
+    n_imu = (seconds + 1) * 200
+    imu_times = SESSION_START - pd.Timedelta(seconds=1) + pd.to_timedelta(np.arange(n_imu) * 5, unit="ms")
+    if imu_jitter_ms > 0:
+        imu_times += pd.to_timedelta(rng.integers(-imu_jitter_ms, imu_jitter_ms + 1, n_imu), unit="ms")
+    imu = pd.DataFrame({"time": system_times(imu_times), "session": SESSION})
+    for column in ["acc_x", "acc_y", "acc_z", "gyro_x", "gyro_y", "gyro_z", "temperature"]:
+        imu[column] = rng.normal(size=n_imu)
+    tables["imu"] = imu
+
+    mag_times = SESSION_START + pd.to_timedelta(np.arange(seconds * 20) * 50 + 25, unit="ms")
+    tables["magnetometer"] = pd.DataFrame({"system_time": system_times(mag_times), "session": SESSION,
+                                           "mag_x": rng.normal(size=len(mag_times)), "mag_y": rng.normal(size=len(mag_times)),
+                                           "mag_z": rng.normal(size=len(mag_times))})
+
+    # gnss rows on whole seconds, stored without fractional seconds
+    gnss_times = SESSION_START + pd.to_timedelta(np.arange(1, seconds), unit="s")
+    gnss = pd.DataFrame({"system_time": system_times(gnss_times, fractional=False), "session": SESSION,
+                         "time": system_times(gnss_times), "actual_system_time": system_times(gnss_times),
+                         "fix": "3D", "rf_jamming_state": "ok", "rf_ant_status": "ok", "rf_ant_power": "on"})
+    for column in ["latitude", "longitude", "altitude", "speed", "heading", "eph", "horizontal_accuracy",
+                   "vertical_accuracy", "heading_accuracy", "speed_accuracy", "hdop", "vdop", "xdop", "ydop",
+                   "tdop", "pdop", "gdop", "cno"]:
+        gnss[column] = rng.normal(size=len(gnss))
+    for column in ["ttff", "satellites_seen", "satellites_used", "rf_post_status", "rf_noise_per_ms", "rf_agc_cnt",
+                   "rf_jam_ind", "rf_ofs_i", "rf_mag_i", "rf_ofs_q", "time_resolved"]:
+        gnss[column] = rng.integers(0, 100, len(gnss))
+    tables["gnss"] = gnss
+
+    auth_times = SESSION_START + pd.to_timedelta(np.arange(seconds // 5) * 5000 + 1, unit="ms")
+    signature = base64.b64encode(b"0123456789abcdef").decode()
+    tables["gnss_auth"] = pd.DataFrame({"system_time": system_times(auth_times), "session_id": SESSION,
+                                        "buffer": "abc", "buffer_message_num": np.arange(len(auth_times)),
+                                        "gnss_session_id": signature, "buffer_hash": signature,
+                                        "signature": signature})
+
+    offsets = {session: pd.Timedelta(hours=i - list(sessions).index(SESSION)) for i, session in enumerate(sessions)}
+    connection = sqlite3.connect(path)
+    for table, df in tables.items():
+        df = pd.concat([shifted_session(df, session, offset) for session, offset in offsets.items()], ignore_index=True)
+        df.to_sql(table, connection, index=True, index_label="id")
+    connection.close()
+    return path
+
+
+def shifted_session(df, session, offset):
+    """Returns a copy of a table's rows as another session, offset in time."""
+    df = df.copy()
+    df["session_id" if "session_id" in df else "session"] = session
+    for column in ["system_time", "time", "actual_system_time"]:
+        if column in df:
+            fractional = df[column].str.contains(".", regex=False).all()
+            df[column] = system_times(pd.to_datetime(df[column]) + offset, fractional)
+    return df
+
+
+def replay(db_path, **kwargs):
+    """Replays into a MemorySink and returns each list's payloads in push order."""
+    sr = SensorReplay(db_path, SESSION, sink="memory", **kwargs)
+    sr.run_replay()
+    return {list_name: [bytes(payload) for payload in reversed(payloads)]
+            for list_name, payloads in sr.sink.lists.items()}
+
+
+def artifact_lists(artifact_path, start_time=None, end_time=None):
+    """Returns each list's payloads of an artifact's messages from start_time until before end_time (ns)."""
+    artifact = ReplayArtifact(artifact_path)
+    lists = {}
+    for schedule_time, list_name, payload in artifact.messages(start_time, end_time):
+        lists.setdefault(list_name, []).append(bytes(payload))
+    artifact.close()
+    return lists
+
+
+@pytest.fixture(scope="module")
+def sensors_db(tmp_path_factory):
+    return write_sensors_db(str(tmp_path_factory.mktemp("replay") / "sensors.db"))
+
+
+def compile_artifact(db_path, artifact_path):
+    SensorReplay(db_path, SESSION, sink="null").compile(artifact_path)
+    return artifact_path
+
+
+@pytest.fixture(scope="module")
+def compiled(sensors_db, tmp_path_factory):
+    return compile_artifact(sensors_db, str(tmp_path_factory.mktemp("replay") / "drive.replay"))
+
+
+@pytest.fixture(scope="module")
+def jittered_db(tmp_path_factory):
+    # imu rows out of time order, so the artifact's schedule times go back and forth
+    return write_sensors_db(str(tmp_path_factory.mktemp("replay") / "sensors.db"), imu_jitter_ms=20, seed=3)
+
+
+@pytest.fixture(scope="module")
+def jittered_compiled(jittered_db, tmp_path_factory):
+    return compile_artifact(jittered_db, str(tmp_path_factory.mktemp("replay") / "drive.replay"))
+
+
+def test_artifact_matches_database(sensors_db, compiled):
+    lists = replay(sensors_db)
+
+    assert len(lists["NavPvt"]) == 200
+    # the imu row at the session start is 150 us before the first nav_pvt
+    assert len(lists["imu_data"]) == 20 * 200 - 1
+    assert lists == replay(sensors_db, artifact_path=compiled)
+
+
+@pytest.fixture
+def redis_port(tmp_path):
+    """Port of a redis-server started from redis.conf for the test, not daemonized and without persistence."""
+    if shutil.which("redis-server") is None:
+        pytest.skip("redis-server is not on PATH")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    conf_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "redis.conf")
+    process = subprocess.Popen(["redis-server", conf_path, "--port", str(port), "--daemonize", "no",
+                                "--dir", str(tmp_path), "--pidfile", str(tmp_path / "redis.pid"),
+                                "--syslog-enabled", "no"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = redis.Redis(port=port)
+    try:
+        for _ in range(100):
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        yield port
+    finally:
+        client.close()
+        process.terminate()
+        process.wait(10)
+
+
+@pytest.mark.parametrize("engine", ["sync", "async"])
+def test_redis_lists_match_memory_sink(sensors_db, redis_port, engine):
+    expected = SensorReplay(sensors_db, SESSION, sink="memory")
+    expected.run_replay()
+
+    # the replay's own Redis server is on port 6379, this one is the test's
+    sr = SensorReplay(sensors_db, SESSION, sink="null", batch_size=64)
+    sr.engine = engine
+    sr.sink = make_sink("redis", engine, "127.0.0.1", redis_port, batch_size=64)
+    sr.run_replay()
+
+    client = redis.Redis(port=redis_port)
+    lists = {name.decode(): client.lrange(name, 0, -1) for name in client.keys()}
+    client.close()
+    assert lists == {list_name: list(payloads) for list_name, payloads in expected.sink.lists.items()}
+
+
+@pytest.mark.parametrize("create_indexes", [False, True])
+@pytest.mark.parametrize("start,end", [("5", "+12s"), ("2024-02-04 00:01:27", "2024-02-04 00:01:35.5")])
+@pytest.mark.parametrize("db_name,compiled_name", [("sensors_db", "compiled"), ("jittered_db", "jittered_compiled")])
+def test_window_matches_full_replay(request, tmp_path, db_name, compiled_name, create_indexes, start, end):
+    compiled = request.getfixturevalue(compiled_name)
+    # indexing writes to the database, so it gets its own copy
+    db_path = str(tmp_path / "sensors.db")
+    shutil.copy(request.getfixturevalue(db_name), db_path)
+    start, end = parse_window_time(start), parse_window_time(end)
+    artifact = ReplayArtifact(compiled)
+    first_time = artifact.first_time
+    artifact.close()
+    start_time = first_time + start.value if isinstance(start, pd.Timedelta) else start.value
+    end_time = first_time + end.value if isinstance(end, pd.Timedelta) else end.value
+
+    lists = replay(db_path, start=start, end=end, create_indexes=create_indexes)
+
+    assert lists == artifact_lists(compiled, start_time, end_time)
+    assert lists == replay(db_path, artifact_path=compiled, start=start, end=end)
+
+
+def test_window_includes_whole_second_times_at_start(sensors_db):
+    lists = replay(sensors_db, start=parse_window_time("2024-02-04 00:01:27"),
+                   end=parse_window_time("2024-02-04 00:01:30"))
+
+    gnss = [sensordata.GnssData.FromString(payload).system_time for payload in lists["gnss_data"]]
+    assert gnss == ["2024-02-04 00:01:27", "2024-02-04 00:01:28", "2024-02-04 00:01:29"]
+
+
+def test_rows_replayed_in_recorded_order(tmp_path):
+    db_path = write_sensors_db(str(tmp_path / "sensors.db"), seconds=5, imu_jitter_ms=3)
+
+    lists = replay(db_path)
+
+    connection = sqlite3.connect(db_path)
+    recorded = [time for time, in connection.execute("SELECT time FROM imu ORDER BY rowid")]
+    connection.close()
+    first_nav_pvt = (SESSION_START + pd.Timedelta(microseconds=150)).value
+    recorded = [time for time in recorded if pd.Timestamp(time).value >= first_nav_pvt]
+    assert [sensordata.ImuData.FromString(payload).time for payload in lists["imu_data"]] == recorded
+
+
+def test_session_read_within_its_rowid_range(tmp_path):
+    single_db = write_sensors_db(str(tmp_path / "single.db"), seconds=5)
+    db_path = write_sensors_db(str(tmp_path / "sensors.db"), seconds=5, sessions=("s0", SESSION, "s2"))
+
+    lists = replay(single_db)
+    assert replay(db_path) == lists
+
+    sr = SensorReplay(db_path, SESSION, sink="memory", create_indexes=True)
+    connection = sqlite3.connect(db_path)
+    for table in sr.system_time_columns:
+        session_column = sr.session_column(table)
+        rowid_range = connection.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table} WHERE {session_column} = ?",
+                                         [SESSION]).fetchone()
+        where, params = sr.filters[table]
+        assert "rowid BETWEEN ? AND ?" in where
+        assert params[-2] >= rowid_range[0] and params[-1] <= rowid_range[1]
+    connection.close()
+    sr.run_replay()
+    assert {list_name: [bytes(payload) for payload in reversed(payloads)]
+            for list_name, payloads in sr.sink.lists.items()} == lists
+
+
+def message_key(list_name, payload):
+    """Returns the fields telling a replayed message apart from the others of its list."""
+    if list_name == "NavPvt":
+        message = sensordata.NavPvt.FromString(payload)
+        return message.system_time, message.itow_ms
+    if list_name in ["gnss_data", "gnss_auth_data"]:
+        return sensordata.GnssData.FromString(payload).system_time
+    if list_name == "imu_data":
+        return sensordata.ImuData.FromString(payload).time
+    if list_name == "magnetometer_data":
+        return sensordata.MagnetometerData.FromString(payload).system_time
+    if list_name == "NavCov":
+        return sensordata.NavCov.FromString(payload).version
+    if list_name == "NavPosecef":
+        return sensordata.NavPosecef.FromString(payload).p_acc_cm
+    if list_name == "NavStatus":
+        return sensordata.NavStatus.FromString(payload).msss
+    if list_name == "NavTimegps":
+        return sensordata.NavTimegps.FromString(payload).ftow_ns
+    if list_name == "NavVelecef":
+        return sensordata.NavVelecef.FromString(payload).s_acc_cm_s
+    if list_name in ["NavDop", "NavSat"]:
+        message = getattr(sensordata, list_name).FromString(payload)
+        return message.system_time, message.itow_ms
+    return sensordata.MonRf.FromString(payload).system_time
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("chunk_rows", [1, 7])
+def test_schedule_matches_baseline_order(tmp_path, monkeypatch, chunk_rows, workers):
+    seconds = 6
+    db_path = write_sensors_db(str(tmp_path / "sensors.db"), seconds=seconds, sessions=("s0", SESSION),
+                               repeat_itow_ms=True)
+    # each itow_ms table row carries its id in a field of its message
+    connection = sqlite3.connect(db_path)
+    for table, column, scale in [("nav_cov", "version", 1), ("nav_posecef", "p_acc", 100),
+                                 ("nav_status", "msss", 1), ("nav_timegps", "ftow_ns", 1), ("nav_velecef", "s_acc", 100)]:
+        connection.execute(f"UPDATE {table} SET {column} = id / {scale:.1f}")
+    connection.commit()
+    connection.close()
+
+    # the baseline merge: rows of the session from the first nav_pvt on in sync time order, ties to
+    # the first table, each nav_pvt with the first recorded row of each itow_ms table with its itow_ms
+    n_nav = seconds * 10
+    nav_times = SESSION_START + pd.Timedelta(microseconds=150) + pd.to_timedelta(np.arange(n_nav) * 100, unit="ms")
+    itow_ms = 100000 + np.arange(n_nav) * 100
+    itow_ms[3], itow_ms[6] = itow_ms[2], itow_ms[1]
+    itow_ms_rows = n_nav + np.array([0, 1, 2, 2, 4, 5, 1] + list(range(7, n_nav)))
+    imu_times = SESSION_START - pd.Timedelta(seconds=1) + pd.to_timedelta(np.arange((seconds + 1) * 200) * 5, unit="ms")
+    rows = [(nav_time, 0, [("NavPvt", (system_time, itow)),
+                           *[(list_name, row) for list_name in ["NavCov", "NavPosecef", "NavStatus", "NavTimegps", "NavVelecef"]],
+                           ("NavDop", (system_time, itow)), ("NavSat", (system_time, itow)), ("MonRf", system_time)])
+            for nav_time, system_time, itow, row in zip(nav_times, system_times(nav_times), itow_ms.tolist(),
+                                                        itow_ms_rows.tolist())]
+    gnss_times = SESSION_START + pd.to_timedelta(np.arange(1, seconds), unit="s")
+    rows += [(gnss_time, 1, [("gnss_data", system_time)])
+             for gnss_time, system_time in zip(gnss_times, system_times(gnss_times, fractional=False))]
+    auth_times = SESSION_START + pd.to_timedelta(np.arange(seconds // 5) * 5000 + 1, unit="ms")
+    rows += [(auth_time, 2, [("gnss_auth_data", system_time)]) for auth_time, system_time in zip(auth_times, system_times(auth_times))]
+    rows += [(imu_time, 3, [("imu_data", system_time)]) for imu_time, system_time in zip(imu_times, system_times(imu_times))
+             if imu_time >= nav_times[0]]
+    mag_times = SESSION_START + pd.to_timedelta(np.arange(seconds * 20) * 50 + 25, unit="ms")
+    rows += [(mag_time, 4, [("magnetometer_data", system_time)]) for mag_time, system_time in zip(mag_times, system_times(mag_times))]
+    expected = [message for _, _, messages in sorted(rows, key=lambda row: row[:2]) for message in messages]
+
+    monkeypatch.setattr(replay_module, "READ_CHUNK_ROWS", chunk_rows)
+    sr = SensorReplay(db_path, SESSION, workers=workers, sink="memory")
+    pushed = []
+    sr.push_to_sink = lambda payload, list_name: (pushed.append((list_name, message_key(list_name, payload))),
+                                                  sr.sink.push(list_name, payload))
+    sr.run_replay()
+
+    assert pushed == expected
+    for list_name, payloads in sr.sink.lists.items():
+        assert [message_key(list_name, payload) for payload in reversed(payloads)] == \
+               [key for name, key in expected if name == list_name]
+
+
+def test_file_sink_round_trip(sensors_db, tmp_path):
+    sink_path = str(tmp_path / "replay.bin")
+    sr = SensorReplay(sensors_db, SESSION, sink="file", sink_path=sink_path)
+    sr.run_replay()
+
+    messages = list(read_sink_file(sink_path))
+    assert len(messages) == sr.sink.n_messages
+    # in push order across lists: the first nav_pvt row and the messages pushed with it
+    assert [list_name for list_name, _ in messages[:9]] == ["NavPvt", "NavCov", "NavPosecef", "NavStatus", "NavTimegps",
+                                                            "NavVelecef", "NavDop", "NavSat", "MonRf"]
+    lists = {}
+    for list_name, payload in messages:
+        lists.setdefault(list_name, []).append(payload)
+    assert lists == replay(sensors_db)
+
+
+def test_pacer_waits_for_rows_at_speed(monkeypatch, capsys):
+    now = [100.]
+    monkeypatch.setattr(replay_module.time, "monotonic", lambda: now[0])
+    pacer = SchedulePacer(2.)
+
+    # at 2x, rows 1 s of sync time apart are due 0.5 s apart from the first row
+    assert pacer.wait_time(1_000_000_000) == 0.
+    pacer.sent()
+    assert pacer.wait_time(2_000_000_000) == 0.5
+    now[0] = 100.5
+    pacer.sent()
+    # sent 0.5 ms late
+    now[0] = 101.0005
+    assert pacer.wait_time(3_000_000_000) == 0.
+    pacer.sent()
+    # due in less than PACING_MIN_SLEEP, sent right away
+    now[0] = 101.4995
+    assert pacer.wait_time(4_000_000_000) == 0.
+    pacer.sent()
+
+    assert pacer.lag_counts[0] == 3 and pacer.lag_counts[9] == 1 and sum(pacer.lag_counts) == 4
+    assert pacer.max_lag == pytest.approx(0.0005)
+    pacer.report()
+    assert capsys.readouterr().out == "Schedule lag at 2x: p50 < 0.001 ms, p99 < 0.512 ms, max 0.50 ms\n"
+
+    # as fast as possible, nothing waits and no lags are counted
+    pacer = SchedulePacer(float("inf"))
+    assert pacer.wait_time(1_000_000_000) == 0. and pacer.wait_time(9_000_000_000) == 0.
+    pacer.sent()
+    assert sum(pacer.lag_counts) == 0
+
+
+def test_histogram_percentiles():
+    # 10 counts in the 2, 8 and 16 us buckets: the 5th is in the 8 us bucket, the 9.9th in the 16 us one
+    counts = [0, 4, 0, 5, 1]
+    assert histogram_percentiles(counts, [0.5, 0.99]) == [8, 16]
+    assert histogram_percentiles([5, 5], [0.5, 1.]) == [1, 2]
+    assert lag_percentiles(counts, 0.0123) == {"p50": 0.008, "p99": 0.016, "max": 12.3}
+    assert lag_percentiles(counts) == {"p50": 0.008, "p99": 0.016}
+    assert lag_percentiles([0] * 32) is None
+
+
+def test_metrics_summary_line(sensors_db, tmp_path):
+    metrics_path = str(tmp_path / "metrics.jsonl")
+    sr = SensorReplay(sensors_db, SESSION, sink="null", metrics=ReplayMetrics(metrics_path, interval=0.05))
+    sr.run_replay()
+
+    with open(metrics_path) as f:
+        lines = [json.loads(line) for line in f]
+    assert all(line["type"] == "interval" for line in lines[:-1])
+    summary = lines[-1]
+    assert summary["type"] == "summary"
+    lists = replay(sensors_db)
+    assert summary["lists"] == {list_name: {"messages": len(payloads), "bytes": sum(len(payload) for payload in payloads)}
+                                for list_name, payloads in lists.items()}
+    assert summary["messages"] == sum(len(payloads) for payloads in lists.values())
+    assert summary["bytes"] == sum(list_counts["bytes"] for list_counts in summary["lists"].values())
+    assert set(summary["serialize_s"]) == set(sr.redis_table_to_list)
+    # no pipeline round trips into a NullSink and no pacing as fast as possible
+    assert summary["push_latency_us"] is None and summary["schedule_lag_ms"] is None
+
+
+class AsyncMemorySink(MemorySink):
+    """A MemorySink with the awaitable push and close of AsyncRedisWriter."""
+
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+
+    async def push(self, list_name, payload):
+        super().push(list_name, payload)
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.parametrize("speed,batch_size", [(float("inf"), 7), (200., 100)])
+def test_async_engine_matches_sync(sensors_db, speed, batch_size):
+    sr = SensorReplay(sensors_db, SESSION, speed=speed, sink="memory")
+    sr.engine = "async"
+    sr.sink = AsyncMemorySink(batch_size)
+    sr.run_replay()
+
+    assert {list_name: [bytes(payload) for payload in reversed(payloads)]
+            for list_name, payloads in sr.sink.lists.items()} == replay(sensors_db)